@@ -0,0 +1,176 @@
+""" Daily maps of a product as PNG frames and/or an animation (MP4 or GIF).
+
+    The figure, its background (the cached basemap of the city, see render.py)
+    and the pcolormesh are created once; for each day only the values of the
+    mesh and the title are updated. The days are read BLOCK_DAYS at a time and
+    each frame is written to disk (or sent to ffmpeg) as soon as it is drawn,
+    so the frames are never all in memory.
+
+    python animate.py -c Moscow -p L2__NO2___ -o ../data/final_tensors/Moscow/L2__NO2___.mp4
+    python animate.py -c Moscow -p L2__NO2___ --frames ../data/frames/Moscow --start 2019-03-01 --end 2019-04-01
+"""
+
+import os
+import time
+import argparse
+from contextlib import nullcontext
+
+import numpy as np
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+from matplotlib import animation
+
+import cartopy.crs as ccrs
+import cartopy.feature as cf
+from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+
+from termcolor import colored
+
+import profiling
+from reader import TensorReader
+from render import set_data_dir, get_basemap, get_coords_extent
+
+# days read at once from the tensor
+BLOCK_DAYS = 64
+
+def set_parser():
+    """ set custom parser """
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("-c", "--city", type=str, required=True,
+                        help="City of the product")
+    parser.add_argument("-p", "--product", type=str, required=True,
+                        help="Product to animate")
+    parser.add_argument("-f", "--folder", type=str, required=False, default='../data/final_tensors',
+                        help="Folder with the final tensors of join_by_time.py")
+    parser.add_argument("-o", "--output", type=str, required=False, default=None,
+                        help="animation file (.mp4 or .gif)")
+    parser.add_argument("--frames", type=str, required=False, default=None,
+                        help="folder to save a PNG of each day")
+    parser.add_argument("--start", type=str, required=False, default=None,
+                        help="first day (yyyy-mm-dd), the first saved day by default")
+    parser.add_argument("--end", type=str, required=False, default=None,
+                        help="last day (excluded), after the last saved day by default")
+    parser.add_argument("--fps", type=int, required=False, default=8,
+                        help="frames per second of the animation")
+    parser.add_argument("--dpi", type=int, required=False, default=100,
+                        help="resolution of the frames")
+    parser.add_argument("--cache", type=str, required=False, default='../data/basemaps',
+                        help="folder of the cached basemaps of each city")
+    parser.add_argument("--data_dir", type=str, required=False, default='../data/cartopy',
+                        help="folder of the Natural Earth shapefiles (downloaded there if missing)")
+    parser.add_argument("--profile", type=str, required=False, default=None, nargs='?', const='profile.jsonl',
+                        help="write the time and memory of each stage to a JSON lines file (profile.jsonl by default)")
+
+    return parser
+
+def get_color_range(reader, days, percentiles=(2, 98)):
+    """ color range shared by all frames, from the percentiles of each block of days """
+    low, high = np.inf, -np.inf
+    for k in range(days.start, days.stop, BLOCK_DAYS):
+        values = reader.read(slice(k, min(k+BLOCK_DAYS, days.stop)))
+        if np.isfinite(values).any():
+            block_low, block_high = np.nanpercentile(values, percentiles)
+            low, high = min(low, block_low), max(high, block_high)
+
+    return (low, high) if np.isfinite(low) else (None, None)
+
+def setup_figure(reader, basemap, vmin, vmax, product):
+    """ figure with the background and an empty pcolormesh of the grid """
+    fig = plt.figure(figsize=(18, 6))
+    ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
+    ax.gridlines()
+
+    # land under the data, provinces over it (as render.plot_map)
+    ax.add_geometries(basemap['land'], ccrs.PlateCarree(), facecolor=cf.COLORS['land'], edgecolor='black', zorder=0)
+    empty = np.full((len(reader.latitude), len(reader.longitude)), np.nan)
+    mesh = ax.pcolormesh(reader.longitude, reader.latitude, np.ma.masked_invalid(empty), shading='nearest',
+                         cmap='magma_r', vmin=vmin, vmax=vmax, transform=ccrs.PlateCarree(), zorder=1)
+    fig.colorbar(mesh, ax=ax, label=product)
+    ax.add_geometries(basemap['provinces'], ccrs.PlateCarree(), facecolor='none', edgecolor='black',
+                      linewidth=0.4, zorder=2)
+
+    gl = ax.gridlines(draw_labels=True, linewidth=1, color='gray', alpha=0.3, linestyle=':')
+    gl.xlabels_top = False
+    gl.ylabels_right = False
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+
+    return fig, ax, mesh
+
+def get_writer(fname, fps):
+    """ matplotlib writer of the animation: ffmpeg streams the frames to the encoder
+        (mp4 or gif), Pillow (gif, only if ffmpeg is missing) keeps them until the end
+    """
+    if animation.FFMpegWriter.isAvailable():
+        return animation.FFMpegWriter(fps=fps)
+    if fname.endswith('.gif'):
+        print(colored("ffmpeg not found, the GIF frames are kept in memory by Pillow", 'red'))
+        return animation.PillowWriter(fps=fps)
+    raise Exception('ffmpeg is needed to write {}'.format(fname))
+
+def export_frames(path, city, product, output=None, frames=None, start=None, end=None, fps=8, dpi=100,
+                  cache='../data/basemaps'):
+    """ draw the daily maps from 'start' to 'end' (excluded) once each, saving
+        every frame in the folder 'frames' and/or the animation 'output'.
+        Returns the number of frames
+    """
+    if output is None and frames is None:
+        raise Exception('give an animation file and/or a folder for the frames')
+
+    with TensorReader(path, product) as reader:
+        days = reader.get_time_slice(start, end)
+        if days.stop <= days.start:
+            print(colored(f"no days of {product} between {start} and {end}", 'red'))
+            return 0
+
+        vmin, vmax = get_color_range(reader, days)
+        basemap = get_basemap(city, get_coords_extent(reader.longitude, reader.latitude), cache)
+        fig, ax, mesh = setup_figure(reader, basemap, vmin, vmax, product)
+
+        if frames is not None:
+            os.makedirs(frames, exist_ok=True)
+        writer = get_writer(output, fps) if output is not None else None
+
+        start_time = time.perf_counter()
+        with (writer.saving(fig, output, dpi) if writer is not None else nullcontext()):
+            for k in range(days.start, days.stop, BLOCK_DAYS):
+                block = reader.read(slice(k, min(k+BLOCK_DAYS, days.stop)))
+                for day, values in zip(reader.time[k:k+len(block)], block):
+                    # only the data layer changes: (longitude, latitude) -> (latitude, longitude)
+                    mesh.set_array(np.ma.masked_invalid(values.T).ravel())
+                    ax.set_title(f'{city} {product} {day}')
+                    if frames is not None:
+                        fig.savefig(os.path.join(frames, f'{product}_{day}.png'), dpi=dpi)
+                    if writer is not None:
+                        writer.grab_frame()
+        plt.close(fig)
+
+    n_frames = days.stop - days.start
+    seconds = time.perf_counter() - start_time
+    print(colored(f"{n_frames} frames drawn in {seconds:.1f} s ({seconds/n_frames:.3f} s per frame)", 'green'))
+    for name in [output, frames]:
+        if name is not None:
+            print(colored(f"saved in: {name}", 'green'))
+
+    return n_frames
+
+def main():
+    parser = set_parser()
+    options = parser.parse_args()
+
+    if options.profile is not None:
+        profiling.enable(options.profile)
+    set_data_dir(options.data_dir)
+
+    path = os.path.join(options.folder, options.city, '')
+    with profiling.stage('export_frames', options.product):
+        export_frames(path, options.city, options.product, options.output, options.frames,
+                      options.start, options.end, options.fps, options.dpi, options.cache)
+
+    profiling.print_summary()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+""" Read benchmark of the chunk layouts and compression of the saved tensors
+    (see CHUNK_LAYOUTS in store.py).
+
+    A tensor (time, longitude, latitude), taken from a '{product}_data.h5' file
+    or synthetic, is written with each layout, with and without compression,
+    and two access patterns are timed on each file:
+        day: read the map of random days, data[t]
+        series: read the time series of random pixels, data[:, i, j]
+
+    python benchmark_tensors.py -i ../data/final_tensors/Moscow/L2__NO2____data.h5
+    python benchmark_tensors.py --shape 365,120,90
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+import h5py
+
+from termcolor import colored
+
+from store import CHUNK_LAYOUTS, get_tensor_options, create_resizable
+from join_by_time import read_h5
+
+def set_parser():
+    """ set custom parser """
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("-i", "--input", type=str, required=False, default=None,
+                        help="'{product}_data.h5' file to take the tensor from (synthetic if not given)")
+    parser.add_argument("--shape", type=str, required=False, default='365,120,90',
+                        help="time,longitude,latitude of the synthetic tensor")
+    parser.add_argument("-z", "--compress", type=int, required=False, default=4,
+                        help="gzip level of the compressed files")
+    parser.add_argument("-n", "--n_reads", type=int, required=False, default=50,
+                        help="number of days and of pixel series read in each file")
+    parser.add_argument("-f", "--folder", type=str, required=False, default=None,
+                        help="folder of the temporary files (system temporary folder by default)")
+
+    return parser
+
+def synthetic_tensor(shape, seed=0):
+    """ smooth daily maps with noise and ~30% of missing (NaN) pixels, like the L3 grids """
+    rng = np.random.default_rng(seed)
+    n_time, n_lon, n_lat = shape
+    lon, lat = np.meshgrid(np.linspace(0, 3, n_lon), np.linspace(0, 3, n_lat), indexing='ij')
+    field = 1e-4*(1 + np.sin(lon)*np.cos(lat))
+    tensor = field[np.newaxis]*(1 + 0.3*rng.standard_normal((n_time, 1, 1))) +\
+             1e-6*rng.standard_normal(shape)
+    tensor[rng.random(shape) < 0.3] = np.nan
+
+    return tensor
+
+def time_reads(fname, key, days, pixels):
+    """ seconds to read the maps of 'days' and the time series of 'pixels' """
+    with h5py.File(fname, 'r') as hf:
+        data = hf[key]
+        start = time.perf_counter()
+        for t in days:
+            data[t]
+        t_day = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i, j in pixels:
+            data[:, i, j]
+        t_series = time.perf_counter() - start
+
+    return t_day, t_series
+
+def benchmark(tensor, complevel=4, n_reads=50, folder=None, seed=0):
+    """ DataFrame with the size, write and read times of each layout and compression """
+    rng = np.random.default_rng(seed)
+    days = rng.integers(0, tensor.shape[0], n_reads)
+    pixels = list(zip(rng.integers(0, tensor.shape[1], n_reads), rng.integers(0, tensor.shape[2], n_reads)))
+
+    rows = []
+    with tempfile.TemporaryDirectory(dir=folder) as tmp:
+        for layout in CHUNK_LAYOUTS:
+            for level in sorted({0, complevel}):
+                options = get_tensor_options(layout, level)
+                fname = os.path.join(tmp, f'{layout}_{level}.h5')
+
+                start = time.perf_counter()
+                with h5py.File(fname, 'w') as hf:
+                    chunks = create_resizable(hf, 'data', tensor, options=options).chunks
+                t_write = time.perf_counter() - start
+
+                t_day, t_series = time_reads(fname, 'data', days, pixels)
+                rows.append({'layout': layout, 'gzip': level, 'chunks': chunks,
+                             'size_MB': os.path.getsize(fname)/1e6, 'write_s': t_write,
+                             'day_ms': 1e3*t_day/n_reads, 'series_ms': 1e3*t_series/n_reads})
+
+    return pd.DataFrame(rows)
+
+def main():
+    parser = set_parser()
+    options = parser.parse_args()
+
+    if options.input is not None:
+        tensor = read_h5(options.input)
+    else:
+        tensor = synthetic_tensor(tuple(int(n) for n in options.shape.split(',')))
+    print(colored(f"tensor of shape {tensor.shape} ({tensor.nbytes/1e6:.1f} MB in memory)", 'blue'))
+
+    df = benchmark(tensor, options.compress, options.n_reads, options.folder)
+    print(df.round(3).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+""" NumPy version of harp's 'bin_spatial' operation: L2 pixels (given by their
+    corner coordinates 'latitude_bounds'/'longitude_bounds') are averaged into
+    a regular latitude/longitude grid.
+
+    The grid is defined as in harp, by the number of edges, the offset of the
+    first edge and the step in degrees, for both latitude and longitude:
+        bin_spatial(lat_edges, lat_offset, lat_step, lon_edges, lon_offset, lon_step)
+    gives a grid of (lat_edges-1, lon_edges-1) cells.
+
+    Two ways of accumulating the pixels are available:
+        'area': each pixel contributes to all cells it overlaps, weighted by the
+                overlapping area (the pixel polygon is clipped with each cell)
+        'center': each pixel contributes only to the cell containing its center
+"""
+
+import numpy as np
+
+def grid_edges(n_edges, offset, step):
+    """ coordinates of the 'n_edges' edges of a regular grid """
+    return offset + step*np.arange(n_edges)
+
+def get_cell_bounds(n_edges, offset, step):
+    """ (n_edges-1, 2) array with the [lower, upper] edge of each cell """
+    edges = grid_edges(n_edges, offset, step)
+    return np.stack([edges[:-1], edges[1:]], axis=-1)
+
+def get_cell_index(coords, n_edges, offset, step):
+    """ index of the cell containing each coordinate, -1 if it is outside the grid """
+    idx = np.floor((coords - offset)/step)
+    idx[~np.isfinite(idx) | (idx < 0) | (idx >= n_edges-1)] = -1
+    return idx.astype(np.int64)
+
+def get_overlapping_cells(lat_bounds, lon_bounds, lat_grid, lon_grid):
+    """ all (pixel, lat cell, lon cell) pairs where the extent of a pixel overlaps a cell.
+        'lat_grid'/'lon_grid' are (n_edges, offset, step) tuples
+    """
+    def cell_range(bounds, n_edges, offset, step):
+        first = np.floor((np.min(bounds, axis=-1) - offset)/step)
+        last = np.ceil((np.max(bounds, axis=-1) - offset)/step) - 1
+        first, last = np.clip(first, 0, None), np.clip(last, None, n_edges-2)
+        n_cells = np.where(np.isfinite(first) & np.isfinite(last), last - first + 1, 0)
+        return np.nan_to_num(first).astype(np.int64), np.clip(n_cells, 0, None).astype(np.int64)
+
+    lat_first, n_lat = cell_range(lat_bounds, *lat_grid)
+    lon_first, n_lon = cell_range(lon_bounds, *lon_grid)
+
+    # expand each pixel into the n_lat*n_lon cells of its extent
+    n_pairs = n_lat*n_lon
+    pixel = np.repeat(np.arange(len(n_pairs)), n_pairs)
+    local = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    cell_lat = lat_first[pixel] + local//n_lon[pixel]
+    cell_lon = lon_first[pixel] + local%n_lon[pixel]
+
+    return pixel, cell_lat, cell_lon
+
+def clip_polygons(poly, n_vertices, axis, bound, keep_above):
+    """ one step of Sutherland-Hodgman: clip all polygons with the half plane
+        poly[..., axis] >= bound (or <= bound if not 'keep_above').
+        'poly' is a (n_polygons, max_vertices, 2) array, only the first
+        'n_vertices' of each polygon are used, 'bound' has one value per polygon
+    """
+    n_poly, max_vertices, _ = poly.shape
+    k = np.arange(max_vertices)[np.newaxis, :]
+    is_vertex = k < n_vertices[:, np.newaxis]
+    bound = np.asarray(bound)[:, np.newaxis]
+
+    # next vertex of each polygon (closing the polygon)
+    nxt = (k + 1) % np.maximum(n_vertices[:, np.newaxis], 1)
+    poly_next = np.take_along_axis(poly, nxt[..., np.newaxis].repeat(2, axis=-1), axis=1)
+
+    dist = poly[..., axis] - bound
+    dist_next = poly_next[..., axis] - bound
+    if not keep_above:
+        dist, dist_next = -dist, -dist_next
+    inside, inside_next = dist >= 0, dist_next >= 0
+
+    # intersection of each edge with the clipping line
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(inside != inside_next, dist/(dist - dist_next), 0)
+    crossing = poly + t[..., np.newaxis]*(poly_next - poly)
+
+    # each edge emits its first vertex if inside and the crossing point if it crosses the line
+    candidates = np.stack([poly, crossing], axis=2).reshape(n_poly, 2*max_vertices, 2)
+    emit = np.stack([is_vertex & inside, is_vertex & (inside != inside_next)], axis=2).reshape(n_poly, 2*max_vertices)
+
+    # move emitted vertices to the front keeping their order
+    order = np.argsort(~emit, axis=1, kind='stable')
+    clipped = np.take_along_axis(candidates, order[..., np.newaxis].repeat(2, axis=-1), axis=1)
+    n_clipped = emit.sum(axis=1)
+
+    return clipped[:, :max(int(n_clipped.max(initial=0)), 1)], n_clipped
+
+def polygon_area(poly, n_vertices):
+    """ area of the polygons (shoelace formula), in squared degrees """
+    n_poly, max_vertices, _ = poly.shape
+    k = np.arange(max_vertices)[np.newaxis, :]
+    is_vertex = k < n_vertices[:, np.newaxis]
+    nxt = (k + 1) % np.maximum(n_vertices[:, np.newaxis], 1)
+    poly_next = np.take_along_axis(poly, nxt[..., np.newaxis].repeat(2, axis=-1), axis=1)
+
+    cross = poly[..., 0]*poly_next[..., 1] - poly_next[..., 0]*poly[..., 1]
+    return 0.5*np.abs(np.sum(np.where(is_vertex, cross, 0), axis=1))
+
+def get_overlap_area(lat_bounds, lon_bounds, pixel, cell_lat, cell_lon, lat_grid, lon_grid):
+    """ area of the intersection between each pixel polygon and its paired cell """
+    lat_cells, lon_cells = get_cell_bounds(*lat_grid), get_cell_bounds(*lon_grid)
+
+    # pixel polygons as (lon, lat) vertices
+    poly = np.stack([lon_bounds[pixel], lat_bounds[pixel]], axis=-1)
+    n_vertices = np.full(len(pixel), poly.shape[1])
+
+    for axis, cells, index in [(0, lon_cells, cell_lon), (1, lat_cells, cell_lat)]:
+        poly, n_vertices = clip_polygons(poly, n_vertices, axis, cells[index, 0], keep_above=True)
+        poly, n_vertices = clip_polygons(poly, n_vertices, axis, cells[index, 1], keep_above=False)
+
+    return polygon_area(poly, n_vertices)
+
+def bin_spatial(values, lat_grid, lon_grid, latitude_bounds=None, longitude_bounds=None,
+                latitude=None, longitude=None, method='area'):
+    """ average the pixel 'values' (dict {name: (n_pixels,) array}) into the grid
+        defined by 'lat_grid' and 'lon_grid' = (n_edges, offset, step).
+
+        method 'area' needs 'latitude_bounds'/'longitude_bounds' (n_pixels, n_corners)
+        method 'center' needs 'latitude'/'longitude' (n_pixels,)
+
+        returns a dict {name: (n_lat, n_lon) array} with NaN where no valid pixel
+        falls, plus 'count' (number of pixels falling in each cell)
+    """
+    shape = (lat_grid[0]-1, lon_grid[0]-1)
+
+    if method == 'area':
+        latitude_bounds = np.asarray(latitude_bounds, dtype=float)
+        longitude_bounds = np.asarray(longitude_bounds, dtype=float)
+        pixel, cell_lat, cell_lon = get_overlapping_cells(latitude_bounds, longitude_bounds, lat_grid, lon_grid)
+        weight = get_overlap_area(latitude_bounds, longitude_bounds, pixel, cell_lat, cell_lon, lat_grid, lon_grid)
+        keep = weight > 0
+        pixel, cell_lat, cell_lon, weight = pixel[keep], cell_lat[keep], cell_lon[keep], weight[keep]
+    elif method == 'center':
+        cell_lat = get_cell_index(np.asarray(latitude, dtype=float), *lat_grid)
+        cell_lon = get_cell_index(np.asarray(longitude, dtype=float), *lon_grid)
+        pixel = np.flatnonzero((cell_lat >= 0) & (cell_lon >= 0))
+        cell_lat, cell_lon = cell_lat[pixel], cell_lon[pixel]
+        weight = np.ones(len(pixel))
+    else:
+        raise Exception('binning method {} is not defined'.format(method))
+
+    cell = np.ravel_multi_index((cell_lat, cell_lon), shape)
+    n_cells = shape[0]*shape[1]
+
+    grids = {'count': np.bincount(cell, minlength=n_cells).reshape(shape)}
+    for name, pixel_values in values.items():
+        v = np.asarray(pixel_values, dtype=float)[pixel]
+        valid = ~np.isnan(v)
+        weight_sum = np.bincount(cell[valid], weights=weight[valid], minlength=n_cells)
+        value_sum = np.bincount(cell[valid], weights=weight[valid]*v[valid], minlength=n_cells)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            grids[name] = np.where(weight_sum > 0, value_sum/weight_sum, np.nan).reshape(shape)
+
+    return grids
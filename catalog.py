@@ -0,0 +1,136 @@
+""" Orbit catalog (SQLite) shared by download.py, mk_raster.py and join_by_time.py
+
+    One row per (city, product, orbit file) with its time coverage, orbit
+    number and processor version (parsed from the S5P file name), the download
+    status, the gridding outcome of mk_raster and the path of the L3 file.
+    Each stage updates the rows it touches, so the others can query, e.g.,
+    all gridded NO2 orbits of Berlin in March:
+
+        catalog = Catalog('../data/catalog.db')
+        rows = catalog.query('Berlin', 'L2__NO2___', start='2019-03-01', end='2019-04-01', grid_status='ok')
+"""
+
+import os
+import re
+import sqlite3
+from datetime import datetime, timezone
+
+# S5P file names: MMM_CCCC_TTTTTTTTTT_yyyymmddThhmmss_YYYYMMDDTHHMMSS_ooooo_cc_vvvvvv_yyyymmddThhmmss
+# (mission, class, product, start, stop, orbit, collection, processor version, production time)
+S5P_NAME = re.compile(r'^S5P_(?P<file_class>\w{4})_(?P<product>.{10})_(?P<start>\d{8}T\d{6})_(?P<stop>\d{8}T\d{6})_'
+                      r'(?P<orbit>\d{5})_(?P<collection>\d{2})_(?P<processor_version>\d{6})_(?P<production>\d{8}T\d{6})')
+
+COLUMNS = ['city', 'product', 'name', 'path', 'time_start', 'time_end', 'orbit', 'processor_version',
+           'download_status', 'grid_status', 'l3_path', 'updated']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orbits (
+    city TEXT NOT NULL,
+    product TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT,
+    time_start TEXT,
+    time_end TEXT,
+    orbit INTEGER,
+    processor_version TEXT,
+    download_status TEXT,
+    grid_status TEXT,
+    l3_path TEXT,
+    updated TEXT,
+    PRIMARY KEY (city, product, name)
+);
+CREATE INDEX IF NOT EXISTS orbits_by_time ON orbits (city, product, time_start);
+CREATE INDEX IF NOT EXISTS orbits_by_grid ON orbits (city, product, grid_status, time_start);
+"""
+
+def parse_s5p_name(fname):
+    """ time coverage, orbit and processor version from a S5P file name, None if it doesn't parse """
+    match = S5P_NAME.match(fname.split('/')[-1])
+    if match is None:
+        return None
+
+    to_iso = lambda t: f'{t[:4]}-{t[4:6]}-{t[6:8]}T{t[9:11]}:{t[11:13]}:{t[13:15]}Z'
+    return {'time_coverage_start': to_iso(match['start']), 'time_coverage_end': to_iso(match['stop']),
+            'orbit': int(match['orbit']), 'collection': match['collection'],
+            'processor_version': match['processor_version'], 'production_time': to_iso(match['production'])}
+
+def get_orbit_name(fname):
+    """ name of the orbit without folder and extensions ('.zip', '.nc', '.zip.incomplete') """
+    return fname.split('/')[-1].split('.')[0]
+
+class Catalog:
+    """ SQLite catalog of orbits, see the module docstring """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        # readers don't block the writer (e.g. join_by_time while mk_raster runs)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def upsert(self, city, product, fname, **fields):
+        """ insert or update the row of orbit 'fname' with the given 'fields'
+            (any of COLUMNS), the name fields are filled from the file name.
+            Call 'commit' to write the changes
+        """
+        name = get_orbit_name(fname)
+        parsed = parse_s5p_name(name)
+        if parsed is not None:
+            fields.setdefault('time_start', parsed['time_coverage_start'])
+            fields.setdefault('time_end', parsed['time_coverage_end'])
+            fields.setdefault('orbit', parsed['orbit'])
+            fields.setdefault('processor_version', parsed['processor_version'])
+        fields['updated'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+        unknown = set(fields) - set(COLUMNS)
+        if len(unknown) > 0:
+            raise Exception('unknown catalog columns: {}'.format(unknown))
+
+        columns = ['city', 'product', 'name'] + list(fields)
+        updates = ', '.join(f'{col}=excluded.{col}' for col in fields)
+        self.conn.execute(f"INSERT INTO orbits ({', '.join(columns)}) VALUES ({', '.join('?'*len(columns))}) "
+                          f"ON CONFLICT(city, product, name) DO UPDATE SET {updates}",
+                          [city, product, name] + list(fields.values()))
+
+    def commit(self):
+        self.conn.commit()
+
+    def query(self, city=None, product=None, start=None, end=None, **status):
+        """ rows (as dicts) of the orbits matching the filters, ordered by time.
+            'start'/'end' filter 'time_start' (ISO strings, end excluded),
+            'status' can be download_status=... and/or grid_status=...
+        """
+        unknown = set(status) - {'download_status', 'grid_status'}
+        if len(unknown) > 0:
+            raise Exception('unknown catalog filters: {}'.format(unknown))
+
+        where, args = [], []
+        for col, value in [('city', city), ('product', product)] + sorted(status.items()):
+            if value is not None:
+                where.append(f'{col} = ?')
+                args.append(value)
+        if start is not None:
+            where.append('time_start >= ?')
+            args.append(start)
+        if end is not None:
+            where.append('time_start < ?')
+            args.append(end)
+
+        sql = 'SELECT * FROM orbits' + (' WHERE ' + ' AND '.join(where) if where else '') + ' ORDER BY time_start, name'
+        return [dict(row) for row in self.conn.execute(sql, args)]
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def open_catalog(path):
+    """ Catalog at 'path', None if no path is given (catalog disabled) """
+    if path is None:
+        return None
+
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    return Catalog(path)
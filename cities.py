@@ -0,0 +1,109 @@
+""" Registry of the areas of interest (cities) and their bounding boxes.
+
+    The three cities used so far are defined in 'CITY_BBOX', more can be added
+    (or redefined) from a csv file with the columns:
+        city,min_lat,max_lat,min_lon,max_lon
+    using 'load_cities'.
+
+    'CityIndex' is a uniform grid over the bounding boxes, so finding the
+    cities covered by an orbit only tests the cities registered in the grid
+    cells that the orbit pixels fall in, instead of every registered city.
+"""
+
+import csv
+
+import numpy as np
+
+# min lat, max lat, min lon, max lon
+CITY_BBOX = {
+    'Istanbul': [40.81000, 41.30500, 28.79400, 29.23000],
+    # 'Moscow': [55.50600, 55.94200, 37.35700, 37.85400], #  old
+    'Moscow': [55.50600, 55.94200, 37.35800, 37.85300],   #  real [37.358, 55.506, 37.853, 55.942]
+    'Berlin': [52.35900, 52.85400, 13.18900, 13.62500],
+}
+
+def load_cities(path, registry=CITY_BBOX):
+    """ add the cities of a csv file to the registry, returns their names """
+    names = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            name = row['city'].strip()
+            registry[name] = [float(row[key]) for key in ['min_lat', 'max_lat', 'min_lon', 'max_lon']]
+            names.append(name)
+
+    return names
+
+def get_cities(registry=CITY_BBOX):
+    """ names of all registered cities """
+    return sorted(registry.keys())
+
+def get_city_bbox(city, registry=CITY_BBOX):
+    """ min lat, max lat, min lon, max lon """
+
+    if city not in registry:
+        raise Exception('city {} is not defined'.format(city))
+    city_bbox = registry[city]
+
+    d = {}
+    d['min_lat'] = city_bbox[0]
+    d['max_lat'] = city_bbox[1]
+    d['min_lon'] = city_bbox[2]
+    d['max_lon'] = city_bbox[3]
+
+    return d
+
+def any_point_in_bbox(lat, lon, latlons, margin=0):
+    """ True if any point falls in the bounding box 'latlons' plus 'margin' degrees """
+    inside = (lat >= latlons['min_lat']-margin) & (lat <= latlons['max_lat']+margin) &\
+             (lon >= latlons['min_lon']-margin) & (lon <= latlons['max_lon']+margin)
+
+    return bool(np.any(inside))
+
+class CityIndex:
+    """ uniform grid of 'cell_size' degrees over the city bounding boxes (plus 'margin') """
+
+    def __init__(self, cities, margin=0, cell_size=1., registry=CITY_BBOX):
+        self.margin = margin
+        self.cell_size = cell_size
+        self.bboxes = {city: get_city_bbox(city, registry) for city in cities}
+        self.cells = {}
+        for city, latlons in self.bboxes.items():
+            for cell in self.get_bbox_cells(latlons):
+                self.cells.setdefault(cell, []).append(city)
+
+    def get_bbox_cells(self, latlons):
+        """ grid cells overlapped by a bounding box plus the margin """
+        lat_0, lat_1 = [int(np.floor(v/self.cell_size)) for v in
+                            [latlons['min_lat']-self.margin, latlons['max_lat']+self.margin]]
+        lon_0, lon_1 = [int(np.floor(v/self.cell_size)) for v in
+                            [latlons['min_lon']-self.margin, latlons['max_lon']+self.margin]]
+
+        return [(i, j) for i in range(lat_0, lat_1+1) for j in range(lon_0, lon_1+1)]
+
+    def query_bbox(self, latlons):
+        """ cities whose bounding box (plus margin) intersects 'latlons' """
+        candidates = {city for cell in self.get_bbox_cells(latlons) for city in self.cells.get(cell, [])}
+
+        return sorted(city for city in candidates
+                        if self.bboxes[city]['min_lat']-self.margin <= latlons['max_lat'] and
+                           self.bboxes[city]['max_lat']+self.margin >= latlons['min_lat'] and
+                           self.bboxes[city]['min_lon']-self.margin <= latlons['max_lon'] and
+                           self.bboxes[city]['max_lon']+self.margin >= latlons['min_lon'])
+
+    def query_points(self, lat, lon):
+        """ cities with at least one of the points (e.g. the pixels of an orbit)
+            inside their bounding box plus margin
+        """
+        lat, lon = np.ravel(lat), np.ravel(lon)
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        lat, lon = lat[valid], lon[valid]
+
+        # cities registered in the cells touched by the points
+        cell_lat = np.floor(lat/self.cell_size).astype(np.int64)
+        cell_lon = np.floor(lon/self.cell_size).astype(np.int64)
+        point_cells = set(zip(*np.unique(np.stack([cell_lat, cell_lon]), axis=1).tolist()))
+        candidates = {city for cell in point_cells & self.cells.keys() for city in self.cells[cell]}
+
+        # exact test only for those cities
+        return [city for city in sorted(candidates) 
+                    if any_point_in_bbox(lat, lon, self.bboxes[city], self.margin)]
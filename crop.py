@@ -0,0 +1,130 @@
+""" Crop whole-orbit S5P L2 files to the scanlines over an area of interest.
+
+    An orbit is a strip around the globe, but only a few of its thousands of
+    scanlines cross a city box. 'crop_orbit' copies a file (all groups,
+    dimensions, variables and attributes) with only the scanlines that have a
+    pixel inside the box plus MARGIN degrees, so harp and mk_raster.py read the
+    cropped file as they read the original, and it keeps the original name.
+
+    download.py does it with '--crop' right after each file is downloaded and
+    verified ('crop_on_arrival'), and the whole orbit is then deleted or moved
+    to a cold storage folder. To crop an orbit that is already on disk:
+
+        crop_orbit('S5P_OFFL_L2__NO2____...zip', 'cropped.nc', get_city_bbox('Berlin'))
+"""
+
+import os
+import shutil
+import threading
+
+import numpy as np
+import netCDF4
+
+from termcolor import colored
+
+import profiling
+
+# degrees kept around the box (the same margin as the pixel filter of mk_raster.py)
+MARGIN = 1
+
+SCANLINE = 'scanline'
+
+# the netCDF/HDF5 library is not thread safe: the download threads crop one orbit at a time
+NETCDF_LOCK = threading.Lock()
+
+def get_scanlines(lat, lon, latlons, margin=MARGIN):
+    """ first and last (excluded) scanline with a pixel inside 'latlons' plus 'margin',
+        lat & lon are (time, scanline, ground_pixel) as in the 'PRODUCT' group
+    """
+    inside = (lat >= latlons['min_lat']-margin) & (lat <= latlons['max_lat']+margin) &\
+             (lon >= latlons['min_lon']-margin) & (lon <= latlons['max_lon']+margin)
+    rows = np.flatnonzero(inside.any(axis=tuple(k for k in range(inside.ndim) if k != 1)))
+    if len(rows) == 0:
+        return slice(0, 0)
+
+    return slice(int(rows[0]), int(rows[-1]) + 1)
+
+def copy_group(src, dst, rows):
+    """ copy a group and its subgroups with only the 'rows' of the scanline dimension """
+    dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+    for name, dimension in src.dimensions.items():
+        if name == SCANLINE:
+            size = rows.stop - rows.start
+        else:
+            size = None if dimension.isunlimited() else len(dimension)
+        dst.createDimension(name, size)
+
+    for name, variable in src.variables.items():
+        attributes = {key: variable.getncattr(key) for key in variable.ncattrs()}
+        fill_value = attributes.pop('_FillValue', None)
+        compress = isinstance(variable.datatype, np.dtype)
+        out = dst.createVariable(name, variable.datatype, variable.dimensions, zlib=compress,
+                                 fill_value=fill_value)
+        out.setncatts(attributes)
+
+        # raw values, without masks & scale factors
+        variable.set_auto_maskandscale(False)
+        out.set_auto_maskandscale(False)
+        index = tuple(rows if dimension == SCANLINE else slice(None) for dimension in variable.dimensions)
+        values = variable[index]
+        if np.size(values) > 0:
+            # explicit slices, so unlimited dimensions grow
+            out[tuple(slice(0, n) for n in np.shape(values))] = values
+
+    for name, group in src.groups.items():
+        copy_group(group, dst.createGroup(name), rows)
+
+def crop_orbit(fname, fname_out, latlons, margin=MARGIN):
+    """ write to 'fname_out' the scanlines of the orbit 'fname' over 'latlons' plus 'margin',
+        returns the number of scanlines kept (0 if the orbit misses the box)
+    """
+    with netCDF4.Dataset(fname) as src:
+        product = src.groups['PRODUCT'] if 'PRODUCT' in src.groups else src
+        lat = np.ma.filled(product['latitude'][:].astype(float), np.nan)
+        lon = np.ma.filled(product['longitude'][:].astype(float), np.nan)
+        rows = get_scanlines(lat, lon, latlons, margin)
+
+        with netCDF4.Dataset(fname_out, 'w') as dst:
+            copy_group(src, dst, rows)
+
+    return rows.stop - rows.start
+
+def store_whole_orbit(partial, path, cold_storage=None):
+    """ move the whole orbit 'partial' of 'path' to 'cold_storage' (in its product folder) or delete it """
+    if cold_storage is not None:
+        folder = os.path.join(cold_storage, os.path.basename(os.path.dirname(path)))
+        os.makedirs(folder, exist_ok=True)
+        shutil.move(partial, os.path.join(folder, os.path.basename(path)))
+    else:
+        os.remove(partial)
+
+def crop_on_arrival(job, partial, latlons, margin=MARGIN, cold_storage=None):
+    """ 'on_complete' of downloader.Downloader: crop the verified 'partial' file
+        of a job into its path and move the whole orbit to 'cold_storage' (in
+        its product folder) or delete it. If it can't be cropped it is kept whole.
+        An orbit without scanlines over the box gets no file in its path and
+        its status is 'outside'
+    """
+    cropped = job['path'] + '.crop.incomplete'
+    try:
+        with NETCDF_LOCK, profiling.stage('crop_orbit', job['path']):
+            n_rows = crop_orbit(partial, cropped, latlons, margin)
+    except Exception as e:
+        print(colored(f"{job['path']} could not be cropped, the whole orbit is kept: {e}", 'red'))
+        if os.path.isfile(cropped):
+            os.remove(cropped)
+        os.replace(partial, job['path'])
+        return
+
+    if n_rows == 0:
+        os.remove(cropped)
+        store_whole_orbit(partial, job['path'], cold_storage)
+        print(colored(f"{os.path.basename(job['path'])} has no scanlines over the city box, it is not kept", 'blue'))
+        return 'outside'
+
+    size, size_cropped = os.path.getsize(partial), os.path.getsize(cropped)
+    os.replace(cropped, job['path'])
+    store_whole_orbit(partial, job['path'], cold_storage)
+
+    print(f"{os.path.basename(job['path'])} cropped to {n_rows} scanlines: "
+          f"{size/2**20:.1f} MB -> {size_cropped/2**20:.1f} MB")
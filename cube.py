@@ -0,0 +1,154 @@
+""" Build one (date, product, longitude, latitude) cube with several products
+    of a city, aligned on a common date axis:
+        'union': all the days with data of any product (missing days are NaN)
+        'intersection': only the days with data of every product
+
+    The days of each product are matched to the date axis with searchsorted
+    and the products are copied one at a time, in blocks of BLOCK_DAYS days,
+    so only one block is in memory. The cube file has:
+        cube        (date, product, longitude, latitude) daily means
+        mask        (date, product, longitude, latitude) True where the value is valid
+        time        (date,) days since 1970-01-01
+        products, latitude, longitude
+
+    python cube.py -c Moscow -p L2__NO2___,L2__O3____,L2__CO____ --dates union
+"""
+
+import os
+import argparse
+
+import numpy as np
+import h5py
+
+from termcolor import colored
+
+import profiling
+from reader import TensorReader
+from store import TIME_UNITS, to_days
+
+# days copied at once from each product
+BLOCK_DAYS = 64
+
+DATE_AXES = ['union', 'intersection']
+
+def set_parser():
+    """ set custom parser """
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("-c", "--city", type=str, required=True,
+                        help="City of the products")
+    parser.add_argument("-p", "--products", type=str, required=False, default='all',
+                        help="comma separated products, 'all' for every product saved for the city")
+    parser.add_argument("-f", "--folder", type=str, required=False, default='../data/final_tensors',
+                        help="Folder with the final tensors of join_by_time.py")
+    parser.add_argument("-d", "--dates", type=str, required=False, default='union', choices=DATE_AXES,
+                        help="date axis: 'union' or 'intersection' of the days of the products")
+    parser.add_argument("-o", "--output", type=str, required=False, default=None,
+                        help="cube file ('{folder}/{city}/{city}_cube_{dates}.h5' by default)")
+    parser.add_argument("--profile", type=str, required=False, default=None, nargs='?', const='profile.jsonl',
+                        help="write the time and memory of each stage to a JSON lines file (profile.jsonl by default)")
+
+    return parser
+
+def find_products(path):
+    """ products with tensors (three files or a store) in 'path' """
+    products = set()
+    for name in os.listdir(path):
+        if name.endswith('_data.h5'):
+            products.add(name[:-len('_data.h5')])
+        elif name.endswith('.zarr') or (name.endswith('.h5') and not name.endswith(('_time.h5', '_pyramid.h5', '_overviews.h5'))
+                                                     and '_cube' not in name):
+            products.add(name.rsplit('.', 1)[0])
+
+    return sorted(products)
+
+def get_date_axis(times, dates='union'):
+    """ common date axis of the days of each product """
+    if dates == 'union':
+        return np.unique(np.concatenate(times))
+    elif dates == 'intersection':
+        axis = times[0]
+        for time in times[1:]:
+            axis = np.intersect1d(axis, time)
+        return axis
+    raise Exception('date axis {} is not defined, use one of {}'.format(dates, DATE_AXES))
+
+def match_dates(axis, time):
+    """ position in 'axis' of each day of 'time' and whether it is in 'axis' """
+    position = np.searchsorted(axis, time)
+    found = position < len(axis)
+    found[found] = axis[position[found]] == time[found]
+
+    return position, found
+
+def copy_product(reader, cube, mask, index, axis):
+    """ copy the days of a product in the cube, BLOCK_DAYS at a time """
+    position, found = match_dates(axis, reader.time)
+    days = np.flatnonzero(found)
+
+    for k in range(0, len(reader.time), BLOCK_DAYS):
+        block = days[(days >= k) & (days < k+BLOCK_DAYS)]
+        if len(block) == 0:
+            continue
+        values = reader.read(slice(k, k+BLOCK_DAYS))[block - k]
+        cube[position[block], index] = values
+        mask[position[block], index] = np.isfinite(values)
+
+    return len(days)
+
+def build_cube(path, products, fname, dates='union'):
+    """ write the cube of 'products' saved in 'path' to 'fname', returns its date axis """
+    readers = [TensorReader(path, product) for product in products]
+    try:
+        shapes = {reader.shape[1:] for reader in readers}
+        if len(shapes) > 1:
+            raise Exception('the products have different grids: {}'.format(dict(zip(products, shapes))))
+        grid_shape = shapes.pop()
+
+        axis = get_date_axis([reader.time for reader in readers], dates)
+        print(colored(f"date axis ({dates}): {len(axis)} days, "
+                      f"{', '.join(f'{p}: {len(r.time)}' for p, r in zip(products, readers))}", 'blue'))
+
+        with h5py.File(fname, 'w') as hf:
+            shape = (len(axis), len(products)) + grid_shape
+            chunks = (1, 1) + grid_shape if len(axis) > 0 else None
+            cube = hf.create_dataset('cube', shape=shape, dtype=np.float64, chunks=chunks, fillvalue=np.nan)
+            mask = hf.create_dataset('mask', shape=shape, dtype=bool, chunks=chunks, fillvalue=False)
+            hf.create_dataset('time', data=to_days(axis))
+            hf.create_dataset('products', data=np.asarray(products, dtype=object), dtype=h5py.string_dtype())
+            hf.create_dataset('latitude', data=readers[0].latitude)
+            hf.create_dataset('longitude', data=readers[0].longitude)
+            hf.attrs.update({'dimensions': 'date, product, longitude, latitude', 'time_units': TIME_UNITS,
+                             'dates': dates})
+
+            for index, (product, reader) in enumerate(zip(products, readers)):
+                with profiling.stage('copy_product', product):
+                    n_days = copy_product(reader, cube, mask, index, axis)
+                print(colored(f"{product}: {n_days} days copied", 'green'))
+    finally:
+        for reader in readers:
+            reader.close()
+
+    return axis
+
+def main():
+    parser = set_parser()
+    options = parser.parse_args()
+
+    if options.profile is not None:
+        profiling.enable(options.profile)
+
+    path = os.path.join(options.folder, options.city, '')
+    products = find_products(path) if options.products == 'all' else options.products.split(',')
+    if len(products) == 0:
+        raise Exception('no products saved in {}'.format(path))
+
+    fname = options.output if options.output is not None else f'{path}{options.city}_cube_{options.dates}.h5'
+    with profiling.stage('build_cube'):
+        build_cube(path, products, fname, options.dates)
+    print(colored(f"cube of {len(products)} products saved in: {fname}", 'green'))
+
+    profiling.print_summary()
+
+if __name__ == "__main__":
+    main()
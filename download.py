@@ -1,10 +1,42 @@
+import os
 import argparse
+import hashlib
+from functools import partial
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from pathlib import Path
 import pickle
 
 import numpy as np
+import shapely
+from termcolor import colored
 from sentinelsat import SentinelAPI
 
+import profiling
+from catalog import open_catalog, get_orbit_name
+from downloader import Downloader
+from crop import crop_on_arrival
+import cities as city_registry
+
+API_URL = 'https://s5phub.copernicus.eu/dhus/'
+AUTH = ('s5pguest', 's5pguest')
+
+# files downloaded at the same time (for all products)
+N_CONCURRENT = 4
+
+PROCESSING_MODE = 'Offline'
+
+# listings of former queries, only the days after their last product are queried again
+QUERY_CACHE = '../data/query_cache'
+
+# days before the last cached product that are queried again (for products published late)
+QUERY_OVERLAP = 7
+
+# fraction of the city box an orbit footprint has to cover to be downloaded (0: any overlap)
+MIN_COVERAGE = 0
+
+SIZE_UNITS = {'B': 1, 'KB': 2**10, 'MB': 2**20, 'GB': 2**30, 'TB': 2**40}
+
 def set_parser():
     """ set custom parser """
     
@@ -17,10 +49,30 @@ def set_parser():
                         help="L1B or L2 data")
     parser.add_argument("-q", "--quiet", required=False, default=True, action='store_false',
                         help="don't print status messages to stdout")
+    parser.add_argument("-n", "--concurrent", type=int, required=False, default=N_CONCURRENT,
+                        help="files downloaded at the same time, shared by all products")
+    parser.add_argument("--query_cache", type=str, required=False, default=QUERY_CACHE,
+                        help="folder of the cached hub queries ('none' to always query the whole date range)")
+    parser.add_argument("--refresh", required=False, default=False, action='store_true',
+                        help="query the whole date range again and replace the cached listings")
+    parser.add_argument("--min_coverage", type=float, required=False, default=MIN_COVERAGE,
+                        help="fraction of the city box an orbit has to cover to be downloaded, -1 to download all orbits")
+    parser.add_argument("--crop", required=False, default=False, action='store_true',
+                        help="keep only the scanlines of each orbit over the city box (see crop.py)")
+    parser.add_argument("--cold_storage", type=str, required=False, default=None,
+                        help="with '--crop', folder where the whole orbits are moved (they are deleted by default)")
+    parser.add_argument("--staging", type=float, required=False, default=None,
+                        help="GB of whole orbits on disk at once (being downloaded or cropped), no limit by default")
+    parser.add_argument("--api_url", type=str, required=False, default=API_URL,
+                        help="URL of the hub (e.g. a local stand-in for tests)")
+    parser.add_argument("-db", "--catalog", type=str, required=False, default=None,
+                        help="SQLite orbit catalog (see catalog.py) where the download status of each orbit is recorded")
+    parser.add_argument("--profile", type=str, required=False, default=None, nargs='?', const='profile.jsonl',
+                        help="write the time and memory of each stage to a JSON lines file (profile.jsonl by default)")
 
     return parser
 
-def get_products(api, product, footprint, level, date_range):
+def query_products(api, product, footprint, level, date_range):
         # search by polygon, time, and SciHub query keywords
         products = api.query(footprint,
                             date=(date_range[0], date_range[1]), 
@@ -28,13 +80,52 @@ def get_products(api, product, footprint, level, date_range):
                             platformname='Sentinel-5',
                             producttype=product,
                             processinglevel=level, # L2 or L1B
-                            processingmode='Offline'
+                            processingmode=PROCESSING_MODE
                             )
 
-        # convert to Pandas DataFrame
-        products_df = api.to_dataframe(products)
+        return products
+
+def to_datetime(date):
+    """ datetime of a date of 'date_range' (yyyymmdd or NOW) """
+    return datetime.utcnow() if date == 'NOW' else datetime.strptime(date, '%Y%m%d')
 
-        return products, products_df
+def get_cache_name(cache, product, footprint, level):
+    """ cached listing of the queries of a footprint, product, level & processing mode """
+    key = hashlib.md5(footprint.encode()).hexdigest()[:12]
+    return os.path.join(cache, f'{product}_{level}_{PROCESSING_MODE}_{key}')
+
+def get_products(api, product, footprint, level, date_range, cache=None, refresh=False):
+    """ products of a query and their DataFrame. With a 'cache' folder, the listing 
+        is saved there and the next runs only query the days after its last product 
+        (minus QUERY_OVERLAP days) and add them to it. 'refresh' queries all days again
+    """
+    if cache is None:
+        products = query_products(api, product, footprint, level, date_range)
+    else:
+        os.makedirs(cache, exist_ok=True)
+        name = get_cache_name(cache, product, footprint, level)
+        start, end = to_datetime(date_range[0]), to_datetime(date_range[1])
+        cached = load_obj(name) if os.path.isfile(name + '.pkl') and not refresh else None
+
+        if cached is None or start < cached['start']:
+            cached = {'start': start, 'products': query_products(api, product, footprint, level, (start, end))}
+            print(f"{len(cached['products'])} products found, saved in the query cache: {name}.pkl")
+        else:
+            last = max([info['beginposition'] for info in cached['products'].values()], default=start)
+            since = max(start, last - timedelta(days=QUERY_OVERLAP))
+            new_products = query_products(api, product, footprint, level, (since, end)) if since < end else {}
+            n_new = len(set(new_products) - set(cached['products']))
+            cached['products'].update(new_products)
+            print(f"{len(cached['products'])} products in the query cache, {n_new} new since {since:%Y-%m-%d}")
+        save_obj(cached, name)
+
+        products = OrderedDict((uuid, info) for uuid, info in cached['products'].items()
+                               if start <= info['beginposition'] <= end)
+
+    # convert to Pandas DataFrame
+    products_df = api.to_dataframe(products)
+
+    return products, products_df
 
 def load_obj(name):
     with open(name + '.pkl', 'rb') as f:
@@ -44,14 +135,102 @@ def save_obj(obj, name):
     with open(name + '.pkl', 'wb') as f:
         pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
 
-def prepare_download(city, folder, level='L2', date_range=['20190101', '20191231']):
+def parse_size(size):
+    """ bytes of a size given by the hub (e.g. '452.26 MB') """
+    value, unit = size.split()
+    return float(value)*SIZE_UNITS[unit]
+
+def get_coverage(footprints, latlons):
+    """ fraction of the box 'latlons' covered by each footprint (WKT), all at once """
+    city_box = shapely.box(latlons['min_lon'], latlons['min_lat'], latlons['max_lon'], latlons['max_lat'])
+    geometries = shapely.from_wkt(np.asarray(footprints, dtype=object))
+
+    return shapely.area(shapely.intersection(geometries, city_box))/city_box.area
+
+def filter_coverage(products, products_df, latlons, min_coverage=MIN_COVERAGE):
+    """ split the products of a query in the ones whose footprint covers more than
+        'min_coverage' of the city box and the ones that can't give (enough) pixels
+        to the grid of mk_raster.py, the coverage is added to 'products_df'
+    """
+    if len(products) == 0:
+        return products, {}, 0
+
+    products_df['coverage'] = get_coverage(products_df['footprint'].values, latlons)
+    keep = (products_df['coverage'] > min_coverage).values
+    kept = OrderedDict((uuid, products[uuid]) for uuid in products_df.index[keep])
+    outside = {uuid: products[uuid] for uuid in products_df.index[~keep]}
+    saved = sum(parse_size(size) for size in products_df.loc[~keep, 'size'])
+
+    print(colored(f"{len(outside)}/{len(products)} orbits cover {min_coverage:.0%} or less of the city box "
+                  f"and are not downloaded: {saved/2**30:.2f} GB saved", 'blue'))
+    return kept, outside, saved
+
+def get_staging_bytes(staging):
+    """ bytes of a staging area given in GB (None: no limit) """
+    return None if staging is None else int(staging*2**30)
+
+def get_jobs(api, products, path):
+    """ download jobs (see downloader.py) of the products of a query, with their 
+        url, size & md5 from the hub, and the products that are offline
+    """
+    jobs, offline = {}, {}
+    for uuid in products:
+        info = api.get_product_odata(uuid)
+        job = {'title': info['title'], 'url': info['url'], 'size': info['size'], 'md5': info.get('md5'),
+               'path': os.path.join(path, info['title'] + '.zip')}
+        if info.get('Online', True):
+            jobs[uuid] = job
+        else:
+            offline[uuid] = job
+
+    return jobs, offline
+
+def update_catalog(catalog, city, product, downloaded_prods, retrieval_scheduled, failed_prods, outside_prods=None):
+    """ record the download status of each orbit in the orbit catalog, the orbits 
+        downloaded in a former run (e.g. with a lower MIN_COVERAGE) stay downloaded
+    """
+    if catalog is None:
+        return
+
+    downloaded = {row['name'] for row in catalog.query(city, product, download_status='downloaded')}
+    for status, prods in [('downloaded', downloaded_prods), ('scheduled', retrieval_scheduled), ('failed', failed_prods),
+                          ('outside', outside_prods or {})]:
+        for product_info in prods.values():
+            if status == 'outside' and get_orbit_name(product_info['title']) in downloaded:
+                continue
+            # the path is only known (and written) for the downloaded orbits
+            fields = {'path': product_info.get('path')} if status == 'downloaded' else {}
+            catalog.upsert(city, product, product_info['title'], download_status=status, **fields)
+    catalog.commit()
+
+def get_outside_paths(catalog, city, product, former_logs, path):
+    """ {path: 'outside'} of the orbits of a product that a former run found outside
+        the city box (in the catalog or its download logs), so they are not downloaded again
+    """
+    names = {info['title'] for info in former_logs.get(product, {}).get('outside_prods', {}).values()}
+    if catalog is not None:
+        names |= {row['name'] for row in catalog.query(city, product, download_status='outside')}
+
+    return {os.path.join(path, name + '.zip'): 'outside' for name in names}
+
+def prepare_download(city, folder, level='L2', date_range=['20190101', '20191231'], catalog=None, only=None,
+                     downloader=None, api_url=API_URL, cache=QUERY_CACHE, refresh=False, crop=False, 
+                     cold_storage=None, min_coverage=MIN_COVERAGE):
     """ download products defined in the bellow dict 'products' for the selected 'city'
         fill the dict 'products' from: https://sentinel.esa.int/web/sentinel/technical-guides/sentinel-5p/products-algorithms
+        with 'only' (a list of products) the other products are not downloaded.
+        The files of all products are downloaded at once by 'downloader' (see downloader.py)
+        and the queries are cached in the folder 'cache' (see 'get_products'). 
+        With 'crop' each orbit is cropped to the city box as soon as it is verified and
+        the whole orbit is moved to '{cold_storage}/{city}' or deleted (see crop.py).
+        Orbits covering 'min_coverage' or less of the city box are not downloaded.
+        Returns the logs of each product (downloaded, failed, scheduled & outside orbits)
     """
     print(f"Downloading {level} products of {city} in {folder}")
 
     # set api
-    api = SentinelAPI('s5pguest', 's5pguest', api_url='https://s5phub.copernicus.eu/dhus/')
+    api = SentinelAPI(*AUTH, api_url=api_url)
+    downloader = downloader if downloader is not None else Downloader(N_CONCURRENT, auth=AUTH)
 
     # big polys with cities inside
     polys = {'Moscow': "POLYGON((34.61091247331172 54.068784458219056,40.70616344210223 54.068784458219056,40.70616344210223 57.347572592132536,34.61091247331172 57.347572592132536,34.61091247331172 54.068784458219056))", # 1070
@@ -93,7 +272,13 @@ def prepare_download(city, folder, level='L2', date_range=['20190101', '20191231
     #date_range=['20191229', '20191231']
     #products = {'L2__O3____': ['L2__O3____', 'Ozone (O3) total column', 'PRF-O3-NRTI, PRF-03-OFFL, PUM-O3, ATBD-O3, IODD-UPAS']}
 
-    logs = {}
+    if only is not None:
+        products = {product: products[product] for product in only}
+
+    logs, all_jobs, skip = {}, {}, {}
+    logs_name = folder+"/{}_logs".format(city if only is None else '_'.join([city] + list(only)))
+    former_logs = load_obj(logs_name) if os.path.isfile(logs_name+'.pkl') else {}
+    latlons = city_registry.get_city_bbox(city)
 
     footprint = polys[city]
     for product in products.keys():
@@ -105,17 +290,54 @@ def prepare_download(city, folder, level='L2', date_range=['20190101', '20191231
         Path(path).mkdir(parents=True, exist_ok=True)
 
         # get links for a product & save them
-        products, products_df = get_products(api, product, footprint, level, date_range)
+        with profiling.stage('api.query', product):
+            products, products_df = get_products(api, product, footprint, level, date_range, cache, refresh)
+
+        # skip the orbits that (almost) miss the city box
+        products, logs[product]['outside_prods'], logs[product]['saved_bytes'] = \
+            filter_coverage(products, products_df, latlons, min_coverage)
         products_df.to_csv(folder+"/{}_{}.csv".format(city, product))
-        
-        # download data from linkss
-        downloaded_prods, retrieval_scheduled, failed_prods = api.download_all(products, directory_path=path, n_concurrent_dl=4)
-        logs[product]['downloaded_prods'] = downloaded_prods
-        logs[product]['retrieval_scheduled'] = retrieval_scheduled
-        logs[product]['failed_prods'] = failed_prods
 
-    save_obj(logs, folder+"/{}_logs".format(city))
+        # url, size & checksum of each file
+        with profiling.stage('api.get_product_odata', product):
+            jobs, logs[product]['retrieval_scheduled'] = get_jobs(api, products, path)
+        all_jobs.update({uuid: dict(job, product=product) for uuid, job in jobs.items()})
+        if crop:
+            # the orbits that a former crop found outside the city box leave no file
+            skip.update(get_outside_paths(catalog, city, product, former_logs, path))
+
+    # download the files of all products with the same budget of concurrent downloads
+    on_complete = None
+    if crop:
+        on_complete = partial(crop_on_arrival, latlons=latlons,
+                              cold_storage=None if cold_storage is None else os.path.join(cold_storage, city))
+    with profiling.stage('downloader.download_all'):
+        downloaded, failed = downloader.download_all(list(all_jobs.values()), on_complete, skip)
+    uuids = {job['path']: uuid for uuid, job in all_jobs.items()}
+    for product in logs.keys():
+        logs[product]['downloaded_prods'] = {uuids[job['path']]: job for job in downloaded 
+                                             if job['product'] == product and job['status'] == 'downloaded'}
+        # orbits without scanlines over the city box (see crop.py)
+        logs[product]['outside_prods'].update({uuids[job['path']]: job for job in downloaded 
+                                               if job['product'] == product and job['status'] == 'outside'})
+        logs[product]['failed_prods'] = {uuids[job['path']]: job for job in failed if job['product'] == product}
+        update_catalog(catalog, city, product, logs[product]['downloaded_prods'], 
+                       logs[product]['retrieval_scheduled'], logs[product]['failed_prods'],
+                       logs[product]['outside_prods'])
+
+    n_outside = sum(len(log['outside_prods']) for log in logs.values())
+    n_cropped_out = sum(job['status'] == 'outside' for job in downloaded)
+    if n_cropped_out > 0:
+        print(colored(f"{n_cropped_out} orbits have no scanlines over the city box and are not kept", 'blue'))
+        n_outside -= n_cropped_out
+    saved = sum(log['saved_bytes'] for log in logs.values())
+    print(colored(f"coverage filter: {n_outside} orbits not downloaded, {saved/2**30:.2f} GB saved", 'blue'))
+
+    # one log per product when they are downloaded separately (see pipeline.py)
+    save_obj(logs, logs_name)
     print(logs)
+
+    return logs
         
 
 def main():
@@ -126,7 +348,17 @@ def main():
     if options.quiet:
         print("Downloading data for city %s in folder %s..." % (options.city, options.folder))
 
-    prepare_download(options.city, options.folder, options.level)
+    if options.profile is not None:
+        profiling.enable(options.profile)
+
+    with profiling.stage('download'):
+        prepare_download(options.city, options.folder, options.level, catalog=open_catalog(options.catalog),
+                         downloader=Downloader(options.concurrent, auth=AUTH, staging=get_staging_bytes(options.staging)),
+                         api_url=options.api_url, cache=None if options.query_cache == 'none' else options.query_cache,
+                         refresh=options.refresh, crop=options.crop, cold_storage=options.cold_storage,
+                         min_coverage=options.min_coverage)
+
+    profiling.print_summary()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,200 @@
+""" Download engine of download.py: concurrent, resumable and verified file transfers.
+
+    A job is a dict with the 'url' of a file, the 'path' to save it and, if
+    known, its 'size' in bytes and 'md5' checksum (the products of the hub
+    have both). Each file is written to '{path}.incomplete' and:
+        - a partial file left by an interrupted run is resumed with an HTTP
+          Range request (started again if the server ignores the range)
+        - when the transfer ends, its size and md5 are checked and only then
+          it is renamed to 'path', so 'path' always is a complete file
+        - failed transfers and checksum errors are retried RETRIES times,
+          waiting BACKOFF, 2*BACKOFF, 4*BACKOFF... seconds
+    All the jobs given to a Downloader share its 'budget' of concurrent
+    transfers, which can also be a semaphore shared by several processes
+    (see pipeline.py), so the budget is global to all cities and products.
+    With 'staging' (bytes) a transfer only starts if the files being downloaded
+    or processed by 'on_complete' (e.g. cropped, see crop.py) fit in it, so a
+    large backlog never fills the disk.
+
+    Only the standard library is used, so any HTTP server can stand in for the
+    hub, e.g. to download two files of a local folder:
+
+        python -m http.server 8000 --directory /tmp/hub
+        Downloader(workers=2).download_all([{'url': 'http://localhost:8000/a.zip', 'path': '/tmp/a.zip'},
+                                            {'url': 'http://localhost:8000/b.zip', 'path': '/tmp/b.zip'}])
+"""
+
+import os
+import time
+import base64
+import hashlib
+import threading
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from termcolor import colored
+
+import profiling
+
+# bytes read at once from the server
+CHUNK_SIZE = 1 << 20
+
+RETRIES = 5
+
+# seconds to wait before the first retry (doubled at each retry)
+BACKOFF = 2
+
+# seconds without data before a transfer is dropped
+TIMEOUT = 60
+
+def get_incomplete_name(path):
+    return path + '.incomplete'
+
+def file_md5(fname):
+    """ md5 of a file, read CHUNK_SIZE bytes at a time """
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+
+    return md5
+
+class Downloader:
+    """ download jobs in 'workers' threads, with at most 'budget' transfers at once
+        (a threading or multiprocessing semaphore, 'workers' if not given)
+    """
+
+    def __init__(self, workers=4, budget=None, auth=None, retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT,
+                 staging=None):
+        self.workers = workers
+        self.budget = budget if budget is not None else threading.BoundedSemaphore(workers)
+        self.staging = staging
+        self.staged = 0
+        self.staging_changed = threading.Condition()
+        self.headers = {}
+        if auth is not None:
+            token = base64.b64encode('{}:{}'.format(*auth).encode()).decode()
+            self.headers['Authorization'] = f'Basic {token}'
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def fetch(self, job):
+        """ one attempt to download a job, from the end of its partial file if any """
+        partial = get_incomplete_name(job['path'])
+        offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+        if job.get('size') is not None and offset >= job['size']:
+            # the former transfer ended but wasn't verified
+            return
+
+        headers = dict(self.headers)
+        if offset > 0:
+            headers['Range'] = f'bytes={offset}-'
+        request = urllib.request.Request(job['url'], headers=headers)
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset > 0:
+                # nothing left after 'offset', the partial file is checked as it is
+                return
+            raise
+
+        with response:
+            # 206: the server resumes from 'offset', 200: it sends the whole file again
+            mode = 'ab' if response.status == 206 else 'wb'
+            with open(partial, mode) as f:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    f.write(chunk)
+
+    def verify(self, job):
+        """ check the size and md5 of the partial file of a job, it is removed if they are wrong
+            (a file shorter than 'size' is kept to be resumed)
+        """
+        partial = get_incomplete_name(job['path'])
+        size = os.path.getsize(partial)
+        if job.get('size') is not None and size < job['size']:
+            # interrupted transfer, kept for the next attempt to resume it
+            raise Exception('transfer of {} stopped at {} of {} bytes'.format(job['path'], size, job['size']))
+        if job.get('size') is not None and size != job['size']:
+            error = 'size of {} is {} instead of {}'.format(job['path'], size, job['size'])
+        elif job.get('md5') is not None and file_md5(partial).hexdigest() != job['md5'].lower():
+            error = 'md5 of {} is not {}'.format(job['path'], job['md5'])
+        else:
+            return
+
+        os.remove(partial)
+        raise Exception(error)
+
+    def reserve(self, size):
+        """ wait until 'size' bytes fit in the staging area (always if it is empty) """
+        with self.staging_changed:
+            while self.staged > 0 and self.staged + size > self.staging:
+                self.staging_changed.wait()
+            self.staged += size
+
+    def release(self, size):
+        with self.staging_changed:
+            self.staged -= size
+            self.staging_changed.notify_all()
+
+    def download(self, job, on_complete=None):
+        """ download a job retrying with backoff, returns the job with its 'status' and 'error'.
+            'on_complete(job, partial)' makes 'path' from the verified file (renamed by default)
+            and can return another status for the job (e.g. 'outside', see crop.py)
+        """
+        if os.path.isfile(job['path']):
+            return {**job, 'status': 'downloaded', 'error': None}
+
+        os.makedirs(os.path.dirname(job['path']) or '.', exist_ok=True)
+        size = (job.get('size') or 0) if self.staging is not None else 0
+        if size > 0:
+            self.reserve(size)
+        try:
+            error = None
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    time.sleep(self.backoff*2**(attempt-1))
+                try:
+                    with self.budget:
+                        with profiling.stage('downloader.fetch', job['path']):
+                            self.fetch(job)
+                    self.verify(job)
+                    status = 'downloaded'
+                    if on_complete is not None:
+                        status = on_complete(job, get_incomplete_name(job['path'])) or status
+                    else:
+                        os.replace(get_incomplete_name(job['path']), job['path'])
+                    return {**job, 'status': status, 'error': None}
+                except Exception as e:
+                    error = f'{type(e).__name__}: {e}'
+                    print(colored(f"attempt {attempt+1}/{self.retries+1} of {job['path']} failed: {error}", 'red'))
+        finally:
+            if size > 0:
+                self.release(size)
+
+        return {**job, 'status': 'failed', 'error': error}
+
+    def download_all(self, jobs, on_complete=None, skip=None):
+        """ download all jobs, returns the downloaded (with the status of 'on_complete') and the failed ones.
+            The jobs whose path is in 'skip' ({path: status}, e.g. orbits that a former crop found
+            outside the city box) and isn't on disk are not queued and keep that status
+        """
+        skip = skip or {}
+        downloaded = [{**job, 'status': skip[job['path']], 'error': None} for job in jobs
+                      if job['path'] in skip and not os.path.isfile(job['path'])]
+        if len(downloaded) > 0:
+            print(colored(f"{len(downloaded)} files are not downloaded again: "
+                          f"{', '.join(sorted(set(job['status'] for job in downloaded)))}", 'blue'))
+        jobs = [job for job in jobs if job['path'] not in skip or os.path.isfile(job['path'])]
+
+        failed = []
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [pool.submit(self.download, job, on_complete) for job in jobs]
+            for i, future in enumerate(as_completed(futures)):
+                result = future.result()
+                (failed if result['status'] == 'failed' else downloaded).append(result)
+                print(f"{i+1}/{len(jobs)}: {result['path']} {result['status']}")
+
+        print(colored(f"{len(downloaded)} files downloaded, {len(failed)} failed", 'green' if len(failed) == 0 else 'red'))
+        return downloaded, failed
@@ -7,6 +7,8 @@ try:
     from os.path import join
     from pathlib import Path
     import pickle
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    from itertools import repeat
 
     import warnings
 
@@ -15,18 +17,17 @@ try:
     import numpy as np
 
     import h5py
+    import netCDF4
 
     from termcolor import colored
 
-    from matplotlib import pyplot as plt
-    import matplotlib.colors as colors
-    import matplotlib.gridspec as gridspec
-    import matplotlib.patches as mpatches
-
-    import cartopy
-    import cartopy.crs as ccrs
-    import cartopy.feature as cf
-    from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+    import profiling
+    from catalog import open_catalog, parse_s5p_name
+    from store import CHUNK_LAYOUTS, STORE_BACKENDS, get_tensor_options, create_resizable, merge_days_into, write_merged,\
+                      get_tensor_names, get_store_name, write_store, read_store_orbits, update_store, from_strings
+    from pyramid import build_pyramid, update_pyramid
+    from overviews import build_overviews, update_overviews
+    import render
 
     print(colored("All modules loaded!\n", 'green'))
 except ModuleNotFoundError:
@@ -78,6 +79,9 @@ warnings.filterwarnings("ignore")
 
 DEBUG = False
 
+# threads reading time attributes of files whose name can't be parsed
+N_THREADS_ATTR = 8
+
 def set_parser():
     """ set custom parser """
     
@@ -94,7 +98,29 @@ def set_parser():
                         help="Folder with L3 processed data")
     parser.add_argument("-f_src", "--folder_src", type=str, required=False, default='../data', 
                         help="Folder with L2 S-5P original data")
-
+    parser.add_argument("-w", "--workers", type=int, required=False, default=1, 
+                        help="number of processes reading the L3 files")
+    parser.add_argument("-db", "--catalog", type=str, required=False, default=None,
+                        help="SQLite orbit catalog (see catalog.py) to take the gridded files from instead of the folders")
+    parser.add_argument("-s", "--store", type=str, required=False, default='files', choices=['files'] + STORE_BACKENDS,
+                        help="'files' saves _data.h5, _time.h5 and .nc, 'hdf5' or 'zarr' a single store (see store.py)")
+    parser.add_argument("--chunks", type=str, required=False, default='day', choices=CHUNK_LAYOUTS,
+                        help="chunk shape of the data and count tensors (see CHUNK_LAYOUTS), 'day' by default")
+    parser.add_argument("-z", "--compress", type=int, required=False, default=0,
+                        help="gzip level (1-9) of the data and count tensors, 0 doesn't compress")
+    parser.add_argument("--no_shuffle", dest='shuffle', required=False, default=True, action='store_false',
+                        help="don't use the HDF5 shuffle filter with '--compress'")
+    parser.add_argument("--no_pyramid", dest='pyramid', required=False, default=True, action='store_false',
+                        help="don't build (or update) the pyramid of weekly, monthly, seasonal and yearly means")
+    parser.add_argument("--overviews", type=int, required=False, default=3,
+                        help="levels of spatial overviews (2x2, 4x4, 8x8... blocks) to save, 0 to skip them")
+    parser.add_argument("-u", "--update", action='store_true',
+                        help="only add the orbits that are not in the saved tensors yet (new days are appended, "
+                             "late orbits are merged into their day)")
+    parser.add_argument("--data_dir", type=str, required=False, default='../data/cartopy',
+                        help="folder of the Natural Earth shapefiles of the plots (downloaded there if missing)")
+    parser.add_argument("--profile", type=str, required=False, default=None, nargs='?', const='profile.jsonl',
+                        help="write the time and memory of each stage to a JSON lines file (profile.jsonl by default)")
 
     return parser
 
@@ -144,37 +170,96 @@ def get_time_attr_old(all_files, verbose=False):
 
     return attributes
 
+def read_time_attr(file_i):
+    """ time atributes of one file, opening it only once """
+    with xr.open_dataset(file_i) as ds:
+        return {'time_coverage_start': ds.attrs['time_coverage_start'], 
+                'time_coverage_end': ds.attrs['time_coverage_end']}
+
+def index_time_attr(all_files, n_threads=N_THREADS_ATTR):
+    """ dict with the time atributes of each file, parsed from its name or,
+        when the name doesn't parse, read from the file in a pool of threads
+    """
+    attributes = {file_i.split('/')[-1]: parse_s5p_name(file_i) for file_i in all_files}
+    to_read = [file_i for file_i in all_files if attributes[file_i.split('/')[-1]] is None]
+
+    if len(to_read) > 0:
+        print(colored(f"reading time attributes of {len(to_read)} files, it can take few minutes...", 'blue'))
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for file_i, attr in zip(to_read, executor.map(read_time_attr, to_read)):
+                attributes[file_i.split('/')[-1]] = attr
+
+    return attributes
+
 def get_time_attr(all_files, path, product, verbose=False):
-    """ this function creates a dict with time atributes for each file if
-        it is not already stored in disk
+    """ this function creates a dict with time atributes for each file, 
+        only the files that are not already stored in disk are indexed
     """
     path_dict = create_folder_to_save(path[:-1], 'dicts')
     path_dict = f'{path_dict}{product}'
 
-    if not os.path.isfile(path_dict+'.pkl'):
-        print(colored("loading time attributes, it can take few minutes...", 'blue'))
-        attributes = {file_i.split('/')[-1]: 
-                        {'time_coverage_start': xr.open_dataset(file_i).attrs['time_coverage_start'],
-                        'time_coverage_end': xr.open_dataset(file_i).attrs['time_coverage_end']
-                        } for file_i in all_files
-                    }
-        # save them
-        save_obj(attributes, path_dict)
-
-    else: 
+    attributes = {}
+    if os.path.isfile(path_dict+'.pkl'):
         print(colored("loading time attributes from memory...", 'blue'))
         attributes = load_obj(path_dict)
 
+    new_files = [file_i for file_i in all_files if file_i.split('/')[-1] not in attributes]
+    if len(new_files) > 0:
+        print(colored(f"indexing time attributes of {len(new_files)} new files...", 'blue'))
+        attributes.update(index_time_attr(new_files))
+        # save them
+        save_obj(attributes, path_dict)
+
     if verbose:
         print('attributes:', attributes)
 
     return attributes
 
-def read_h5(path):
+def get_L3_name(file_i):
+    """ name (without extension) of the L3 file that mk_raster creates from 'file_i' """
+    return file_i.split("/")[-1].replace('L2', 'L3').split('.')[0]
+
+def add_routed_sources(product, folder_src, all_files_L3, all_files):
+    """ L3 files gridded with 'mk_raster.py --route' come from orbits in the folders
+        of other cities: their source files are looked up in the folders of all cities
+    """
+    own_names = {get_L3_name(file_i) for file_i in all_files}
+    missing = {file_i.split('/')[-1].split('.')[0] for file_i in all_files_L3} - own_names
+    if len(missing) == 0:
+        return all_files
+
+    routed = {}
+    for file_i in sorted(iglob(join(folder_src, '*', product, '*.zip'))):
+        if get_L3_name(file_i) in missing:
+            routed.setdefault(get_L3_name(file_i), file_i)
+
+    if len(routed) > 0:
+        print(colored(f"{len(routed)} source files of routed orbits found in the folders of other cities", 'blue'))
+
+    return all_files + sorted(routed.values())
+
+def drop_incomplete(city, product, folder_src, all_files_L3, all_files):
+    """ skip partial downloads ('.zip.incomplete') up front: report them and drop 
+        the L3 files that don't come from a complete source file
+    """
+    incomplete = retrieve_files(city, product, folder_src, '.incomplete', verbose=False)
+    if len(incomplete) > 0:
+        print(colored(f"{len(incomplete)} partial downloads (.incomplete) are skipped: {incomplete}", 'red'))
+
+    complete_names = {get_L3_name(file_i) for file_i in all_files}
+    kept = [file_i for file_i in all_files_L3 if file_i.split('/')[-1].split('.')[0] in complete_names]
+    if len(kept) < len(all_files_L3):
+        print(colored(f"{len(all_files_L3)-len(kept)} L3 files without a complete source file are skipped", 'red'))
+
+    return kept
+
+def read_h5(path, key=None):
     with h5py.File(path, 'r') as hf:
 
-        # get the name of the dataset
-        key = list(hf.keys())[0]
+        # get the name of the dataset (the one named as the file if there are several)
+        if key is None:
+            key = path.split('/')[-1][:-len('.h5')]
+            key = key if key in hf else list(hf.keys())[0]
 
         # access to the dataset and get all data
         data = hf[key][:]
@@ -213,55 +298,103 @@ def get_tensors(no2_L3_DATA_mean):
 
     return tensor, time_values
 
-def save_tensors(path, product, no2_L3_DATA_mean):
-    """ save tensor and its date indexes into h5 files """
+def get_orbit_names(all_files_L3):
+    """ names (without folder & extension) of the orbits of the L3 files """
+    return [file_i.split('/')[-1].split('.')[0] for file_i in all_files_L3]
+
+def save_tensors(path, product, no2_L3_DATA_mean, count=None, orbits=(), options=None):
+    """ save tensor and its date indexes into h5 files. The time axis is unlimited 
+        and the number of orbits averaged in each day and pixel ('count') and the 
+        names of the 'orbits' are saved with the data, so 'update_tensors' can add 
+        new orbits later. 'options' (see 'get_tensor_options') set the chunks and
+        compression of the data and count tensors, the updates keep them
+    """
 
     tensor, time_values = get_tensors(no2_L3_DATA_mean)
+    if count is None:
+        count = np.isfinite(tensor).astype(np.int32)
+    else:
+        count = np.moveaxis(count.values, 1, -1)
 
     # declare names
-    netcdf_name = f'{path}{product}.nc'
-    tensor_name = f'{path}{product}_data.h5'
-    time_name = f'{path}{product}_time.h5'
+    netcdf_name, tensor_name, time_name = get_tensor_names(path, product)
 
     with h5py.File(tensor_name, 'w') as hf:
-        hf.create_dataset(f'{product}_data',  data=tensor)
+        create_resizable(hf, f'{product}_data', tensor, options=options)
+        create_resizable(hf, f'{product}_count', count, options=options)
+        create_resizable(hf, f'{product}_orbits', np.asarray(orbits, dtype=object), dtype=h5py.string_dtype())
 
     with h5py.File(time_name, 'w') as hf:
-        hf.create_dataset(f'{product}_time',  data=time_values)
+        create_resizable(hf, f'{product}_time', time_values)
     
     # save original netcdf file
-    no2_L3_DATA_mean.to_netcdf(netcdf_name)
+    no2_L3_DATA_mean.to_netcdf(netcdf_name, unlimited_dims=['time'])
 
     print(colored(f'data saved in: {tensor_name}', 'green') )
     print(colored(f'time index saved in: {time_name}', 'green'))
     print(colored(f'original netcdf saved in {netcdf_name}', 'green'))
 
-def create_save_plot(img, fname):
-    fig = plt.figure(figsize=(18, 6))
-    ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
-
-    # plot data
-    im = img.plot.pcolormesh(ax=ax, x='longitude', y='latitude',
-                                cmap='magma_r', add_colorbar=True, 
-                                transform=ccrs.PlateCarree(), zorder=1)
-    #ax.set_title('Centered in %s'%folder)
-
-    # add backgorund features
-    #ax.stock_img()
-    ax.gridlines()
-    state_provinces = cf.NaturalEarthFeature(category='cultural', name='admin_1_states_provinces_lines', 
-                                            scale='10m', facecolor='none')
-    ax.add_feature(cartopy.feature.LAND, edgecolor='black')
-    ax.add_feature(state_provinces, linewidth=0.4, edgecolor='black')
-
-    # set axis
-    gl = ax.gridlines(draw_labels=True, linewidth=1, color='gray', alpha=0.3, linestyle=':')
-    gl.xlabels_top = False
-    gl.ylabels_right = False
-    gl.xformatter = LONGITUDE_FORMATTER
-    gl.yformatter = LATITUDE_FORMATTER
-
-    plt.savefig(fname, bbox_inches='tight')
+def read_saved_orbits(path, product):
+    """ names of the orbits in the saved tensors, None if there are no tensors 
+        that can be updated (missing or saved by a former version)
+    """
+    netcdf_name, tensor_name, time_name = get_tensor_names(path, product)
+    if not all(os.path.isfile(name) for name in [netcdf_name, tensor_name, time_name]):
+        return None
+
+    with h5py.File(tensor_name, 'r') as hf:
+        if f'{product}_orbits' not in hf or hf[f'{product}_data'].maxshape[0] is not None:
+            return None
+        return set(name.decode() for name in hf[f'{product}_orbits'][:])
+
+def update_netcdf(netcdf_name, var_of_interest, plan, time_values, day_mean):
+    """ write the merged days of an update in the netcdf file (its time is unlimited),
+        with the plan of 'merge_days_into' so only the changed and moved days are written
+    """
+    with netCDF4.Dataset(netcdf_name, 'a') as nc:
+        time = nc['time']
+        dates = pd.to_datetime([t.decode() for t in time_values]).to_pydatetime()
+        dates = netCDF4.date2num(dates, time.units, getattr(time, 'calendar', 'standard'))
+        # back to (time, latitude, longitude)
+        write_merged(plan, [time, nc[var_of_interest]], [dates, np.moveaxis(day_mean, -1, 1)])
+
+def update_tensors(path, product, new_mean, new_count, new_orbits):
+    """ merge the daily means of new orbits into the saved tensors: days already 
+        saved are averaged again with their counts in place, new days after the
+        last saved day are appended and new days among the saved ones are inserted
+        in their place. Only the changed days (and the saved days after an inserted
+        one) are written, so an update costs the size of the new orbits.
+        Returns the number of days and orbits saved and the changed days 
+        (see store.update_store)
+    """
+    tensor_new, time_new = get_tensors(new_mean)
+    count_new = np.moveaxis(new_count.values, 1, -1)
+
+    netcdf_name, tensor_name, time_name = get_tensor_names(path, product)
+    with h5py.File(tensor_name, 'a') as hf_data, h5py.File(time_name, 'a') as hf_time:
+        # the orbits are recorded with the data: an interrupted update is undone on the next one
+        plan, day_mean, (old_time, old_mean) = merge_days_into(
+            hf_data[f'{product}_data'], hf_data[f'{product}_count'], hf_time[f'{product}_time'], 
+            tensor_new, count_new, time_new, hf_data[f'{product}_orbits'], new_orbits, journal=hf_data)
+
+        n_orbits = len(hf_data[f'{product}_orbits'])
+
+    update_netcdf(netcdf_name, new_mean.name, plan, time_new, day_mean)
+
+    print(colored(f'{len(new_orbits)} orbits merged into {len(time_new)} days '
+                  f'({len(plan["time"])-plan["n_old"]} new), {plan["n_written"]} days written in: {path}', 'green'))
+
+    changes = {'plan': plan, 'old_time': from_strings(old_time), 'old_mean': old_mean,
+               'new_time': from_strings(time_new), 'new_mean': day_mean}
+
+    return len(plan['time']), n_orbits, changes
+
+def create_save_plot(img, fname, city='map', cache='../data/basemaps'):
+    """ plot the image over the land and provinces of its area, which are read
+        once and cached for the next plots of the city (see render.py)
+    """
+    basemap = render.get_basemap(city, render.get_extent(img), cache)
+    render.plot_map(img, fname, basemap)
 
 def save_log(city, product, n_after, n_before, all_files, fname_log):
     # fill log
@@ -277,59 +410,238 @@ def save_log(city, product, n_after, n_before, all_files, fname_log):
         df.to_csv(fname_log, mode='a', header=False)
         print(colored(f'appended log to: {fname_log}'), 'green' )
 
-def process(city, product, folder, folder_src, folder_grid, var_product=VAR_PRODUCT):
-    """ main function to stack grids into 'time' dimension """
+def get_day(time_coverage_start):
+    """ day (datetime64 at 00h) of a time attribute, so the orbits of a day share the label """
+    return pd.to_datetime(time_coverage_start, utc=True).tz_convert(None).floor('1D').to_datetime64()
 
-    #print(xr.show_versions())
-
-    ## 1. get original files to substract time information & create a folder to store final tensors
-    all_files = retrieve_files(city, product, folder_src)
-    path = create_folder_to_save(folder, city)
-
-    ## 2. create time attributes & a function to access them
-    attributes = get_time_attr(all_files, path, product)
+def accumulate_days(all_files_L3, attributes, var_of_interest):
+    """ read the L3 files one at a time keeping only a running NaN-aware sum and
+        count of valid values per day: {day: [sum, count]} & the lat/lon coordinates
+    """
+    days, coords = {}, None
+    for file_i in all_files_L3:
+        with xr.open_dataset(file_i) as ds:
+            source = ds.attrs['source_product'].replace('.incomplete', '')
+            grid = ds[var_of_interest].values
+            grid = grid.reshape((-1,) + grid.shape[-2:])
+            if coords is None:
+                coords = {'latitude': ds['latitude'].values, 'longitude': ds['longitude'].values}
+
+        day = get_day(attributes[source]['time_coverage_start'])
+        if day not in days:
+            days[day] = [np.zeros(grid.shape[-2:]), np.zeros(grid.shape[-2:], dtype=np.int32)]
+        valid = np.isfinite(grid)
+        days[day][0] += np.where(valid, grid, 0).sum(axis=0)
+        days[day][1] += valid.sum(axis=0)
+
+    return days, coords
+
+def merge_days(partials):
+    """ merge the {day: [sum, count]} of several 'accumulate_days' """
+    days, coords = {}, None
+    for part_days, part_coords in partials:
+        coords = part_coords if coords is None else coords
+        for day, (day_sum, day_count) in part_days.items():
+            if day not in days:
+                days[day] = [day_sum, day_count]
+            else:
+                days[day][0] += day_sum
+                days[day][1] += day_count
+
+    return days, coords
+
+def stack_by_day(all_files_L3, attributes, var_of_interest, workers=1):
+    """ average the orbits of each day streaming the L3 files (in 'workers' processes),
+        returns the daily mean (time, latitude, longitude) like a groupby('time').mean()
+        and the number of orbits with a valid value per day and pixel
+    """
+    if workers <= 1 or len(all_files_L3) < 2*workers:
+        days, coords = accumulate_days(all_files_L3, attributes, var_of_interest)
+    else:
+        chunks = [list(chunk) for chunk in np.array_split(all_files_L3, workers)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            days, coords = merge_days(executor.map(accumulate_days, chunks, repeat(attributes), repeat(var_of_interest)))
+
+    time = np.array(sorted(days), dtype='datetime64[ns]')
+    day_sum = np.stack([days[day][0] for day in sorted(days)])
+    day_count = np.stack([days[day][1] for day in sorted(days)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        day_mean = np.where(day_count > 0, day_sum/day_count, np.nan)
+
+    dims = ['time', 'latitude', 'longitude']
+    coords = {'time': time, **coords}
+    mean = xr.DataArray(day_mean, dims=dims, coords=coords, name=var_of_interest)
+    count = xr.DataArray(day_count, dims=dims, coords=coords, name=f'{var_of_interest}_count')
+
+    return mean, count
+
+def stack_by_day_mfdataset(all_files_L3, attributes, var_of_interest):
+    """ former version of 'stack_by_day' (lazy open_mfdataset + groupby mean),
+        kept to compare both results
+    """
     def preprocess(ds, attributes=attributes):
-        ds['time'] = pd.to_datetime(np.array([attributes[ds.attrs['source_product']]['time_coverage_start']])).values
+        source = ds.attrs['source_product'].replace('.incomplete', '')
+        ds['time'] = pd.to_datetime(np.array([attributes[source]['time_coverage_start']])).values
         return ds
 
-    ## 3. load & stack all files over time dimension
-    all_files_L3 = retrieve_files(city, product, folder_grid, '.nc')
     L3_DATA = xr.open_mfdataset(all_files_L3, combine='nested', concat_dim='time', 
                             preprocess=preprocess, chunks={'time': 100})
-
-    ## 4. group the different orbits by day
-     # set all dates to have time at 00h so multiple measurements in a day have the same label
     L3_DATA.coords['time'] = L3_DATA.time.dt.floor('1D')
 
-     # group by 'date' using an average (mean)
-    L3_DATA_mean = L3_DATA.groupby('time').mean()
+    return L3_DATA.groupby('time').mean()[var_of_interest]
+
+def get_catalog_files(catalog, city, product):
+    """ source files, gridded L3 files and their time attributes from the orbit catalog """
+    all_files = [row['path'] for row in catalog.query(city, product) if row['path'] is not None]
+    gridded = catalog.query(city, product, grid_status='ok')
+    all_files_L3 = [row['l3_path'] for row in gridded]
+    attributes = {row['path'].split('/')[-1]: {'time_coverage_start': row['time_start'], 
+                                               'time_coverage_end': row['time_end']} for row in gridded}
+    print(colored(f"catalog: {len(all_files)} orbits, {len(all_files_L3)} gridded", 'green'))
+
+    return all_files, all_files_L3, attributes
+
+def process(city, product, folder, folder_src, folder_grid, var_product=VAR_PRODUCT, catalog=None, workers=1,
+            update=False, tensor_options=None, store='files', pyramid=True, overviews=3, plot=True):
+    """ main function to stack grids into 'time' dimension,
+        with 'update' only the orbits that are not in the saved tensors are added,
+        'tensor_options' (see 'get_tensor_options') set the chunks & compression and
+        'store' the output: 'files' (_data.h5, _time.h5, .nc) or a single 'hdf5'/'zarr' store
+        and 'pyramid' also saves the weekly, monthly, seasonal & yearly means (see pyramid.py)
+        and 'overviews' that number of levels of block averages (see overviews.py).
+        With 'plot' False the summary plot is left to render.py
+    """
+
+    #print(xr.show_versions())
+
+    path = create_folder_to_save(folder, city)
+    if catalog is not None:
+        ## 1-2. one indexed query gives the files and their time attributes
+        all_files, all_files_L3, attributes = get_catalog_files(catalog, city, product)
+    else:
+        ## 1. get original files to substract time information & create a folder to store final tensors
+        all_files = retrieve_files(city, product, folder_src)
+        all_files_L3 = retrieve_files(city, product, folder_grid, '.nc')
+        all_files = add_routed_sources(product, folder_src, all_files_L3, all_files)
+
+        ## 2. create time attributes
+        with profiling.stage('get_time_attr'):
+            attributes = get_time_attr(all_files, path, product)
+
+        all_files_L3 = drop_incomplete(city, product, folder_src, all_files_L3, all_files)
 
-    ## 5. get variable of interest and annual average
     var_of_interest = var_product[product]['keep'].split(',')[0]
-    no2_L3_DATA_mean = L3_DATA_mean[var_of_interest]
+    if update:
+        if store == 'files':
+            saved_orbits = read_saved_orbits(path, product)
+        else:
+            saved_orbits = read_store_orbits(get_store_name(path, product, store))
+        if saved_orbits is None:
+            print(colored("no tensors to update (missing or saved by a former version), stacking all orbits", 'red'))
+        else:
+            update_saved(city, product, folder, path, all_files, all_files_L3, saved_orbits, attributes, 
+                         var_of_interest, workers, store, pyramid, overviews)
+            return
+
+    ## 3-4. stream all files & average the orbits of each day (time at 00h)
+    with profiling.stage('stack_by_day'):
+        no2_L3_DATA_mean, count = stack_by_day(all_files_L3, attributes, var_of_interest, workers)
+
+    ## 5. annual average
     year_mean = no2_L3_DATA_mean.groupby('time.year').mean()[0]
 
     ## 6. get info about aggregation
-    n_before = L3_DATA[var_of_interest].shape[0]
+    n_before = len(all_files_L3)
     n_after = no2_L3_DATA_mean.shape[0]
     print(colored(f"--> There were {n_before} orbits belonging to {n_after} unique days.\n", 'blue'))
 
     ## 7. get and save tensors
-    save_tensors(path, product, no2_L3_DATA_mean)
+    with profiling.stage('save_tensors'):
+        if store == 'files':
+            save_tensors(path, product, no2_L3_DATA_mean, count, get_orbit_names(all_files_L3), tensor_options)
+        else:
+            store_name = get_store_name(path, product, store)
+            write_store(store_name, product, city, no2_L3_DATA_mean, count, get_orbit_names(all_files_L3), tensor_options)
+            print(colored(f'data, counts, time & coordinates saved in: {store_name}', 'green'))
+
+    ## 7b. weekly, monthly, seasonal & yearly aggregates and spatial overviews
+    days = no2_L3_DATA_mean.coords['time'].values.astype('datetime64[D]')
+    if pyramid:
+        with profiling.stage('build_pyramid'):
+            build_pyramid(path, product, days, np.moveaxis(no2_L3_DATA_mean.values, 1, -1))
+    if overviews > 0:
+        with profiling.stage('build_overviews'):
+            build_overviews(path, product, overviews, days, np.moveaxis(no2_L3_DATA_mean.values, 1, -1),
+                            no2_L3_DATA_mean.coords['longitude'].values, no2_L3_DATA_mean.coords['latitude'].values)
 
     ## 8. save a plot
-    name = f'{path}/{city}_{product}.png'
-    create_save_plot(year_mean, name)
+    if plot:
+        name = f'{path}/{city}_{product}.png'
+        with profiling.stage('create_save_plot'):
+            create_save_plot(year_mean, name, city)
 
     ## 9. save a log
     save_log(city, product, n_after, n_before, all_files, f'{folder}/LOG.csv')
 
+def update_saved(city, product, folder, path, all_files, all_files_L3, saved_orbits, attributes, 
+                 var_of_interest, workers=1, store='files', pyramid=True, overviews=3):
+    """ add the orbits that are not in the saved tensors (see 'update_tensors')
+        or store ('update_store'), the plot of the annual average is not redone
+        since it needs all days
+    """
+
+    ## 3. only the orbits that are not saved yet
+    new_files = [file_i for file_i, orbit in zip(all_files_L3, get_orbit_names(all_files_L3)) 
+                    if orbit not in saved_orbits]
+    if len(new_files) == 0:
+        print(colored(f"--> all {len(all_files_L3)} orbits are already saved in: {path}", 'green'))
+        return
+
+    ## 4. stream the new files & average them by day
+    with profiling.stage('stack_by_day'):
+        new_mean, new_count = stack_by_day(new_files, attributes, var_of_interest, workers)
+
+    ## 5. merge them into the saved tensors
+    with profiling.stage('update_tensors'):
+        if store == 'files':
+            n_after, n_before, changes = update_tensors(path, product, new_mean, new_count, get_orbit_names(new_files))
+        else:
+            store_name = get_store_name(path, product, store)
+            n_after, n_before, changes = update_store(store_name, new_mean, new_count, get_orbit_names(new_files))
+            print(colored(f"{len(new_files)} orbits merged into {len(changes['new_time'])} days, "
+                          f"{changes['plan']['n_written']} days written in: {store_name}", 'green'))
+
+    print(colored(f"--> There are {n_before} orbits belonging to {n_after} unique days.\n", 'blue'))
+
+    ## 6. apply the changed days to the pyramid of aggregates and the overviews
+    if pyramid:
+        with profiling.stage('update_pyramid'):
+            update_pyramid(path, product, changes)
+    if overviews > 0:
+        with profiling.stage('update_overviews'):
+            update_overviews(path, product, changes)
+
+    ## 7. save a log
+    save_log(city, product, n_after, n_before, all_files, f'{folder}/LOG.csv')
+
 def main():
     if not DEBUG:
         parser = set_parser()
         options = parser.parse_args()
 
-        process(options.city, options.product, options.folder, options.folder_src, options.folder_grid)
+        if options.profile is not None:
+            profiling.enable(options.profile)
+
+        render.set_data_dir(options.data_dir)
+        catalog = open_catalog(options.catalog)
+        tensor_options = get_tensor_options(options.chunks, options.compress, options.shuffle)
+        with profiling.stage('join_by_time'):
+            process(options.city, options.product, options.folder, options.folder_src, options.folder_grid,
+                    catalog=catalog, workers=options.workers, update=options.update, tensor_options=tensor_options,
+                    store=options.store, pyramid=options.pyramid,
+                    overviews=options.overviews)
+
+        profiling.print_summary()
     else:
         city, product = 'Moscow', 'L2__O3____'
         folder = '../data/final_tensors'
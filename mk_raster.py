@@ -1,14 +1,24 @@
 
 
 try:    
+    import os
     import argparse
     from glob import iglob
     from os.path import join
     from pathlib import Path
     import pickle
+    import time
+    from functools import partial
+    from multiprocessing import Pool
 
     import harp
     import numpy as np
+    import netCDF4
+
+    import binning
+    import profiling
+    from catalog import open_catalog
+    import cities as city_registry
 
     from termcolor import colored
 
@@ -20,6 +30,17 @@ except ModuleNotFoundError:
 DEBUG = False
 N_debug = 10
 
+# degrees added around the city bounding box when filtering the L2 pixels
+BBOX_MARGIN = 1
+
+# with '--workers' > 1, each worker process is replaced after this number of orbits
+# so the memory that harp does not give back to the OS doesn't pile up
+MAX_TASKS_PER_CHILD = 20
+
+# the manifest is saved to disk every 'MANIFEST_SAVE_EVERY' orbits, so an
+# interrupted run keeps most of its progress
+MANIFEST_SAVE_EVERY = 50
+
 # define harp products of each variable:
 # 'keep' first value should be the variable of interest for the product
 # (the one that harp has a _validity parameter)
@@ -70,7 +91,9 @@ def set_parser():
     
     parser = argparse.ArgumentParser(description="")
     parser.add_argument("-c", "--city", type=str, required=True, 
-                        help="City to process the data from [Moscow, Istanbul, Berlin]")
+                        help="City to process the data from [Moscow, Istanbul, Berlin], " + 
+                             "a comma separated list (e.g. Moscow,Berlin) imports each orbit only once for all of them, " +
+                             "'all' uses all cities in the registry")
     parser.add_argument("-p", "--product", type=str, required=True, 
                         help="Product to process [\'L2__O3____\', \'L2__NO2___\', \'L2__SO2___\', \
                         \'L2__CO____\', \'L2__CH4___\', \'L2__HCHO__\', \'L2__CLOUD_\', \
@@ -81,6 +104,30 @@ def set_parser():
                         help="Folder with L2 S-5P data")
     parser.add_argument("-d", "--degrees", type=float, required=False, default=0.01, 
                         help="pixel degrees for the grid")
+    parser.add_argument("-w", "--workers", type=int, required=False, default=1, 
+                        help="number of processes gridding orbits in parallel")
+    parser.add_argument("--cities_file", type=str, required=False, default=None,
+                        help="csv file (city,min_lat,max_lat,min_lon,max_lon) with more cities for the registry")
+    parser.add_argument("--route", required=False, default=False, action='store_true',
+                        help="grid the orbits of all city folders for every city they cover")
+    parser.add_argument("-e", "--engine", type=str, required=False, default='harp', choices=['harp', 'numpy'],
+                        help="grid the pixels with harp's bin_spatial or with the numpy engine in binning.py")
+    parser.add_argument("--binning", type=str, required=False, default='area', choices=['area', 'center'],
+                        help="numpy engine: weight pixels by overlapping area or use only their center")
+    parser.add_argument("-z", "--compress", type=int, required=False, default=0,
+                        help="deflate level (1-9) of the exported L3 netCDF4 files, 0 exports with harp uncompressed")
+    parser.add_argument("--no_shuffle", dest='shuffle', required=False, default=True, action='store_false',
+                        help="don't use the HDF5 shuffle filter with '--compress'")
+    parser.add_argument("--float32", required=False, default=False, action='store_true',
+                        help="store the float64 variables of the L3 files as float32")
+    parser.add_argument("--no_prescreen", dest='prescreen', required=False, default=True, action='store_false',
+                        help="don't check the orbit geolocation before the full harp import")
+    parser.add_argument("--force", required=False, default=False, action='store_true',
+                        help="ignore the manifest and grid again all orbits")
+    parser.add_argument("-db", "--catalog", type=str, required=False, default=None,
+                        help="SQLite orbit catalog (see catalog.py) where the outcome of each orbit is recorded")
+    parser.add_argument("--profile", type=str, required=False, default=None, nargs='?', const='profile.jsonl',
+                        help="write the time and memory of each stage to a JSON lines file (profile.jsonl by default)")
 
     return parser
 
@@ -88,26 +135,13 @@ def save_obj(obj, name):
     with open(name + '.pkl', 'wb') as f:
         pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
 
-def get_city_bbox(city):
-    """ min lat, max lat, min lon, max lon """
-
-    if city == 'Istanbul':
-        city_bbox = [40.81000, 41.30500, 28.79400, 29.23000]
-    elif city == 'Moscow':
-        # city_bbox = [55.50600, 55.94200, 37.35700, 37.85400] #  old 
-        city_bbox = [55.50600, 55.94200, 37.35800, 37.85300]   #  real [37.358, 55.506, 37.853, 55.942]
-    elif city == 'Berlin':
-        city_bbox = [52.35900, 52.85400, 13.18900, 13.62500]
-    else:
-        raise Exception('city {} is not defined'.format(city))
-    
-    d = {}
-    d['min_lat'] = city_bbox[0]
-    d['max_lat'] = city_bbox[1]
-    d['min_lon'] = city_bbox[2]
-    d['max_lon'] = city_bbox[3]
+def load_obj(name):
+    with open(name + '.pkl', 'rb') as f:
+        return pickle.load(f)
 
-    return d
+def get_city_bbox(city):
+    """ min lat, max lat, min lon, max lon (from the city registry in cities.py) """
+    return city_registry.get_city_bbox(city)
 
 def bounding_box_steps(city, degrees, verbose=True):
     """ get the latitude/longitude steps to be done in a given bounding box
@@ -131,6 +165,12 @@ def retrieve_files(city, product, folder_source, verbose=True):
     path_files = join(folder_source, city, product, '*')
     all_files = sorted(list(iglob(path_files, recursive=True)))
 
+    # skip partial downloads
+    incomplete = [one_file for one_file in all_files if one_file.endswith('.incomplete')]
+    all_files = [one_file for one_file in all_files if not one_file.endswith('.incomplete')]
+    if len(incomplete) > 0:
+        print(colored(f"skipping {len(incomplete)} partial downloads (.incomplete)", 'red'))
+
     if verbose:
         print("looking for files at %s"%(path_files))
         print(colored("number of .nc detected: %i"%len(all_files), "green"))
@@ -152,19 +192,27 @@ def create_folder_to_save(folder, city, product):
     
     return path, fail_path
 
+def get_filter_operations(product, latlons, var_product=VAR_PRODUCT):
+    """ harp operations that keep the valid pixels inside 'latlons' (plus BBOX_MARGIN) """
+
+    var_of_interest = var_product[product]['keep'].split(',')[0]
+
+    ops_string = f"{var_of_interest}_validity > {var_product[product]['threshold']}; \
+        derive(datetime_stop {{time}});\
+        latitude >= {latlons['min_lat']-BBOX_MARGIN} [degree_north] ; latitude <= {latlons['max_lat']+BBOX_MARGIN} [degree_north] ;\
+        longitude >= {latlons['min_lon']-BBOX_MARGIN} [degree_east] ; longitude <= {latlons['max_lon']+BBOX_MARGIN} [degree_east];"
+
+    return ops_string
+
 def get_harp_operations(city, product, degrees, verbose=True, 
                         var_product=VAR_PRODUCT, keep_general=KEEP_GENERAL):
     """ get the operations that harp library needs to create the grid """
 
-    # get bounding box params & harp main variable
+    # get bounding box params
     lat_steps, lon_steps, city_latlons = bounding_box_steps(city, degrees)
-    var_of_interest = var_product[product]['keep'].split(',')[0]
 
-    # define harp operations
-    ops_string = f"{var_of_interest}_validity > {var_product[product]['threshold']}; \
-        derive(datetime_stop {{time}});\
-        latitude >= {city_latlons['min_lat']-1} [degree_north] ; latitude <= {city_latlons['max_lat']+1} [degree_north] ;\
-        longitude >= {city_latlons['min_lon']-1} [degree_east] ; longitude <= {city_latlons['max_lon']+1} [degree_east];\
+    # define harp operations: filter pixels, then grid them
+    ops_string = get_filter_operations(product, city_latlons, var_product) + f"\
         bin_spatial({lat_steps+1}, {city_latlons['min_lat']}, {degrees}, {lon_steps+1}, {city_latlons['min_lon']}, {degrees});\
         derive(latitude {{latitude}}); derive(longitude {{longitude}});\
         keep({var_product[product]['keep']}, {keep_general})"
@@ -174,40 +222,467 @@ def get_harp_operations(city, product, degrees, verbose=True,
 
     return ops_string
 
-def process(city, product, degrees, folder, folder_src):
+def get_union_bbox(cities, bboxes=None):
+    """ smallest bounding box containing the bounding box of all 'cities',
+        taken from 'bboxes' = {city: latlons} if given (e.g. in worker processes,
+        where the cities of '--cities_file' aren't registered)
+    """
+    all_latlons = [get_city_bbox(city) if bboxes is None else bboxes[city] for city in cities]
+
+    d = {}
+    d['min_lat'] = min(latlons['min_lat'] for latlons in all_latlons)
+    d['max_lat'] = max(latlons['max_lat'] for latlons in all_latlons)
+    d['min_lon'] = min(latlons['min_lon'] for latlons in all_latlons)
+    d['max_lon'] = max(latlons['max_lon'] for latlons in all_latlons)
+
+    return d
+
+def get_export_name(path, one_file):
+    """ name of the L3 file that harp exports for 'one_file' """
+    return '{}{}.{}'.format(path, one_file.split("/")[-1].replace('L2', 'L3').split('.')[0], 'nc')
+
+def get_numpy_grid(city, product, degrees, method='area', 
+                   var_product=VAR_PRODUCT, keep_general=KEEP_GENERAL):
+    """ grid of the numpy engine, the same as the 'bin_spatial' of get_harp_operations """
+    lat_steps, lon_steps, city_latlons = bounding_box_steps(city, degrees, verbose=False)
+    keep = [name.strip() for name in (var_product[product]['keep'] + ',' + keep_general).split(',')]
+
+    return {'lat_grid': (lat_steps+1, city_latlons['min_lat'], degrees),
+            'lon_grid': (lon_steps+1, city_latlons['min_lon'], degrees),
+            'method': method, 'keep': [name for name in keep if name]}
+
+def get_engine_operations(city, product, degrees, engine='harp', method='area'):
+    """ harp operations and numpy grid (None with the harp engine) of a city.
+        With the numpy engine harp only filters the pixels
+    """
+    if engine == 'harp':
+        return get_harp_operations(city, product, degrees), None
+
+    ops_string = get_filter_operations(product, get_city_bbox(city))
+    print('operations:\n', ops_string, '\n')
+
+    return ops_string, get_numpy_grid(city, product, degrees, method)
+
+def get_run_id(ops_string, grid, export=None):
+    """ string describing how the files are gridded and exported, stored in the manifest """
+    run_id = ops_string
+    if grid is not None:
+        run_id += f" numpy_bin_spatial({grid['lat_grid']}, {grid['lon_grid']}, {grid['method']})"
+    if export is not None:
+        run_id += f" export({export['complevel']}, {export['shuffle']}, {export['float32']})"
+
+    return run_id
+
+def get_export_options(complevel=0, shuffle=True, float32=False):
+    """ options of 'export_L3', None exports with harp (netcdf, uncompressed) """
+    if complevel == 0 and not float32:
+        return None
+
+    return {'complevel': complevel, 'shuffle': shuffle, 'float32': float32}
+
+def write_netcdf4(harp_L3, fname, complevel=4, shuffle=True, float32=False):
+    """ write a harp product as netCDF4 with the same layout as harp's netcdf export,
+        compressing (deflate + shuffle) each grid in one chunk per time step.
+        With 'float32' the float64 measurements are downcast
+    """
+    with netCDF4.Dataset(fname, 'w', format='NETCDF4') as ds:
+        ds.Conventions = 'HARP-1.0'
+        ds.source_product = harp_L3.source_product
+        if harp_L3.history:
+            ds.history = harp_L3.history
+
+        for name in harp_L3:
+            variable = harp_L3[name]
+            data = np.asarray(variable.data)
+            dims = [dim if dim is not None else f'independent_{size}' 
+                        for dim, size in zip(variable.dimension, data.shape)]
+            for dim, size in zip(dims, data.shape):
+                if dim not in ds.dimensions:
+                    ds.createDimension(dim, size)
+
+            if data.dtype.kind in 'OSU':
+                nc_var = ds.createVariable(name, str, dims)
+                nc_var[:] = data.astype(str)
+            else:
+                # coordinates keep their precision so grids stay aligned with other files
+                if float32 and data.dtype == np.float64 and 'time' in dims:
+                    data = data.astype(np.float32)
+                chunks = [1 if dim == 'time' else size for dim, size in zip(dims, data.shape)] if len(dims) > 0 else None
+                nc_var = ds.createVariable(name, data.dtype, dims, zlib=complevel > 0, complevel=max(complevel, 1), 
+                                           shuffle=shuffle and complevel > 0, chunksizes=chunks if complevel > 0 else None)
+                nc_var[:] = data
+
+            if variable.unit:
+                nc_var.units = variable.unit
+            if variable.description:
+                nc_var.description = variable.description
+
+def export_L3(harp_L3, export_pat, export=None):
+    """ export the L3 product with harp or, with 'export' options, as compressed netCDF4.
+        returns the stats of the export: bytes in disk, bytes in memory and seconds
+    """
+    print(f"exporting {export_pat} ...\n")
+    start = time.perf_counter()
+    with profiling.stage('export', export_pat):
+        if export is None:
+            harp.export_product(harp_L3, export_pat, file_format='netcdf')
+        else:
+            write_netcdf4(harp_L3, export_pat, **export)
+
+    return {'bytes': os.path.getsize(export_pat), 'seconds': time.perf_counter() - start,
+            'raw_bytes': sum(np.asarray(harp_L3[name].data).nbytes for name in harp_L3)}
+
+def print_export_stats(all_stats, export=None):
+    """ report the size and write time of the exported files """
+    all_stats = [stats for stats in all_stats if stats is not None]
+    if len(all_stats) == 0:
+        return
+
+    size, raw_size = sum(stats['bytes'] for stats in all_stats), sum(stats['raw_bytes'] for stats in all_stats)
+    seconds = sum(stats['seconds'] for stats in all_stats)
+    mode = 'harp netcdf' if export is None else f"netCDF4 {export}"
+    print(colored(f"exported {len(all_stats)} files ({mode}): {size/1e6:.2f} MB in disk, "
+                  f"{raw_size/1e6:.2f} MB in memory (ratio {raw_size/max(size, 1):.2f}), "
+                  f"{seconds:.2f} s writing ({1000*seconds/len(all_stats):.1f} ms/file)", 'blue'))
+
+def bin_product(harp_L2, grid):
+    """ numpy engine: 'bin_spatial', 'derive(latitude/longitude)' and 'keep'
+        of get_harp_operations over a product already filtered by harp
+    """
+    grid_variables = ['latitude_bounds', 'longitude_bounds', 'latitude', 'longitude']
+    names = [name for name in grid['keep'] if name in harp_L2 and name not in grid_variables
+                and list(harp_L2[name].dimension) == ['time'] 
+                and np.issubdtype(harp_L2[name].data.dtype, np.number)]
+
+    grids = binning.bin_spatial({name: harp_L2[name].data for name in names}, grid['lat_grid'], grid['lon_grid'],
+                                latitude_bounds=harp_L2.latitude_bounds.data, longitude_bounds=harp_L2.longitude_bounds.data,
+                                latitude=harp_L2.latitude.data, longitude=harp_L2.longitude.data,
+                                method=grid['method'])
+
+    # same variables and dimensions as the harp L3 product
+    lat_bounds, lon_bounds = binning.get_cell_bounds(*grid['lat_grid']), binning.get_cell_bounds(*grid['lon_grid'])
+    harp_L3 = harp.Product(source_product=harp_L2.source_product)
+    harp_L3.latitude_bounds = harp.Variable(lat_bounds, ['latitude', None], unit='degree_north')
+    harp_L3.longitude_bounds = harp.Variable(lon_bounds, ['longitude', None], unit='degree_east')
+    for name in names:
+        setattr(harp_L3, name, harp.Variable(grids[name][np.newaxis], ['time', 'latitude', 'longitude'], 
+                                             unit=harp_L2[name].unit, description=harp_L2[name].description))
+    harp_L3.latitude = harp.Variable(lat_bounds.mean(axis=1), ['latitude'], unit='degree_north')
+    harp_L3.longitude = harp.Variable(lon_bounds.mean(axis=1), ['longitude'], unit='degree_east')
+
+    return harp_L3
+
+def read_geolocation(one_file):
+    """ read only the pixel latitudes/longitudes of an orbit (S5P L2 keeps them
+        in the 'PRODUCT' group, harp files in the root group)
+    """
+    with profiling.stage('read_geolocation', one_file), netCDF4.Dataset(one_file) as ds:
+        group = ds.groups['PRODUCT'] if 'PRODUCT' in ds.groups else ds
+        lat = np.ma.filled(group['latitude'][:].astype(float), np.nan)
+        lon = np.ma.filled(group['longitude'][:].astype(float), np.nan)
+
+    return lat, lon
+
+def intersects_bbox(one_file, city_latlons, margin=BBOX_MARGIN):
+    """ cheap pre-screen: True if any pixel of the orbit falls in the city bounding box.
+        If the geolocation can't be read we let harp decide (True)
+    """
+    try:
+        lat, lon = read_geolocation(one_file)
+    except Exception:
+        return True
+
+    return city_registry.any_point_in_bbox(lat, lon, city_latlons, margin)
+
+def process_file(one_file, ops_string, path, city_latlons=None, grid=None, export=None):
+    """ grid one orbit with harp (or with the numpy 'grid') and export it to 'path', 
+        returns the file, its outcome ('ok', 'no_data', 'error' or 'outside'
+        when the pre-screen with 'city_latlons' rejects it before the harp import)
+        and the export stats (None if nothing was exported)
+    """
+    if city_latlons is not None and not intersects_bbox(one_file, city_latlons):
+        return one_file, 'outside', None
+
+    try:
+        with profiling.stage('harp.import_product', one_file):
+            harp_L2_L3 = harp.import_product(one_file, operations=ops_string)
+        if grid is not None:
+            with profiling.stage('bin_product', one_file):
+                harp_L2_L3 = bin_product(harp_L2_L3, grid)
+        stats = export_L3(harp_L2_L3, get_export_name(path, one_file), export)
+    except harp.NoDataError:
+        return one_file, 'no_data', None
+    except Exception:
+        return one_file, 'error', None
+
+    return one_file, 'ok', stats
+
+def get_manifest_path(path):
+    """ the manifest lives next to the L3 files of a city/product """
+    return '{}{}'.format(path, 'manifest')
+
+def load_manifest(manifest_path):
+    """ dict {input file: entry} of previous runs, empty if there is none """
+    if not os.path.isfile(manifest_path+'.pkl'):
+        return {}
+    
+    return load_obj(manifest_path)
+
+def save_manifest(manifest, manifest_path):
+    """ write to a temporary file first, so a killed run never leaves a broken manifest """
+    save_obj(manifest, manifest_path+'_tmp')
+    os.replace(manifest_path+'_tmp.pkl', manifest_path+'.pkl')
+
+def update_catalog(catalog, city, product, all_files, manifest, path):
+    """ record the outcome and L3 file of each orbit in the orbit catalog """
+    if catalog is None:
+        return
+
+    for one_file in all_files:
+        outcome = manifest[one_file]['outcome']
+        catalog.upsert(city, product, one_file, path=one_file, grid_status=outcome,
+                       l3_path=get_export_name(path, one_file) if outcome == 'ok' else None)
+    catalog.commit()
+
+def get_manifest_entry(one_file, ops_string, degrees, outcome=None):
+    """ manifest entry of one input file; 'size', 'mtime', 'ops_string' and 'degrees'
+        tell if the entry is still valid for the current run
+    """
+    stat = os.stat(one_file)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'ops_string': ops_string, 
+            'degrees': degrees, 'outcome': outcome}
+
+def is_up_to_date(manifest, one_file, ops_string, degrees, path):
+    """ True if 'one_file' was already gridded (or had no data) with the same
+        operations and its input did not change since then
+    """
+    entry = manifest.get(one_file)
+    if entry is None or entry['outcome'] not in ['ok', 'no_data', 'outside']:
+        return False
+
+    current = get_manifest_entry(one_file, ops_string, degrees, entry['outcome'])
+    if current != entry:
+        return False
+
+    # the L3 file might have been removed by hand
+    return entry['outcome'] != 'ok' or os.path.isfile(get_export_name(path, one_file))
+
+def map_files(func, items, workers=1):
+    """ yields func(item) in the same order as 'items', 
+        using a pool of 'workers' processes if workers > 1
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    print(colored(f"gridding with {workers} processes", 'blue'))
+    with Pool(processes=workers, maxtasksperchild=MAX_TASKS_PER_CHILD,
+              initializer=profiling.init_worker, initargs=(dict(profiling.STATE),)) as pool:
+        # 'imap' keeps the input order, so outcomes match a serial run
+        yield from pool.imap(func, items)
+
+def grid_files(all_files, ops_string, path, workers=1, city_latlons=None, grid=None, export=None):
+    """ yields (file, outcome, export stats) in the same order as 'all_files' """
+    grid_one = partial(process_file, ops_string=ops_string, path=path, city_latlons=city_latlons, 
+                       grid=grid, export=export)
+    for i, (one_file, outcome, stats) in enumerate(map_files(grid_one, all_files, workers)):
+        print(f'{i+1}/{len(all_files)}: ', one_file, outcome)
+        yield one_file, outcome, stats
+
+def process(city, product, degrees, folder, folder_src, workers=1, force=False, prescreen=True,
+            engine='harp', method='area', export=None, catalog=None):
     """ """
-    no_data_files = []
 
     ## 1. get all files to be processed & create a folder to store data
     all_files = retrieve_files(city, product, folder_src)
     path, fail_path = create_folder_to_save(folder, city, product)
 
-    ## 2. get harp operations
-    ops_string = get_harp_operations(city, product, degrees)
+    ## 2. get harp operations (and the grid of the numpy engine)
+    ops_string, grid = get_engine_operations(city, product, degrees, engine, method)
+    run_id = get_run_id(ops_string, grid, export)
 
     if DEBUG:
         print("######## DEBUG MODE ON")
         all_files = all_files[:N_debug]
 
-    for i, one_file in enumerate(all_files):
-        try:
-            print(f'{i+1}/{len(all_files)}: ', one_file)
-            harp_L2_L3 = harp.import_product(one_file, operations=ops_string)
-            export_pat = '{}{}.{}'.format(path, one_file.split("/")[-1].replace('L2', 'L3').split('.')[0], 'nc')
-            print(f"exporting {export_pat} ...\n")
-            harp.export_product(harp_L2_L3, export_pat, file_format='netcdf')
-        except:
-            no_data_files.append(one_file)
-
+    ## 3. skip files that are up to date in the manifest
+    manifest_path = get_manifest_path(path)
+    manifest = {} if force else load_manifest(manifest_path)
+    to_process = [one_file for one_file in all_files 
+                    if not is_up_to_date(manifest, one_file, run_id, degrees, path)]
+    print(colored(f"{len(all_files)-len(to_process)} files are up to date, "
+                  f"{len(to_process)} files will be processed", 'blue'))
+
+    ## 4. grid each orbit (orbits outside the city bbox are rejected before the harp import)
+    city_latlons = get_city_bbox(city) if prescreen else None
+    n_outside, all_stats = 0, []
+    for i, (one_file, outcome, stats) in enumerate(grid_files(to_process, ops_string, path, workers, 
+                                                              city_latlons, grid, export)):
+        manifest[one_file] = get_manifest_entry(one_file, run_id, degrees, outcome)
+        n_outside += outcome == 'outside'
+        all_stats.append(stats)
+        if (i+1) % MANIFEST_SAVE_EVERY == 0:
+            save_manifest(manifest, manifest_path)
+    save_manifest(manifest, manifest_path)
+
+    if prescreen:
+        print(colored(f"pre-screen saved {n_outside}/{len(to_process)} harp imports", 'blue'))
+    print_export_stats(all_stats, export)
+
+    ## 5. files without data (or that failed), in the same order as 'all_files'
+    no_data_files = [one_file for one_file in all_files if manifest[one_file]['outcome'] != 'ok']
     save_obj(no_data_files, fail_path)
+    update_catalog(catalog, city, product, all_files, manifest, path)
     print("files with no data:\n", no_data_files)
 
+def process_orbit_cities(targets, product, bboxes, index=None, export=None):
+    """ grid one orbit for several cities with a single harp import over the union 
+        of their bounding boxes ('bboxes' = {city: latlons}). 'targets' is a list of 
+        (city, one_file, ops_string, path, grid) with the same orbit (one_file), returns 
+        a list of (city, one_file, outcome, export stats).
+        With a 'CityIndex' the geolocation is read once and only the cities it finds are gridded
+    """
+    outcomes, all_stats = {}, {}
+
+    # pre-screen all cities with a single read of the geolocation and one index query
+    if index is not None:
+        try:
+            lat, lon = read_geolocation(targets[0][1])
+            covered = set(index.query_points(lat, lon))
+            outcomes.update({target[0]: 'outside' for target in targets if target[0] not in covered})
+        except Exception:
+            pass
+
+    to_grid = [target for target in targets if target[0] not in outcomes]
+    if len(to_grid) > 0:
+        try:
+            union_ops = get_filter_operations(product, get_union_bbox([target[0] for target in to_grid], bboxes))
+            with profiling.stage('harp.import_product', to_grid[0][1]):
+                harp_L2 = harp.import_product(to_grid[0][1], operations=union_ops)
+        except harp.NoDataError:
+            outcomes.update({target[0]: 'no_data' for target in to_grid})
+            to_grid = []
+        except Exception:
+            outcomes.update({target[0]: 'error' for target in to_grid})
+            to_grid = []
+
+    # the city operations on the imported product give the same grid as importing it per city
+    for city, one_file, ops_string, path, grid in to_grid:
+        try:
+            with profiling.stage('harp.execute_operations', one_file):
+                harp_L2_L3 = harp.execute_operations(harp_L2, operations=ops_string)
+            if grid is not None:
+                with profiling.stage('bin_product', one_file):
+                    harp_L2_L3 = bin_product(harp_L2_L3, grid)
+            all_stats[city] = export_L3(harp_L2_L3, get_export_name(path, one_file), export)
+            outcomes[city] = 'ok'
+        except harp.NoDataError:
+            outcomes[city] = 'no_data'
+        except Exception:
+            outcomes[city] = 'error'
+
+    return [(city, one_file, outcomes[city], all_stats.get(city)) for city, one_file, _, _, _ in targets]
+
+def process_cities(cities, product, degrees, folder, folder_src, workers=1, force=False, prescreen=True,
+                   engine='harp', method='area', route=False, export=None, catalog=None):
+    """ same as 'process' for several cities at once: each orbit is imported only
+        once (over the union of the bounding boxes of the cities it covers) and 
+        gridded for every city whose folder contains it. 
+        With 'route', the orbits of all city folders are gridded for every city they cover
+    """
+
+    ## 1. files, folders, harp operations & manifest of each city
+    runs = {}
+    for city in cities:
+        all_files = retrieve_files(city, product, folder_src, verbose=not route)
+        if DEBUG:
+            all_files = all_files[:N_debug]
+        path, fail_path = create_folder_to_save(folder, city, product)
+        manifest_path = get_manifest_path(path)
+        ops_string, grid = get_engine_operations(city, product, degrees, engine, method)
+        runs[city] = {'all_files': all_files, 'path': path, 'fail_path': fail_path,
+                      'ops_string': ops_string, 'grid': grid, 'run_id': get_run_id(ops_string, grid, export),
+                      'manifest_path': manifest_path, 
+                      'manifest': {} if force else load_manifest(manifest_path)}
+
+    # with 'route' every city receives the orbits of all folders (once per orbit name)
+    if route:
+        unique_files = {}
+        for run in runs.values():
+            for one_file in run['all_files']:
+                unique_files.setdefault(os.path.basename(one_file), one_file)
+        all_files = [unique_files[name] for name in sorted(unique_files)]
+        print(colored(f"routing {len(all_files)} orbits to {len(cities)} cities", 'green'))
+        for run in runs.values():
+            run['all_files'] = all_files
+
+    ## 2. group by orbit the files that are not up to date
+    orbits = {}
+    for city, run in runs.items():
+        for one_file in run['all_files']:
+            if not is_up_to_date(run['manifest'], one_file, run['run_id'], degrees, run['path']):
+                target = (city, one_file, run['ops_string'], run['path'], run['grid'])
+                orbits.setdefault(os.path.basename(one_file), []).append(target)
+    all_targets = [orbits[name] for name in sorted(orbits)]
+    n_city_files = sum(len(targets) for targets in all_targets)
+    print(colored(f"{n_city_files} city files to process from {len(all_targets)} orbits", 'blue'))
+
+    ## 3. spatial index of the cities to find the ones covered by each orbit
+    index = city_registry.CityIndex(cities, margin=BBOX_MARGIN) if prescreen or route else None
+
+    ## 4. grid each orbit for all its cities
+    # the boxes go to the workers with the task (the registry of the parent isn't there with spawn)
+    bboxes = {city: get_city_bbox(city) for city in cities}
+    grid_one = partial(process_orbit_cities, product=product, bboxes=bboxes, index=index, export=export)
+    all_stats = []
+    for i, results in enumerate(map_files(grid_one, all_targets, workers)):
+        for city, one_file, outcome, stats in results:
+            run = runs[city]
+            run['manifest'][one_file] = get_manifest_entry(one_file, run['run_id'], degrees, outcome)
+            all_stats.append(stats)
+        print(f'{i+1}/{len(all_targets)}: ', [(city, outcome) for city, _, outcome, _ in results])
+        if (i+1) % MANIFEST_SAVE_EVERY == 0:
+            for run in runs.values():
+                save_manifest(run['manifest'], run['manifest_path'])
+
+    ## 5. save manifests and files without data of each city
+    for city, run in runs.items():
+        save_manifest(run['manifest'], run['manifest_path'])
+        no_data_files = [one_file for one_file in run['all_files'] if run['manifest'][one_file]['outcome'] != 'ok']
+        save_obj(no_data_files, run['fail_path'])
+        update_catalog(catalog, city, product, run['all_files'], run['manifest'], run['path'])
+        print(f"{city} files with no data:\n", no_data_files)
+
+    print(colored(f"{len(all_targets)} harp imports for {n_city_files} city files", 'blue'))
+    print_export_stats(all_stats, export)
+
 def main():
 
     parser = set_parser()
     options = parser.parse_args()
     
-    process(options.city, options.product, options.degrees, options.folder, options.folder_src)
+    if options.profile is not None:
+        profiling.enable(options.profile)
+
+    export = get_export_options(options.compress, options.shuffle, options.float32)
+    catalog = open_catalog(options.catalog)
+
+    if options.cities_file is not None:
+        city_registry.load_cities(options.cities_file)
+
+    cities = city_registry.get_cities() if options.city == 'all' else options.city.split(',')
+    with profiling.stage('mk_raster'):
+        if len(cities) > 1 or options.route:
+            process_cities(cities, options.product, options.degrees, options.folder, options.folder_src, 
+                           options.workers, options.force, options.prescreen, options.engine, options.binning,
+                           options.route, export, catalog)
+        else:
+            process(options.city, options.product, options.degrees, options.folder, options.folder_src, 
+                    options.workers, options.force, options.prescreen, options.engine, options.binning, export,
+                    catalog)
+
+    profiling.print_summary()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,217 @@
+""" Spatial overviews of a product ('{product}_overviews.h5'): the daily means
+    averaged in blocks of 2x2, 4x4, 8x8... pixels, so a coarse map or statistic
+    reads a fraction of the bytes of the full resolution tensor.
+
+    Each level is a group named by its factor with:
+        data        (time, longitude, latitude) mean of the valid pixels of each block
+        count       (time, longitude, latitude) number of valid pixels of each block
+        longitude, latitude     mean coordinates of the pixels of each block
+    and 'time' (days since 1970-01-01) is shared by all levels. Each level is
+    computed from the sums & counts of the previous one, so NaN pixels don't
+    count and the mean is the same as averaging the full resolution block.
+
+    join_by_time.py builds it with '--overviews N' (N levels) and updates the
+    changed days with '--update'. 'select_overview' picks the coarsest level
+    that still has at least the requested output size:
+
+        map = select_overview('../data/final_tensors/Moscow/', 'L2__NO2___', size=(100, 80),
+                              start='2019-03-01', end='2019-03-02')
+"""
+
+import os
+import argparse
+
+import numpy as np
+import xarray as xr
+import h5py
+
+from termcolor import colored
+
+import profiling
+from reader import TensorReader, get_window
+from store import TIME_UNITS, to_days, from_days, write_merged
+
+# days read at once when building the overviews from saved tensors
+BLOCK_DAYS = 64
+
+def set_parser():
+    """ set custom parser """
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("-c", "--city", type=str, required=True,
+                        help="City of the product")
+    parser.add_argument("-p", "--product", type=str, required=True,
+                        help="Product to build the overviews of")
+    parser.add_argument("-f", "--folder", type=str, required=False, default='../data/final_tensors',
+                        help="Folder with the final tensors of join_by_time.py")
+    parser.add_argument("-n", "--levels", type=int, required=False, default=3,
+                        help="number of levels (factors 2, 4, 8...)")
+    parser.add_argument("--profile", type=str, required=False, default=None, nargs='?', const='profile.jsonl',
+                        help="write the time and memory of each stage to a JSON lines file (profile.jsonl by default)")
+
+    return parser
+
+def get_overviews_name(path, product):
+    return f'{path}{product}_overviews.h5'
+
+def get_factors(n_levels):
+    """ block sizes of the levels: 2, 4, 8... """
+    return [2**(k+1) for k in range(n_levels)]
+
+def block_sum(values, factor=2):
+    """ sum of the blocks of factor x factor pixels of the last two axes,
+        the grid is padded with zeros if its size isn't a multiple of 'factor'
+    """
+    n_x, n_y = values.shape[-2:]
+    pad_x, pad_y = -n_x % factor, -n_y % factor
+    values = np.pad(values, [(0, 0)]*(values.ndim-2) + [(0, pad_x), (0, pad_y)])
+    shape = values.shape[:-2] + ((n_x+pad_x)//factor, factor, (n_y+pad_y)//factor, factor)
+
+    return values.reshape(shape).sum(axis=(-3, -1))
+
+def get_block_mean(block_values, block_count):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(block_count > 0, block_values/block_count, np.nan)
+
+def compute_levels(values, n_levels):
+    """ (mean, count) of each level of the daily means 'values' (days, longitude, latitude) """
+    valid = np.isfinite(values)
+    level_sum, level_count = np.where(valid, values, 0), valid.astype(np.int32)
+
+    levels = []
+    for _ in range(n_levels):
+        level_sum, level_count = block_sum(level_sum), block_sum(level_count)
+        levels.append((get_block_mean(level_sum, level_count), level_count))
+
+    return levels
+
+def block_coords(coords, factor):
+    """ mean coordinates of the pixels of each block """
+    coords = np.asarray(coords, dtype=float)
+    return block_sum(coords[np.newaxis], factor)[0]/block_sum(np.ones_like(coords)[np.newaxis], factor)[0]
+
+def create_overviews(fname, n_levels, longitude, latitude):
+    """ empty overviews with a resizable group per level """
+    grid_shape = (len(longitude), len(latitude))
+    with h5py.File(fname, 'w') as hf:
+        hf.attrs.update({'factors': get_factors(n_levels), 'time_units': TIME_UNITS,
+                         'dimensions': 'time, longitude, latitude'})
+        hf.create_dataset('time', shape=(0,), dtype=np.int64, maxshape=(None,), chunks=(1024,))
+        for factor in get_factors(n_levels):
+            group = hf.create_group(str(factor))
+            shape = tuple(-(-n // factor) for n in grid_shape)
+            group.create_dataset('longitude', data=block_coords(longitude, factor))
+            group.create_dataset('latitude', data=block_coords(latitude, factor))
+            for name, dtype in [('data', np.float64), ('count', np.int32)]:
+                group.create_dataset(name, shape=(0,) + shape, dtype=dtype, maxshape=(None,) + shape,
+                                     chunks=(1,) + shape)
+
+def write_days(fname, days, values):
+    """ append the overviews of the daily means 'values' """
+    with h5py.File(fname, 'a') as hf:
+        start = hf['time'].shape[0]
+        levels = compute_levels(values, len(hf.attrs['factors']))
+
+        datasets = [(hf['time'], to_days(days))]
+        for factor, (mean, count) in zip(hf.attrs['factors'], levels):
+            datasets += [(hf[str(factor)]['data'], mean), (hf[str(factor)]['count'], count)]
+        for dataset, level_values in datasets:
+            dataset.resize(start + len(days), axis=0)
+            dataset[start:] = level_values
+
+def build_overviews(path, product, n_levels=3, days=None, values=None, longitude=None, latitude=None):
+    """ overviews of the daily means 'values' (days, longitude, latitude) or, if
+        not given, of the saved tensors read BLOCK_DAYS days at a time
+    """
+    fname = get_overviews_name(path, product)
+    if values is not None:
+        create_overviews(fname, n_levels, longitude, latitude)
+        write_days(fname, days, values)
+    else:
+        with TensorReader(path, product) as reader:
+            create_overviews(fname, n_levels, reader.longitude, reader.latitude)
+            for k in range(0, len(reader.time), BLOCK_DAYS):
+                write_days(fname, reader.time[k:k+BLOCK_DAYS], reader.read(slice(k, k+BLOCK_DAYS)))
+
+    print(colored(f"overviews (factors {get_factors(n_levels)}) saved in: {fname}", 'green'))
+    return fname
+
+def update_overviews(path, product, changes):
+    """ write the overviews of the days changed by an update of the tensors
+        (see store.update_store) with its plan: only the changed days and the
+        days moved by the inserted ones are written
+    """
+    fname = get_overviews_name(path, product)
+    if not os.path.isfile(fname):
+        print(colored(f"no overviews to update in {fname}, build them with 'python overviews.py'", 'red'))
+        return
+
+    with h5py.File(fname, 'a') as hf:
+        if hf['time'].shape[0] != changes['plan']['n_old']:
+            print(colored(f"the overviews in {fname} don't have the days of the tensors, "
+                          f"build them again with 'python overviews.py'", 'red'))
+            return
+
+        levels = compute_levels(changes['new_mean'], len(hf.attrs['factors']))
+        datasets, rows = [hf['time']], [to_days(changes['new_time'])]
+        for factor, (mean, count) in zip(hf.attrs['factors'], levels):
+            datasets += [hf[str(factor)]['data'], hf[str(factor)]['count']]
+            rows += [mean, count]
+        write_merged(changes['plan'], datasets, rows)
+
+    print(colored(f"overviews updated with {len(changes['new_time'])} days: {fname}", 'green'))
+
+def choose_factor(factors, grid_shape, size):
+    """ largest factor whose level still has at least 'size' (longitude, latitude) pixels, 1 if none """
+    chosen = 1
+    for factor in sorted(factors):
+        if all(-(-n // factor) >= s for n, s in zip(grid_shape, size)):
+            chosen = factor
+
+    return chosen
+
+def select_overview(path, product, size, start=None, end=None, lat=None, lon=None):
+    """ DataArray (time, longitude, latitude) of the days from 'start' to 'end'
+        (excluded) in the window lat = (min, max), lon = (min, max), read from
+        the coarsest level with at least 'size' = (n_lon, n_lat) pixels in the window
+    """
+    fname = get_overviews_name(path, product)
+    with TensorReader(path, product) as reader:
+        factors = []
+        if os.path.isfile(fname):
+            with h5py.File(fname, 'r') as hf:
+                factors = list(hf.attrs['factors'])
+        window_shape = (len(reader.longitude[get_window(reader.longitude, lon)]),
+                        len(reader.latitude[get_window(reader.latitude, lat)]))
+        factor = choose_factor(factors, window_shape, size)
+        if factor == 1:
+            return reader.select(start, end, lat, lon)
+
+    with h5py.File(fname, 'r') as hf:
+        group = hf[str(factor)]
+        time = from_days(hf['time'][:])
+        longitude, latitude = group['longitude'][:], group['latitude'][:]
+        t = slice(0 if start is None else int(np.searchsorted(time, np.datetime64(start, 'D'))),
+                  len(time) if end is None else int(np.searchsorted(time, np.datetime64(end, 'D'))))
+        i, j = get_window(longitude, lon), get_window(latitude, lat)
+        values = group['data'][t, i, j]
+
+    return xr.DataArray(values, dims=['time', 'longitude', 'latitude'], name=f'{product}_data_x{factor}',
+                        coords={'time': time[t].astype('datetime64[ns]'),
+                                'longitude': longitude[i], 'latitude': latitude[j]})
+
+def main():
+    parser = set_parser()
+    options = parser.parse_args()
+
+    if options.profile is not None:
+        profiling.enable(options.profile)
+
+    path = os.path.join(options.folder, options.city, '')
+    with profiling.stage('build_overviews'):
+        build_overviews(path, options.product, options.levels)
+
+    profiling.print_summary()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+""" Run download.py -> mk_raster.py -> join_by_time.py for all cities & products.
+
+    Each (city, product) has a task per stage, started when the former stage
+    finished without errors:
+        download    'prepare_download' of the product (download.py)
+        grid        'process' of mk_raster.py on the downloaded orbits
+        stack       'process' of join_by_time.py with 'update' (only new orbits are stacked)
+    and each stage runs in its own pool of processes with its own limit of
+    concurrent tasks ('--downloads', '--grids', '--stacks'). While a product is
+    downloading, the orbits that already landed are gridded every POLL_SECONDS
+    (the manifest of mk_raster skips the ones of the former passes), so the
+    last grid pass after the download only has the last orbits left.
+
+    The outcome of every task is appended to a JSON lines status file
+    ('{folder}/pipeline_status.jsonl' by default):
+        {"time": "...", "stage": "grid", "city": "Berlin", "product": "L2__NO2___", "status": "failed",
+         "seconds": 12.3, "error": "NoDataError: ...", "traceback": "..."}
+    with status 'started', 'partial' (a grid pass during the download), 'done',
+    'failed' or 'skipped' (a former stage failed). Running the same command
+    again resumes the run: the (city, product) pairs start from their first
+    stage that is not 'done'.
+
+    python pipeline.py -c Moscow,Istanbul,Berlin -p all --downloads 2 --grids 3 --stacks 1
+"""
+
+try:
+    import os
+    import json
+    import time
+    import argparse
+    import traceback
+    from datetime import datetime
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from multiprocessing import Manager
+
+    from termcolor import colored
+
+    import profiling
+    from catalog import open_catalog
+    from store import STORE_BACKENDS
+    import download
+    from downloader import Downloader
+    import mk_raster
+    import join_by_time
+    from render import set_data_dir, get_year_mean, render_all
+except ModuleNotFoundError as e:
+    print("Module not found: %s"%e)
+
+STAGES = ['download', 'grid', 'stack']
+
+# seconds between the checks for new orbits of the products being downloaded
+POLL_SECONDS = 60
+
+def set_parser():
+    """ set custom parser """
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("-c", "--cities", type=str, required=False, default='Moscow,Istanbul,Berlin',
+                        help="comma separated cities")
+    parser.add_argument("-p", "--products", type=str, required=False, default='all',
+                        help="comma separated products, 'all' for every product of join_by_time.VAR_PRODUCT")
+    parser.add_argument("-f", "--folder", type=str, required=False, default='../data/final_tensors',
+                        help="Folder to save the final tensors")
+    parser.add_argument("-f_grid", "--folder_grid", type=str, required=False, default='../data/crop',
+                        help="Folder to save the gridded orbits")
+    parser.add_argument("-f_src", "--folder_src", type=str, required=False, default='../data',
+                        help="Folder to save the downloaded orbits (in '{folder_src}/{city}/{product}')")
+    parser.add_argument("-l", "--level", type=str, required=False, default='L2',
+                        help="L1B or L2 data")
+    parser.add_argument("-d", "--degrees", type=float, required=False, default=0.01,
+                        help="resolution of the grid in degrees")
+    parser.add_argument("--stages", type=str, required=False, default=','.join(STAGES),
+                        help="comma separated stages to run, e.g. 'grid,stack' if the orbits are already downloaded")
+    parser.add_argument("--downloads", type=int, required=False, default=1,
+                        help="products downloaded at the same time")
+    parser.add_argument("--transfers", type=int, required=False, default=4,
+                        help="files downloaded at the same time by all download tasks")
+    parser.add_argument("--crop", required=False, default=False, action='store_true',
+                        help="crop each orbit to the city box as soon as it is downloaded (see crop.py)")
+    parser.add_argument("--cold_storage", type=str, required=False, default=None,
+                        help="with '--crop', folder where the whole orbits are moved (they are deleted by default)")
+    parser.add_argument("--staging", type=float, required=False, default=None,
+                        help="GB of whole orbits on disk at once in each download task, no limit by default")
+    parser.add_argument("--grids", type=int, required=False, default=1,
+                        help="products gridded at the same time")
+    parser.add_argument("--stacks", type=int, required=False, default=1,
+                        help="products stacked at the same time")
+    parser.add_argument("-w", "--workers", type=int, required=False, default=1,
+                        help="processes of each grid and stack task")
+    parser.add_argument("-s", "--store", type=str, required=False, default='files', choices=['files'] + STORE_BACKENDS,
+                        help="output of join_by_time.py: three files per product or a single 'hdf5'/'zarr' store")
+    parser.add_argument("-db", "--catalog", type=str, required=False, default=None,
+                        help="SQLite orbit catalog (see catalog.py) shared by all stages")
+    parser.add_argument("--status", type=str, required=False, default=None,
+                        help="JSON lines file with the status of each task ('{folder}/pipeline_status.jsonl' by default)")
+    parser.add_argument("--no_resume", dest='resume', required=False, default=True, action='store_false',
+                        help="run all stages again, even the ones done by a former run")
+    parser.add_argument("--plots", required=False, default=False, action='store_true',
+                        help="render the summary plot of each stacked product at the end (see render.py)")
+    parser.add_argument("--data_dir", type=str, required=False, default='../data/cartopy',
+                        help="folder of the Natural Earth shapefiles of the plots (see render.py)")
+    parser.add_argument("--profile", type=str, required=False, default=None, nargs='?', const='profile.jsonl',
+                        help="write the time and memory of each stage to a JSON lines file (profile.jsonl by default)")
+
+    return parser
+
+def download_task(city, product, options, catalog):
+    # the semaphore 'budget' is shared by the download tasks of all cities & products
+    downloader = Downloader(options['transfers'], budget=options['budget'], auth=download.AUTH,
+                            staging=download.get_staging_bytes(options.get('staging')))
+    logs = download.prepare_download(city, os.path.join(options['folder_src'], city), options['level'],
+                                     catalog=catalog, only=[product], downloader=downloader,
+                                     crop=options.get('crop', False), cold_storage=options.get('cold_storage'))
+
+    # a download with failed orbits is not done: the later stages are skipped and a resume retries it
+    failed = [job['title'] for job in logs[product]['failed_prods'].values()]
+    if len(failed) > 0:
+        raise Exception('{} orbits of {}/{} failed to download: {}'.format(len(failed), city, product, ', '.join(failed)))
+
+def grid_task(city, product, options, catalog):
+    mk_raster.process(city, product, options['degrees'], options['folder_grid'], options['folder_src'],
+                      options['workers'], catalog=catalog)
+
+def stack_task(city, product, options, catalog):
+    join_by_time.process(city, product, options['folder'], options['folder_src'], options['folder_grid'],
+                         catalog=catalog, workers=options['workers'], update=True, store=options['store'],
+                         plot=False)
+
+TASKS = {'download': download_task, 'grid': grid_task, 'stack': stack_task}
+
+def run_task(stage, city, product, options):
+    """ run the task of a stage in a worker process, returns its outcome
+        (the error and traceback if it failed) instead of raising
+    """
+    start = time.perf_counter()
+    catalog = open_catalog(options['catalog'])
+    try:
+        with profiling.stage(f'pipeline.{stage}', f'{city}/{product}'):
+            TASKS[stage](city, product, options, catalog)
+        return {'status': 'done', 'seconds': time.perf_counter() - start}
+    except Exception as e:
+        return {'status': 'failed', 'seconds': time.perf_counter() - start,
+                'error': f'{type(e).__name__}: {e}', 'traceback': traceback.format_exc()}
+    finally:
+        if catalog is not None:
+            catalog.close()
+
+def load_status(fname):
+    """ last record of each (stage, city, product) in a status file """
+    last = {}
+    if os.path.isfile(fname):
+        with open(fname) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    last[(record['stage'], record['city'], record['product'])] = record
+
+    return last
+
+def count_landed(folder_src, city, product):
+    """ downloaded orbits of a product (the ones still downloading are '.incomplete') """
+    path = os.path.join(folder_src, city, product)
+    if not os.path.isdir(path):
+        return 0
+
+    return sum(not name.endswith('.incomplete') for name in os.listdir(path))
+
+class Pipeline:
+    """ tasks of the (city, product) pairs on a pool of processes per stage,
+        with the status of each task written to the JSON lines file 'status'
+    """
+
+    def __init__(self, options, stages=STAGES, limits=None, status='pipeline_status.jsonl', resume=True):
+        self.options = options
+        self.stages = [stage for stage in STAGES if stage in stages]
+        self.limits = {stage: (limits or {}).get(stage, 1) for stage in self.stages}
+        self.status = status
+        self.last = load_status(status) if resume else {}
+        self.results = {}
+
+        self.running = {}       # future: (stage, pair, final)
+        self.grids = set()      # pairs with a grid pass running
+        self.waiting = set()    # pairs downloaded while a grid pass was running
+        self.landed = {}        # orbits of each pair at its last grid pass
+        self.pools = {}
+
+    def record(self, stage, pair, status, **info):
+        record = {'time': datetime.now().isoformat(timespec='seconds'), 'stage': stage,
+                  'city': pair[0], 'product': pair[1], 'status': status, **info}
+        with open(self.status, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        if status != 'started':
+            self.results[(stage,) + pair] = record
+
+        return record
+
+    def is_done(self, stage, pair):
+        return self.last.get((stage,) + pair, {}).get('status') == 'done'
+
+    def submit(self, stage, pair, final=True):
+        future = self.pools[stage].submit(run_task, stage, pair[0], pair[1], self.options)
+        self.running[future] = (stage, pair, final)
+        if stage == 'grid':
+            self.grids.add(pair)
+            self.landed[pair] = count_landed(self.options['folder_src'], *pair)
+        if final:
+            self.record(stage, pair, 'started')
+
+    def next_stage(self, stage, pair):
+        """ submit the stage after 'stage' (its inputs changed, so it runs even if it was done) """
+        later = self.stages[self.stages.index(stage)+1:]
+        if len(later) > 0:
+            self.submit(later[0], pair)
+
+    def skip_after(self, stage, pair):
+        for later in self.stages[self.stages.index(stage)+1:]:
+            self.record(later, pair, 'skipped', error=f'{stage} failed')
+
+    def start(self, pair):
+        """ submit the first stage of a pair that is not done """
+        todo = [stage for stage in self.stages if not self.is_done(stage, pair)]
+        if len(todo) == 0:
+            print(colored(f"{pair[0]}/{pair[1]} is done", 'blue'))
+            return
+        self.submit(todo[0], pair)
+
+    def finish(self, future):
+        """ record the outcome of a task and submit the next one """
+        stage, pair, final = self.running.pop(future)
+        outcome = future.result()
+        if stage == 'grid':
+            self.grids.discard(pair)
+
+        if not final:
+            # grid pass during the download: the last pass runs when the download is done
+            if self.results.get((stage,) + pair, {}).get('status') == 'skipped':
+                # the download failed during the pass, the grid stays skipped
+                return
+            status = 'partial' if outcome.pop('status') == 'done' else 'failed'
+            self.record(stage, pair, status, final=False, **outcome)
+            if pair in self.waiting:
+                self.waiting.discard(pair)
+                self.submit('grid', pair)
+            return
+
+        self.record(stage, pair, **outcome)
+        color = 'green' if outcome['status'] == 'done' else 'red'
+        print(colored(f"{stage} of {pair[0]}/{pair[1]}: {outcome['status']} ({outcome['seconds']:.1f} s)", color))
+        if outcome['status'] != 'done':
+            self.skip_after(stage, pair)
+        elif stage == 'download' and pair in self.grids:
+            self.waiting.add(pair)
+        else:
+            self.next_stage(stage, pair)
+
+    def poll_downloads(self):
+        """ grid the orbits that landed since the last pass of the products being downloaded """
+        if 'grid' not in self.stages:
+            return
+        downloading = [pair for stage, pair, _ in self.running.values() if stage == 'download']
+        for pair in downloading:
+            if pair not in self.grids and count_landed(self.options['folder_src'], *pair) > self.landed.get(pair, 0):
+                self.submit('grid', pair, final=False)
+
+    def run(self, pairs):
+        """ run all stages of the (city, product) 'pairs', returns the records of this run """
+        state = dict(profiling.STATE)
+        manager = Manager() if 'download' in self.stages else None
+        if manager is not None:
+            self.options = dict(self.options, budget=manager.BoundedSemaphore(self.options.get('transfers', 4)))
+        self.pools = {stage: ProcessPoolExecutor(self.limits[stage], initializer=profiling.init_worker,
+                                                 initargs=(state,)) for stage in self.stages}
+        try:
+            for pair in pairs:
+                self.start(pair)
+            while len(self.running) > 0:
+                finished, _ = wait(list(self.running), timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    self.finish(future)
+                self.poll_downloads()
+        finally:
+            for pool in self.pools.values():
+                pool.shutdown(cancel_futures=True)
+            if manager is not None:
+                manager.shutdown()
+
+        return self.results
+
+    def print_summary(self):
+        """ number of tasks of each stage & status, and the errors of the failed ones """
+        counts = {}
+        for (stage, _, _), record in self.results.items():
+            counts.setdefault(stage, {}).setdefault(record['status'], 0)
+            counts[stage][record['status']] += 1
+        for stage in self.stages:
+            print(f"{stage}: {counts.get(stage, {})}")
+
+        for (stage, city, product), record in self.results.items():
+            if record['status'] == 'failed':
+                print(colored(f"{stage} of {city}/{product} failed: {record['error']}", 'red'))
+        print(f"status of each task in: {self.status}")
+
+    def done_pairs(self, stage):
+        return [(city, product) for (s, city, product), record in self.results.items()
+                if s == stage and record['status'] == 'done']
+
+def run_pipeline(cities, products, options, stages=STAGES, limits=None, status=None, resume=True):
+    """ run the 'stages' of every city & product with 'limits' = {stage: concurrent tasks},
+        'options' has the folders and settings of the tasks (see 'set_parser')
+    """
+    status = status if status is not None else os.path.join(options['folder'], 'pipeline_status.jsonl')
+    os.makedirs(os.path.dirname(status) or '.', exist_ok=True)
+
+    pipeline = Pipeline(options, stages, limits, status, resume)
+    pairs = [(city, product) for city in cities for product in products]
+    print(f"The pipeline will run {', '.join(pipeline.stages)} for {len(cities)} cities & {len(products)} products")
+    with profiling.stage('pipeline'):
+        pipeline.run(pairs)
+    pipeline.print_summary()
+
+    return pipeline
+
+def main():
+    parser = set_parser()
+    options = parser.parse_args()
+
+    if options.profile is not None:
+        profiling.enable(options.profile)
+
+    cities = options.cities.split(',')
+    products = list(join_by_time.VAR_PRODUCT.keys()) if options.products == 'all' else options.products.split(',')
+    limits = {'download': options.downloads, 'grid': options.grids, 'stack': options.stacks}
+    pipeline = run_pipeline(cities, products, vars(options), options.stages.split(','), limits, options.status,
+                            options.resume)
+
+    if options.plots:
+        plots = []
+        for city, product in pipeline.done_pairs('stack'):
+            path = os.path.join(options.folder, city, '')
+            plots.append((city, get_year_mean(path, product), f'{path}{city}_{product}.png'))
+        set_data_dir(options.data_dir)
+        with profiling.stage('render_all'):
+            render_all(plots, options.workers)
+
+    profiling.print_summary()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+""" Timing and memory instrumentation shared by download.py, mk_raster.py and join_by_time.py
+
+    When enabled (with '--profile' in each script), every 'stage' writes one
+    JSON line to the profile file with its wall time, CPU time, peak RSS and
+    bytes read/written by the process:
+
+        with profiling.stage('harp.import_product', one_file):
+            product = harp.import_product(one_file)
+
+    and 'print_summary' shows a table with the totals of each stage at the end
+    of the run. When it is not enabled, 'stage' does nothing.
+"""
+
+import os
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+import pandas as pd
+
+# profile file and id of the current run (shared with the worker processes)
+STATE = {'path': None, 'run': None}
+
+def enable(path, run=None):
+    """ start writing stages to 'path' (JSON lines) """
+    STATE['path'] = path
+    STATE['run'] = run if run is not None else f'{os.getpid()}-{int(time.time())}'
+    print(f"profiling stages in: {path}")
+
+def init_worker(state):
+    """ initializer of worker processes, so their stages go to the same file """
+    STATE.update(state)
+
+def is_enabled():
+    return STATE['path'] is not None
+
+def read_io():
+    """ bytes read and written by this process (0 if /proc is not available) """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def peak_rss():
+    """ peak resident memory of this process in bytes """
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1 if os.uname().sysname == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+
+def write_record(record):
+    # one short write per line in append mode, so processes don't mix their lines
+    with open(STATE['path'], 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+@contextmanager
+def stage(name, file=None):
+    """ measure the code inside the 'with' block as stage 'name' (of 'file') """
+    if not is_enabled():
+        yield
+        return
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    read, written = read_io()
+    try:
+        yield
+    finally:
+        read_end, written_end = read_io()
+        write_record({'run': STATE['run'], 'pid': os.getpid(), 'stage': name, 'file': file,
+                      'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu,
+                      'peak_rss': peak_rss(), 'read': read_end - read, 'written': written_end - written})
+
+def load_records(path=None, run=None):
+    """ stages of a run (the current one by default) as a DataFrame """
+    path = path if path is not None else STATE['path']
+    run = run if run is not None else STATE['run']
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    return pd.DataFrame([record for record in records if record['run'] == run])
+
+def print_summary(path=None, run=None):
+    """ table with the totals of each stage of the run """
+    if not is_enabled() and path is None:
+        return
+
+    df = load_records(path, run)
+    if len(df) == 0:
+        print("no stages were profiled")
+        return
+
+    summary = df.groupby('stage').agg(calls=('wall', 'size'), wall_s=('wall', 'sum'), cpu_s=('cpu', 'sum'),
+                                      peak_rss_MB=('peak_rss', 'max'), read_MB=('read', 'sum'),
+                                      written_MB=('written', 'sum'))
+    summary[['peak_rss_MB', 'read_MB', 'written_MB']] /= 1e6
+    summary = summary.sort_values('wall_s', ascending=False)
+
+    print(f"\n######## profile summary (run {STATE['run'] if run is None else run})")
+    print(summary.round(3).to_string())
@@ -0,0 +1,195 @@
+""" Pyramid of temporal aggregates of a product ('{product}_pyramid.h5'), so a
+    period mean reads a few precomputed grids instead of every day. Each level
+    has one (period, longitude, latitude) grid per period:
+
+        week        weeks from Monday
+        month       calendar months
+        season      DJF, MAM, JJA, SON (labelled by their first month, December for DJF)
+        year        calendar years
+
+    with the 'sum' of the daily means and the 'count' of days with a valid
+    value, so the mean is the same as averaging the daily tensor (like the
+    annual plot of join_by_time.py), and 'time' the first day of each period.
+
+    join_by_time.py builds it with the tensors and, with '--update', only adds
+    the difference of the days that changed ('update_pyramid'). To (re)build
+    it from saved tensors:
+
+        python pyramid.py -c Moscow -p L2__NO2___
+
+    and to get the mean of March to May from the monthly grids:
+
+        mean, count = period_mean('../data/final_tensors/Moscow/L2__NO2____pyramid.h5',
+                                  'month', '2019-03-01', '2019-06-01')
+"""
+
+import os
+import argparse
+
+import numpy as np
+import h5py
+
+from termcolor import colored
+
+import profiling
+from reader import TensorReader
+from store import TIME_UNITS, to_days, from_days, get_merge_plan, write_merged
+
+LEVELS = ['week', 'month', 'season', 'year']
+
+# days read at once when building the pyramid from saved tensors
+BLOCK_DAYS = 64
+
+def set_parser():
+    """ set custom parser """
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("-c", "--city", type=str, required=True,
+                        help="City of the product")
+    parser.add_argument("-p", "--product", type=str, required=True,
+                        help="Product to build the pyramid of")
+    parser.add_argument("-f", "--folder", type=str, required=False, default='../data/final_tensors',
+                        help="Folder with the final tensors of join_by_time.py")
+    parser.add_argument("--profile", type=str, required=False, default=None, nargs='?', const='profile.jsonl',
+                        help="write the time and memory of each stage to a JSON lines file (profile.jsonl by default)")
+
+    return parser
+
+def get_pyramid_name(path, product):
+    return f'{path}{product}_pyramid.h5'
+
+def get_period_start(days, level):
+    """ first day of the period (of a level of LEVELS) of each day (datetime64[D]) """
+    days = np.asarray(days, dtype='datetime64[D]')
+    if level == 'week':
+        # 1970-01-01 was a Thursday
+        return days - (days.astype(np.int64) + 3) % 7
+    elif level == 'year':
+        return days.astype('datetime64[Y]').astype('datetime64[D]')
+
+    months = days.astype('datetime64[M]')
+    if level == 'month':
+        return months.astype('datetime64[D]')
+    elif level == 'season':
+        # months since the start of the season: Dec, Mar, Jun, Sep -> 0
+        shift = (months.astype(np.int64) % 12 + 1) % 3
+        return (months - shift).astype('datetime64[D]')
+    raise Exception('pyramid level {} is not defined, use one of {}'.format(level, LEVELS))
+
+def aggregate(days, values, level):
+    """ sum of the valid 'values' (days, longitude, latitude) and number of valid
+        days of each period of a level, with the period of each one
+    """
+    periods, index = np.unique(get_period_start(days, level), return_inverse=True)
+    valid = np.isfinite(values)
+
+    period_sum = np.zeros((len(periods),) + values.shape[1:])
+    period_count = np.zeros((len(periods),) + values.shape[1:], dtype=np.int32)
+    np.add.at(period_sum, index, np.where(valid, values, 0))
+    np.add.at(period_count, index, valid)
+
+    return periods, period_sum, period_count
+
+def create_pyramid(fname, grid_shape):
+    """ empty pyramid with a resizable group per level """
+    with h5py.File(fname, 'w') as hf:
+        hf.attrs.update({'levels': ', '.join(LEVELS), 'time_units': TIME_UNITS,
+                         'dimensions': 'period, longitude, latitude'})
+        for level in LEVELS:
+            group = hf.create_group(level)
+            group.create_dataset('time', shape=(0,), dtype=np.int64, maxshape=(None,), chunks=(1024,))
+            for name, dtype in [('sum', np.float64), ('count', np.int32)]:
+                group.create_dataset(name, shape=(0,) + grid_shape, dtype=dtype,
+                                     maxshape=(None,) + grid_shape, chunks=(1,) + grid_shape)
+
+def add_periods(old, new):
+    """ merge of store.write_merged for (time, sum, count) rows: sums & counts are added """
+    return new[0], old[1] + new[1], old[2] + new[2]
+
+def add_days(fname, days, values, sign=1):
+    """ add (or remove with sign=-1) the daily means 'values' (days, longitude, latitude)
+        to the periods of every level. The saved periods are added in place, new
+        periods are appended or inserted in their place and only the changed
+        periods (and the ones after an inserted period) are written
+    """
+    if len(days) == 0:
+        return
+
+    with h5py.File(fname, 'a') as hf:
+        for level in LEVELS:
+            periods, period_sum, period_count = aggregate(days, values, level)
+            group = hf[level]
+
+            # same merge as store.merge_days_into, on sums & counts
+            plan = get_merge_plan(group['time'][:], to_days(periods))
+            write_merged(plan, [group['time'], group['sum'], group['count']],
+                         [to_days(periods), sign*period_sum, sign*period_count], add_periods)
+
+def update_pyramid(path, product, changes):
+    """ apply the days changed by an update of the tensors (see store.update_store)
+        to the pyramid: the former means of those days are removed and the new ones added
+    """
+    fname = get_pyramid_name(path, product)
+    if not os.path.isfile(fname):
+        print(colored(f"no pyramid to update in {fname}, build it with 'python pyramid.py'", 'red'))
+        return
+
+    add_days(fname, changes['old_time'], changes['old_mean'], sign=-1)
+    add_days(fname, changes['new_time'], changes['new_mean'])
+    print(colored(f"pyramid updated with {len(changes['new_time'])} days: {fname}", 'green'))
+
+def build_pyramid(path, product, days=None, values=None):
+    """ pyramid of the daily means 'values' (days, longitude, latitude) or, if
+        not given, of the saved tensors read BLOCK_DAYS days at a time
+    """
+    fname = get_pyramid_name(path, product)
+    if values is not None:
+        create_pyramid(fname, values.shape[1:])
+        add_days(fname, days, values)
+    else:
+        with TensorReader(path, product) as reader:
+            create_pyramid(fname, reader.shape[1:])
+            for k in range(0, len(reader.time), BLOCK_DAYS):
+                add_days(fname, reader.time[k:k+BLOCK_DAYS], reader.read(slice(k, k+BLOCK_DAYS)))
+
+    print(colored(f"pyramid ({', '.join(LEVELS)}) saved in: {fname}", 'green'))
+    return fname
+
+def read_level(fname, level, start=None, end=None):
+    """ periods of a level starting from 'start' to 'end' (excluded):
+        their first day, sum and count grids
+    """
+    with h5py.File(fname, 'r') as hf:
+        group = hf[level]
+        time = from_days(group['time'][:])
+        first = 0 if start is None else int(np.searchsorted(time, np.datetime64(start, 'D')))
+        last = len(time) if end is None else int(np.searchsorted(time, np.datetime64(end, 'D')))
+
+        return time[first:last], group['sum'][first:last], group['count'][first:last]
+
+def period_mean(fname, level, start=None, end=None):
+    """ mean (longitude, latitude) of the days of the periods of a level from
+        'start' to 'end' (excluded), and the number of valid days of each pixel
+    """
+    _, period_sum, period_count = read_level(fname, level, start, end)
+    total_sum, total_count = period_sum.sum(axis=0), period_count.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(total_count > 0, total_sum/total_count, np.nan)
+
+    return mean, total_count
+
+def main():
+    parser = set_parser()
+    options = parser.parse_args()
+
+    if options.profile is not None:
+        profiling.enable(options.profile)
+
+    path = os.path.join(options.folder, options.city, '')
+    with profiling.stage('build_pyramid'):
+        build_pyramid(path, options.product)
+
+    profiling.print_summary()
+
+if __name__ == "__main__":
+    main()
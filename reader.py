@@ -0,0 +1,142 @@
+""" Lazy reader of the tensors saved by join_by_time.py (the three files or a
+    single hdf5/zarr store, see store.py). Nothing but the days and the grid
+    coordinates is read when it is opened; a selection by dates and a
+    latitude/longitude window reads only that part of the tensor:
+
+        with TensorReader('../data/final_tensors/Moscow/', 'L2__NO2___') as reader:
+            march = reader.select('2019-03-01', '2019-04-01', lat=(55.7, 55.8), lon=(37.5, 37.7))
+
+    HDF5 selections are hyperslab reads (only the chunks of the window). If the
+    data is contiguous and uncompressed (e.g. tensors saved by former versions)
+    the selection is a view of a np.memmap of the file, without any copy.
+"""
+
+import os
+
+import numpy as np
+import xarray as xr
+import h5py
+import netCDF4
+
+from store import STORE_BACKENDS, get_store_name, get_tensor_names, open_store, close_store, from_days,\
+                  from_strings
+
+def as_memmap(dataset, fname):
+    """ np.memmap of a contiguous & uncompressed h5py dataset, None if it isn't """
+    if not isinstance(dataset, h5py.Dataset) or dataset.chunks is not None or dataset.compression is not None:
+        return None
+
+    # the offset is None if the dataset has no data written in the file
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+
+    return np.memmap(fname, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+
+def get_window(coords, bounds):
+    """ slice of the (sorted) coordinates inside 'bounds' = (min, max), all if None """
+    if bounds is None:
+        return slice(None)
+
+    inside = np.flatnonzero((coords >= min(bounds)) & (coords <= max(bounds)))
+    if len(inside) == 0:
+        return slice(0, 0)
+    return slice(inside[0], inside[-1] + 1)
+
+class TensorReader:
+    """ lazy reader of the (time, longitude, latitude) tensors of a product, see the module docstring """
+
+    def __init__(self, path, product):
+        self.path = os.path.join(path, '')
+        self.product = product
+        self.files = []
+
+        stores = [get_store_name(self.path, product, backend) for backend in STORE_BACKENDS]
+        stores = [name for name in stores if os.path.exists(name)]
+        if len(stores) > 0:
+            self.open_single_store(stores[0])
+        else:
+            self.open_files()
+
+        # zero-copy views of the datasets that can be memory mapped
+        self.memmaps = {}
+        for variable, (dataset, fname) in self.datasets.items():
+            memmap = as_memmap(dataset, fname)
+            if memmap is not None:
+                self.memmaps[variable] = memmap
+
+    def open_single_store(self, fname):
+        group = open_store(fname, 'r')
+        self.files.append(group)
+        self.datasets = {'data': (group['data'], fname), 'count': (group['count'], fname)}
+        self.time = from_days(group['time'][:])
+        self.latitude, self.longitude = group['latitude'][:], group['longitude'][:]
+
+    def open_files(self):
+        netcdf_name, tensor_name, time_name = get_tensor_names(self.path, self.product)
+        if not os.path.isfile(tensor_name):
+            raise Exception('no tensors of {} in {}'.format(self.product, self.path))
+
+        hf = h5py.File(tensor_name, 'r')
+        self.files.append(hf)
+        # tensors saved by former versions only have the data, in a dataset with any name
+        key = f'{self.product}_data' if f'{self.product}_data' in hf else list(hf.keys())[0]
+        self.datasets = {'data': (hf[key], tensor_name)}
+        if f'{self.product}_count' in hf:
+            self.datasets['count'] = (hf[f'{self.product}_count'], tensor_name)
+
+        with h5py.File(time_name, 'r') as hf_time:
+            time = hf_time[list(hf_time.keys())[0]][:]
+        self.time = from_strings(time)
+
+        # only the coordinates of the netcdf copy are read
+        with netCDF4.Dataset(netcdf_name, 'r') as nc:
+            self.latitude, self.longitude = nc['latitude'][:].data, nc['longitude'][:].data
+
+    @property
+    def variables(self):
+        return list(self.datasets)
+
+    @property
+    def shape(self):
+        return self.datasets['data'][0].shape
+
+    def get_time_slice(self, start=None, end=None):
+        """ slice of the days from 'start' to 'end' (excluded), dates as 'yyyy-mm-dd' """
+        first = 0 if start is None else int(np.searchsorted(self.time, np.datetime64(start, 'D')))
+        last = len(self.time) if end is None else int(np.searchsorted(self.time, np.datetime64(end, 'D')))
+        return slice(first, last)
+
+    def read(self, key, variable='data'):
+        """ raw indexing (time, longitude, latitude) of a variable: a view of the
+            memmap if it is contiguous & uncompressed, a hyperslab read otherwise
+        """
+        if variable in self.memmaps:
+            return self.memmaps[variable][key]
+        return self.datasets[variable][0][key]
+
+    def __getitem__(self, key):
+        return self.read(key)
+
+    def select(self, start=None, end=None, lat=None, lon=None, variable='data'):
+        """ DataArray (time, longitude, latitude) with the days from 'start' to 'end'
+            (excluded) in the window lat = (min, max), lon = (min, max)
+        """
+        t, i, j = self.get_time_slice(start, end), get_window(self.longitude, lon), get_window(self.latitude, lat)
+        values = self.read((t, i, j), variable)
+
+        return xr.DataArray(values, dims=['time', 'longitude', 'latitude'], name=f'{self.product}_{variable}',
+                            coords={'time': self.time[t].astype('datetime64[ns]'),
+                                    'longitude': self.longitude[i], 'latitude': self.latitude[j]})
+
+    def close(self):
+        self.memmaps = {}
+        for group in self.files:
+            close_store(group)
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,221 @@
+""" Render the summary plots (annual mean of each city & product) in parallel.
+
+    'create_save_plot' of join_by_time.py read the 10m Natural Earth land and
+    provinces shapefiles and projected them for every plot. Here the features
+    are read once per city, clipped to the extent of its grid and cached in
+    '{cache}/{city}_basemap.pkl', so the next plots (of any product, in any
+    run) only draw the few geometries of the city. The shapefiles are taken
+    from (or downloaded once to) a local cartopy data folder, so once they are
+    there the plots are rendered offline.
+
+    python render.py -c Moscow,Istanbul,Berlin -p all -w 4
+"""
+
+import os
+import time
+import pickle
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import xarray as xr
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+
+import cartopy
+import cartopy.crs as ccrs
+import cartopy.feature as cf
+from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+from shapely.geometry import box
+
+from termcolor import colored
+
+import profiling
+from reader import TensorReader
+from pyramid import get_pyramid_name, read_level
+from cube import find_products
+
+# Natural Earth features of the background: (category, name, scale)
+FEATURES = {
+    'land': ('physical', 'land', '10m'),
+    'provinces': ('cultural', 'admin_1_states_provinces_lines', '10m'),
+}
+
+# basemaps of the worker processes, {city: basemap}
+BASEMAPS = {}
+
+def set_parser():
+    """ set custom parser """
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("-c", "--cities", type=str, required=True,
+                        help="comma separated cities")
+    parser.add_argument("-p", "--products", type=str, required=False, default='all',
+                        help="comma separated products, 'all' for every product saved for each city")
+    parser.add_argument("-f", "--folder", type=str, required=False, default='../data/final_tensors',
+                        help="Folder with the final tensors of join_by_time.py (the plots are saved there)")
+    parser.add_argument("-w", "--workers", type=int, required=False, default=1,
+                        help="number of processes rendering the plots")
+    parser.add_argument("--cache", type=str, required=False, default='../data/basemaps',
+                        help="folder of the cached basemaps of each city")
+    parser.add_argument("--data_dir", type=str, required=False, default='../data/cartopy',
+                        help="folder of the Natural Earth shapefiles (downloaded there if missing)")
+    parser.add_argument("--profile", type=str, required=False, default=None, nargs='?', const='profile.jsonl',
+                        help="write the time and memory of each stage to a JSON lines file (profile.jsonl by default)")
+
+    return parser
+
+def save_obj(obj, name):
+    with open(name + '.pkl', 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+
+def load_obj(name):
+    with open(name + '.pkl', 'rb') as f:
+        return pickle.load(f)
+
+def set_data_dir(data_dir):
+    """ read (and download if missing) the Natural Earth shapefiles in 'data_dir' """
+    os.makedirs(data_dir, exist_ok=True)
+    cartopy.config['data_dir'] = data_dir
+    cartopy.config['pre_existing_data_dir'] = data_dir
+
+def get_coords_extent(longitude, latitude):
+    """ [min lon, max lon, min lat, max lat] of a grid, plus half a pixel """
+    extent = []
+    for values in [np.asarray(longitude), np.asarray(latitude)]:
+        half = np.abs(np.diff(values)).min()/2 if len(values) > 1 else 0.5
+        extent += [values.min() - half, values.max() + half]
+
+    return [float(v) for v in extent]
+
+def get_extent(img):
+    """ extent of the grid of an image (DataArray with longitude & latitude) """
+    return get_coords_extent(img.coords['longitude'].values, img.coords['latitude'].values)
+
+def get_basemap(city, extent, cache='../data/basemaps'):
+    """ geometries of the FEATURES inside 'extent', from the cache of the city
+        if it was made for the same extent
+    """
+    os.makedirs(cache, exist_ok=True)
+    name = os.path.join(cache, f'{city}_basemap')
+    if os.path.isfile(name + '.pkl'):
+        basemap = load_obj(name)
+        if np.allclose(basemap['extent'], extent):
+            return basemap
+
+    clip = box(extent[0], extent[2], extent[1], extent[3])
+    basemap = {'extent': extent}
+    for key, (category, feature_name, scale) in FEATURES.items():
+        feature = cf.NaturalEarthFeature(category=category, name=feature_name, scale=scale)
+        geometries = [geometry.intersection(clip) for geometry in feature.intersecting_geometries(extent)]
+        basemap[key] = [geometry for geometry in geometries if not geometry.is_empty]
+    save_obj(basemap, name)
+
+    print(colored(f"basemap of {city} saved in: {name}.pkl", 'green'))
+    return basemap
+
+def init_worker(basemaps, state):
+    """ initializer of the rendering processes: the basemaps are sent once to each one """
+    BASEMAPS.update(basemaps)
+    profiling.init_worker(state)
+
+def plot_map(img, fname, basemap):
+    """ same plot as join_by_time.create_save_plot, with the background of a basemap """
+    fig = plt.figure(figsize=(18, 6))
+    ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
+    ax.gridlines()
+
+    # land under the data, provinces over it
+    ax.add_geometries(basemap['land'], ccrs.PlateCarree(), facecolor=cf.COLORS['land'], edgecolor='black', zorder=0)
+
+    # plot data
+    im = img.plot.pcolormesh(ax=ax, x='longitude', y='latitude',
+                                cmap='magma_r', add_colorbar=True,
+                                transform=ccrs.PlateCarree(), zorder=1)
+
+    ax.add_geometries(basemap['provinces'], ccrs.PlateCarree(), facecolor='none', edgecolor='black',
+                      linewidth=0.4, zorder=2)
+
+    # set axis
+    gl = ax.gridlines(draw_labels=True, linewidth=1, color='gray', alpha=0.3, linestyle=':')
+    gl.xlabels_top = False
+    gl.ylabels_right = False
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+
+    plt.savefig(fname, bbox_inches='tight')
+    plt.close(fig)
+
+def render_task(task):
+    """ render one plot in a worker, returns its file and seconds """
+    city, img, fname = task
+    start = time.perf_counter()
+    with profiling.stage('render', fname):
+        plot_map(img, fname, BASEMAPS[city])
+
+    return fname, time.perf_counter() - start
+
+def render_all(tasks, workers=1, cache='../data/basemaps'):
+    """ render the plots of 'tasks' = [(city, img DataArray, fname)] in a pool of
+        processes, the basemap of each city is prepared once for all its products
+    """
+    start = time.perf_counter()
+    with profiling.stage('basemaps'):
+        basemaps = {}
+        for city, img, _ in tasks:
+            if city not in basemaps:
+                basemaps[city] = get_basemap(city, get_extent(img), cache)
+
+    if workers <= 1:
+        init_worker(basemaps, dict(profiling.STATE))
+        times = [render_task(task) for task in tasks]
+    else:
+        with Pool(workers, initializer=init_worker, initargs=(basemaps, dict(profiling.STATE))) as pool:
+            times = pool.map(render_task, tasks)
+
+    total = time.perf_counter() - start
+    print(colored(f"{len(tasks)} plots rendered in {total:.1f} s with {workers} workers "
+                  f"({sum(t for _, t in times):.1f} s of rendering)", 'green'))
+
+    return times
+
+def get_year_mean(path, product):
+    """ annual mean of the first year of a product (the image of the summary plot),
+        from the pyramid if it was saved or from the daily tensor
+    """
+    pyramid = get_pyramid_name(path, product)
+    with TensorReader(path, product) as reader:
+        longitude, latitude = reader.longitude, reader.latitude
+        if os.path.isfile(pyramid):
+            _, year_sum, year_count = read_level(pyramid, 'year')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = np.where(year_count[0] > 0, year_sum[0]/year_count[0], np.nan)
+        else:
+            year = reader.time[0].astype('datetime64[Y]')
+            values = reader.select(str(year), str(year + 1)).mean('time').values
+
+    return xr.DataArray(values, dims=['longitude', 'latitude'], name=product,
+                        coords={'longitude': longitude, 'latitude': latitude})
+
+def main():
+    parser = set_parser()
+    options = parser.parse_args()
+
+    if options.profile is not None:
+        profiling.enable(options.profile)
+    set_data_dir(options.data_dir)
+
+    tasks = []
+    for city in options.cities.split(','):
+        path = os.path.join(options.folder, city, '')
+        products = find_products(path) if options.products == 'all' else options.products.split(',')
+        for product in products:
+            tasks.append((city, get_year_mean(path, product), f'{path}{city}_{product}.png'))
+
+    render_all(tasks, options.workers, options.cache)
+    profiling.print_summary()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+""" Consolidated store of a stacked product: a single HDF5 file ('{product}.h5')
+    or Zarr directory ('{product}.zarr') instead of the '_data.h5', '_time.h5'
+    and '.nc' files, with:
+
+        data        (time, longitude, latitude) daily mean, NaN without valid orbits
+        count       (time, longitude, latitude) orbits averaged in each day and pixel
+        time        (time,) days since 1970-01-01
+        latitude, longitude     coordinates of the grid
+        orbits      names of the stacked orbits
+        attrs       product, city, variable, chunk layout, created/updated (provenance)
+
+    The time axis is unlimited so new orbits are merged with 'update_store'.
+    Zarr (optional, 'pip install zarr') writes each chunk in its own file, so
+    parallel processes can read and write different chunks without file locks.
+
+    The chunk layouts and the merge of new orbits are shared with the three
+    files format of join_by_time.py.
+"""
+
+import os
+import shutil
+from datetime import datetime, timezone
+
+import numpy as np
+import h5py
+
+from termcolor import colored
+
+try:
+    import zarr
+except ModuleNotFoundError:
+    zarr = None
+
+STORE_BACKENDS = ['hdf5', 'zarr']
+STORE_EXTENSION = {'hdf5': '.h5', 'zarr': '.zarr'}
+
+# chunk shapes of the (time, longitude, latitude) tensors:
+# 'day': the whole map of one day (reading a day reads one chunk)
+# 'tile': TILE x TILE pixels of one day
+# 'series': SERIES_DAYS days of TILE x TILE pixels (reading a pixel time series reads few chunks)
+# 'auto': h5py's (or zarr's) guess from the shape
+CHUNK_LAYOUTS = ['day', 'tile', 'series', 'auto']
+TILE = 16
+SERIES_DAYS = 366
+
+TIME_UNITS = 'days since 1970-01-01'
+
+# group with the undo journal of an update until its orbits are recorded (see 'merge_days_into')
+PENDING = 'orbits_pending'
+
+def get_chunks(layout, shape):
+    """ chunk shape of a (time, longitude, latitude) tensor for a layout of CHUNK_LAYOUTS """
+    tile = tuple(min(TILE, n) for n in shape[1:])
+    if layout == 'day':
+        return (1,) + tuple(shape[1:])
+    elif layout == 'tile':
+        return (1,) + tile
+    elif layout == 'series':
+        return (SERIES_DAYS,) + tile
+    elif layout == 'auto':
+        return True
+    raise Exception('chunk layout {} is not defined, use one of {}'.format(layout, CHUNK_LAYOUTS))
+
+def get_tensor_options(layout='day', complevel=0, shuffle=True):
+    """ chunk layout and lossless compression (gzip + shuffle) of the saved tensors """
+    if layout not in CHUNK_LAYOUTS:
+        raise Exception('chunk layout {} is not defined, use one of {}'.format(layout, CHUNK_LAYOUTS))
+
+    return {'layout': layout, 'complevel': complevel, 'shuffle': shuffle}
+
+def is_zarr(group):
+    return zarr is not None and isinstance(group, zarr.Group)
+
+def create_zarr_array(group, name, data, chunks, dtype=None):
+    """ resizable zarr array (zarr 2 & 3), compressed with the zarr default compressor """
+    dtype = dtype if dtype is not None else data.dtype
+    if hasattr(group, 'create_array'):
+        array = group.create_array(name, shape=data.shape, dtype=dtype, chunks='auto' if chunks is True else chunks)
+    else:
+        array = group.create_dataset(name, shape=data.shape, dtype=dtype, chunks=chunks)
+    if data.size > 0:
+        array[...] = data
+    return array
+
+def create_resizable(group, name, data, dtype=None, options=None):
+    """ dataset with an unlimited first (time) axis in a h5py file or zarr group.
+        Tensors are chunked and compressed with the 'options' of 'get_tensor_options'
+        (one day per chunk, uncompressed by default), 1D datasets in chunks of 1024 values
+    """
+    options = options if options is not None else get_tensor_options()
+    chunks = (1024,) if data.ndim == 1 else get_chunks(options['layout'], data.shape)
+
+    if is_zarr(group):
+        # variable length strings (h5py.string_dtype()) are 'str' in zarr
+        dtype = str if dtype is not None and np.dtype(dtype).kind == 'O' else dtype
+        return create_zarr_array(group, name, data, chunks, dtype=dtype)
+
+    compress = data.ndim > 1 and options['complevel'] > 0
+    return group.create_dataset(name, data=data, dtype=dtype, maxshape=(None,) + data.shape[1:], chunks=chunks,
+                                compression='gzip' if compress else None,
+                                compression_opts=options['complevel'] if compress else None,
+                                shuffle=options['shuffle'] and compress)
+
+def is_zarr_array(dataset):
+    return zarr is not None and isinstance(dataset, zarr.Array)
+
+def resize(dataset, n):
+    """ resize the first (time) axis of a h5py dataset or zarr array
+        (a netCDF4 variable grows along its unlimited dimension when it is written)
+    """
+    if is_zarr_array(dataset):
+        dataset.resize((n,) + dataset.shape[1:])
+    elif isinstance(dataset, h5py.Dataset):
+        dataset.resize(n, axis=0)
+
+def append(dataset, values):
+    """ append 'values' to a 1D resizable dataset """
+    n = dataset.shape[0]
+    resize(dataset, n + len(values))
+    if len(values) > 0:
+        dataset[n:] = values
+
+def get_merge_plan(time_old, time_new):
+    """ where the sorted days 'time_new' go among the sorted saved days 'time_old',
+        so only the rows that change are written: the saved days are merged in
+        place and the days after the last saved day are appended. Only when days
+        are inserted among the saved ones, the saved days from the first of them
+        ('shift') on move to make room. The same plan is replayed on all the
+        files with the same time axis (see 'write_merged')
+    """
+    time_old, time_new = np.asarray(time_old), np.asarray(time_new)
+    time_all = np.union1d(time_old, time_new)
+    saved = np.isin(time_new, time_old)
+    inserted = time_new[~saved]
+    shift = int(np.searchsorted(time_old, inserted[0])) if len(inserted) > 0 else len(time_old)
+    position = np.searchsorted(time_all, time_new)
+
+    return {'time': time_all, 'n_old': len(time_old), 'shift': shift, 'saved': saved, 'position': position,
+            'old_position': np.searchsorted(time_old, time_new), 
+            'moved': np.searchsorted(time_all, time_old[shift:]),
+            'n_written': int(np.sum(position < shift)) + len(time_all) - shift}
+
+def read_rows(dataset, positions):
+    """ rows of a dataset at 'positions', one at a time (h5py, zarr & netCDF4 alike) """
+    rows = [np.asarray(dataset[int(k)]) for k in positions]
+    return np.array(rows).reshape((len(positions),) + tuple(dataset.shape[1:]))
+
+def replace_rows(old, new):
+    """ merge of 'write_merged' that keeps the new rows """
+    return new
+
+def write_merged(plan, datasets, rows_new, merge=replace_rows):
+    """ write the 'rows_new' (an array per dataset, a row per day of the plan) into
+        resizable datasets with the time axis of the plan (see 'get_merge_plan'):
+        the saved days are merged with merge(old rows, new rows) (tuples with an
+        array per dataset) and written in place, and only the rows from 'shift' on
+        are rewritten (the moved saved days and the new ones). Returns the rows of
+        the saved days before the merge and the final rows of all days of the plan
+    """
+    shift, n_all = plan['shift'], len(plan['time'])
+    saved, position = plan['saved'], plan['position']
+
+    old_rows = tuple(read_rows(dataset, plan['old_position'][saved]) for dataset in datasets)
+    merged = merge(old_rows, tuple(rows[saved] for rows in rows_new))
+    final = tuple(np.array(rows, copy=True) for rows in rows_new)
+    for rows, merged_rows in zip(final, merged):
+        rows[saved] = merged_rows
+
+    in_place = np.flatnonzero(position < shift)
+    tail = np.flatnonzero(position >= shift)
+    for dataset, rows in zip(datasets, final):
+        # the saved days that move, read before their rows are overwritten
+        moved = dataset[shift:plan['n_old']] if len(plan['moved']) > 0 else None
+        for k in in_place:
+            dataset[int(position[k])] = rows[k]
+        if shift < n_all:
+            if n_all > dataset.shape[0]:
+                resize(dataset, n_all)
+            tail_rows = np.zeros((n_all-shift,) + rows.shape[1:], dtype=rows.dtype)
+            if moved is not None:
+                tail_rows[plan['moved'] - shift] = moved
+            tail_rows[position[tail] - shift] = rows[tail]
+            dataset[shift:n_all] = tail_rows
+
+    return old_rows, final
+
+def merge_mean_rows(old, new):
+    """ merge of 'write_merged' for (time, mean, count) rows: the means are averaged with their counts """
+    (_, old_mean, old_count), (time, mean, count) = old, new
+    total_count = old_count + count
+    total_sum = np.where(old_count > 0, old_mean, 0)*old_count + np.where(count > 0, mean, 0)*count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total_mean = np.where(total_count > 0, total_sum/total_count, np.nan)
+
+    return time, total_mean, total_count
+
+def flush(group):
+    """ write the buffers of the h5py file of a group or dataset (zarr writes each chunk at once) """
+    if not is_zarr(group) and not is_zarr_array(group):
+        group.file.flush()
+
+def begin_update(journal, plan, datasets, orbits, new_orbits):
+    """ undo journal of an update in the group 'journal' ('orbits_pending'): the rows
+        of 'datasets' ({name: dataset}) that the 'plan' overwrites, the number of
+        'orbits' before the update and the 'new_orbits' it adds
+    """
+    pending = journal.create_group(PENDING)
+    in_place = plan['position'][plan['position'] < plan['shift']]
+    create_resizable(pending, 'in_place', np.asarray(in_place, dtype=np.int64))
+    create_resizable(pending, 'orbits', np.asarray(list(new_orbits), dtype=object), dtype=h5py.string_dtype())
+    for name, dataset in datasets.items():
+        create_resizable(pending, f'{name}_in_place', read_rows(dataset, in_place))
+        create_resizable(pending, f'{name}_tail', np.asarray(dataset[plan['shift']:plan['n_old']]))
+    # written last: a journal without 'ready' was interrupted before the data changed
+    pending.attrs.update({'n_old': int(plan['n_old']), 'shift': int(plan['shift']),
+                          'n_orbits': int(orbits.shape[0]), 'ready': True})
+    flush(journal)
+
+def commit_update(journal, orbits, new_orbits):
+    """ append the orbits of an update once its data is written, and drop its journal """
+    append(orbits, list(new_orbits))
+    flush(orbits)
+    del journal[PENDING]
+    flush(journal)
+
+def recover_update(journal, datasets, orbits):
+    """ finish or undo an update interrupted after 'begin_update': if all its orbits
+        were appended it is complete, otherwise the rows it overwrote are restored
+        and the orbits appended since are dropped, so they are merged again (once)
+        by the next update. Returns 'complete', 'undone' or None if there was none
+    """
+    if PENDING not in journal:
+        return None
+
+    pending = journal[PENDING]
+    status = 'undone'
+    if 'ready' in pending.attrs:
+        n_orbits, shift, n_old = (int(pending.attrs[key]) for key in ['n_orbits', 'shift', 'n_old'])
+        names = [decode(name) for name in pending['orbits'][:]]
+        if [decode(name) for name in orbits[n_orbits:]] == names:
+            status = 'complete'
+        else:
+            for name, dataset in datasets.items():
+                for k, row in zip(pending['in_place'][:], pending[f'{name}_in_place'][:]):
+                    dataset[int(k)] = row
+                tail = pending[f'{name}_tail'][:]
+                if len(tail) > 0:
+                    dataset[shift:n_old] = tail
+                resize(dataset, n_old)
+            resize(orbits, n_orbits)
+
+    del journal[PENDING]
+    flush(journal)
+    print(colored(f"an interrupted update was found and {status}", 'red'))
+
+    return status
+
+def merge_days_into(data, count, times, tensor_new, count_new, time_new, orbits, new_orbits, journal):
+    """ merge the daily means of new orbits ('tensor_new', 'count_new' with
+        sorted days 'time_new') into resizable 'data', 'count' and 'times' datasets:
+        days already saved are averaged again with their counts in place, days
+        after the last saved day are appended and only the saved days after a day
+        inserted among them are moved (see 'get_merge_plan'). The names of the
+        'new_orbits' are appended to 'orbits' after the data, as the commit of an
+        undo journal kept in the group 'journal' (see 'recover_update'), so an
+        interrupted update is never merged twice. Returns the plan, the mean of
+        each day of 'time_new' after the merge and the (days, mean) of the saved
+        ones before it
+    """
+    datasets = {'time': times, 'data': data, 'count': count}
+    recover_update(journal, datasets, orbits)
+
+    plan = get_merge_plan(times[:], time_new)
+    begin_update(journal, plan, datasets, orbits, new_orbits)
+    old_rows, final = write_merged(plan, [times, data, count], [np.asarray(time_new), tensor_new, count_new],
+                                   merge_mean_rows)
+    flush(times)
+    flush(data)
+    commit_update(journal, orbits, new_orbits)
+
+    return plan, final[1], (np.asarray(time_new)[plan['saved']], old_rows[1])
+
+def get_tensor_names(path, product):
+    """ netcdf, data and time files of a product in the three files format """
+    return f'{path}{product}.nc', f'{path}{product}_data.h5', f'{path}{product}_time.h5'
+
+def get_store_name(path, product, backend='hdf5'):
+    """ file (hdf5) or directory (zarr) of the store of a product """
+    if backend not in STORE_BACKENDS:
+        raise Exception('store backend {} is not defined, use one of {}'.format(backend, STORE_BACKENDS))
+    return f'{path}{product}{STORE_EXTENSION[backend]}'
+
+def open_store(fname, mode='r'):
+    """ h5py file or zarr group of a store, the backend is given by the extension """
+    if fname.endswith(STORE_EXTENSION['zarr']):
+        if zarr is None:
+            raise Exception('zarr is not installed, use the hdf5 store or "pip install zarr"')
+        return zarr.open_group(fname, mode=mode)
+    return h5py.File(fname, mode)
+
+def close_store(group):
+    # zarr groups don't need to be closed
+    if not is_zarr(group):
+        group.close()
+
+def to_days(time_values):
+    """ days since 1970-01-01 of datetime64 values """
+    return np.asarray(time_values).astype('datetime64[D]').astype(np.int64)
+
+def from_days(days):
+    """ datetime64 (days) of the stored 'time' """
+    return np.asarray(days, dtype=np.int64).astype('datetime64[D]')
+
+def from_strings(time_values):
+    """ datetime64 (days) of the 'yyyy-mm-dd' bytes of '{product}_time.h5' """
+    return np.array([t.decode() for t in time_values], dtype='datetime64[D]')
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+def write_store(fname, product, city, day_mean, day_count, orbits=(), options=None):
+    """ write a product in a single store: the daily mean and count (DataArrays
+        (time, latitude, longitude) of join_by_time.stack_by_day), saved with
+        longitude first like '_data.h5', their coordinates and the stacked 'orbits'
+    """
+    tensor = np.moveaxis(day_mean.values, 1, -1)
+    count = np.moveaxis(day_count.values, 1, -1)
+    options = options if options is not None else get_tensor_options()
+
+    # a store is written from scratch (a zarr directory is not truncated by mode 'w' in all versions)
+    if os.path.isdir(fname):
+        shutil.rmtree(fname)
+    group = open_store(fname, 'w')
+    try:
+        create_resizable(group, 'data', tensor, options=options)
+        create_resizable(group, 'count', count, options=options)
+        create_resizable(group, 'time', to_days(day_mean.coords['time'].values))
+        create_resizable(group, 'orbits', np.asarray(orbits, dtype=object), dtype=h5py.string_dtype())
+        for coord in ['latitude', 'longitude']:
+            values = np.asarray(day_mean.coords[coord].values)
+            if is_zarr(group):
+                create_zarr_array(group, coord, values, values.shape)
+            else:
+                group.create_dataset(coord, data=values)
+
+        group.attrs.update({'product': product, 'city': city, 'variable': str(day_mean.name),
+                            'dimensions': 'time, longitude, latitude', 'time_units': TIME_UNITS,
+                            'chunk_layout': options['layout'], 'complevel': options['complevel'],
+                            'source': 'S5P L3 grids of mk_raster.py stacked by join_by_time.py',
+                            'created': now(), 'updated': now()})
+    finally:
+        close_store(group)
+
+def read_store_orbits(fname):
+    """ names of the orbits in a store, None if it doesn't exist """
+    if not os.path.exists(fname):
+        return None
+
+    group = open_store(fname, 'r')
+    try:
+        return set(decode(name) for name in group['orbits'][:])
+    finally:
+        close_store(group)
+
+def decode(name):
+    return name.decode() if isinstance(name, bytes) else str(name)
+
+def update_store(fname, new_mean, new_count, new_orbits):
+    """ merge the daily means of new orbits into a store (see 'merge_days_into'),
+        returns the number of days and orbits in the store and the changed days:
+        {'plan', 'old_time', 'old_mean', 'new_time', 'new_mean'} (e.g. for pyramid.update_pyramid)
+    """
+    tensor_new = np.moveaxis(new_mean.values, 1, -1)
+    count_new = np.moveaxis(new_count.values, 1, -1)
+    time_new = to_days(new_mean.coords['time'].values)
+
+    group = open_store(fname, 'r+' if fname.endswith(STORE_EXTENSION['zarr']) else 'a')
+    try:
+        plan, day_mean, (old_time, old_mean) = merge_days_into(group['data'], group['count'], group['time'],
+                                                               tensor_new, count_new, time_new,
+                                                               group['orbits'], new_orbits, journal=group)
+        group.attrs['updated'] = now()
+        n_orbits = group['orbits'].shape[0]
+    finally:
+        close_store(group)
+
+    changes = {'plan': plan, 'old_time': from_days(old_time), 'old_mean': old_mean,
+               'new_time': from_days(time_new), 'new_mean': day_mean}
+
+    return len(plan['time']), n_orbits, changes
+
+def read_store(fname):
+    """ all the content of a store: {'data', 'count', 'time' (datetime64),
+        'latitude', 'longitude', 'orbits', 'attrs'}
+    """
+    group = open_store(fname, 'r')
+    try:
+        content = {key: group[key][:] for key in ['data', 'count', 'latitude', 'longitude']}
+        content['time'] = from_days(group['time'][:])
+        content['orbits'] = [decode(name) for name in group['orbits'][:]]
+        content['attrs'] = dict(group.attrs)
+    finally:
+        close_store(group)
+
+    return content
@@ -0,0 +1,159 @@
+""" binning.py against hand-computed overlaps and against harp's 'bin_spatial'
+    (also through the numpy engine of mk_raster.py): directly if harp is
+    installed, and always against the output of a harp run stored in
+    HARP_REFERENCE, which is written where harp is installed with:
+
+        python tests/test_binning.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import binning
+
+VAR = 'tropospheric_NO2_column_number_density'
+
+# grid of the comparisons with harp
+LAT_GRID, LON_GRID = (5, 0, 1), (6, 0, 1)
+METHODS = ['area', 'center']
+
+HARP_REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'harp_bin_spatial.npz')
+
+def pixel_corners(lat_min, lat_max, lon_min, lon_max):
+    """ (4,) latitude and longitude corners of an axis aligned pixel, counterclockwise """
+    return [lat_min, lat_min, lat_max, lat_max], [lon_min, lon_max, lon_max, lon_min]
+
+def make_pixels(boxes):
+    """ latitude_bounds, longitude_bounds (n, 4) and the centers (n,) of some pixels """
+    corners = [pixel_corners(*box) for box in boxes]
+    lat_bounds = np.array([lat for lat, lon in corners], dtype=float).reshape(-1, 4)
+    lon_bounds = np.array([lon for lat, lon in corners], dtype=float).reshape(-1, 4)
+    return lat_bounds, lon_bounds, lat_bounds.mean(axis=1), lon_bounds.mean(axis=1)
+
+def make_swath(n_rows=12, n_cols=9, seed=0):
+    """ pixels of equal size (0.3 x 0.45 degrees) not aligned with a 1 degree grid """
+    rng = np.random.default_rng(seed)
+    boxes = [(0.15 + 0.3*i, 0.45 + 0.3*i, 0.1 + 0.45*j, 0.55 + 0.45*j) for i in range(n_rows) for j in range(n_cols)]
+    return make_pixels(boxes) + (rng.uniform(1, 10, len(boxes)),)
+
+## hand-computed overlaps
+
+def test_pixel_inside_one_cell():
+    lat_bounds, lon_bounds, lat, lon = make_pixels([(0.2, 0.8, 0.2, 0.8)])
+    grids = binning.bin_spatial({VAR: [5.]}, (3, 0, 1), (3, 0, 1), lat_bounds, lon_bounds)
+
+    expected = np.full((2, 2), np.nan)
+    expected[0, 0] = 5
+    np.testing.assert_array_equal(grids[VAR], expected)
+    np.testing.assert_array_equal(grids['count'], [[1, 0], [0, 0]])
+
+def test_half_overlapping_pixel():
+    # a full pixel of 1 in cell (0, 0) and a pixel of 4 with half of it in cell (0, 0)
+    lat_bounds, lon_bounds, lat, lon = make_pixels([(0, 1, 0, 1), (0, 1, 0.5, 1.5)])
+    grids = binning.bin_spatial({VAR: [1., 4.]}, (2, 0, 1), (3, 0, 1), lat_bounds, lon_bounds)
+
+    np.testing.assert_allclose(grids[VAR], [[(1*1 + 0.5*4)/1.5, 4]])
+    np.testing.assert_array_equal(grids['count'], [[2, 1]])
+
+def test_overlap_areas():
+    lat_bounds, lon_bounds, lat, lon = make_pixels([(0.5, 1.5, 0.25, 1.25)])
+    pixel, cell_lat, cell_lon = binning.get_overlapping_cells(lat_bounds, lon_bounds, (3, 0, 1), (3, 0, 1))
+    area = binning.get_overlap_area(lat_bounds, lon_bounds, pixel, cell_lat, cell_lon, (3, 0, 1), (3, 0, 1))
+
+    overlaps = {(i, j): a for i, j, a in zip(cell_lat, cell_lon, area)}
+    assert overlaps == pytest.approx({(0, 0): 0.5*0.75, (0, 1): 0.5*0.25, (1, 0): 0.5*0.75, (1, 1): 0.5*0.25})
+
+def test_center_uses_the_cell_of_the_center():
+    # the pixel is mostly in cell (0, 1) but its center is in cell (0, 0)
+    lat_bounds, lon_bounds, lat, lon = make_pixels([(0.2, 0.8, 0.1, 0.9), (0.2, 0.8, 0.9, 1.9)])
+    grids = binning.bin_spatial({VAR: [2., 6.]}, (2, 0, 1), (3, 0, 1), latitude=lat, longitude=lon, method='center')
+
+    np.testing.assert_array_equal(grids[VAR], [[2, 6]])
+    np.testing.assert_array_equal(grids['count'], [[1, 1]])
+
+def test_nan_values_and_pixels_outside_are_ignored():
+    lat_bounds, lon_bounds, lat, lon = make_pixels([(0.2, 0.8, 0.2, 0.8), (0.2, 0.8, 0.2, 0.8), (5, 6, 5, 6)])
+    for method in ['area', 'center']:
+        grids = binning.bin_spatial({VAR: [3., np.nan, 7.]}, (2, 0, 1), (2, 0, 1), lat_bounds, lon_bounds,
+                                    lat, lon, method=method)
+        np.testing.assert_array_equal(grids[VAR], [[3]])
+
+def test_empty_input_gives_nan():
+    empty = np.zeros((0, 4))
+    for method in ['area', 'center']:
+        grids = binning.bin_spatial({VAR: []}, (3, 0, 1), (4, 0, 1), empty, empty, empty[:, 0], empty[:, 0],
+                                    method=method)
+        assert grids[VAR].shape == (2, 3)
+        assert np.isnan(grids[VAR]).all()
+        np.testing.assert_array_equal(grids['count'], 0)
+
+def test_unknown_method():
+    with pytest.raises(Exception, match='binning method'):
+        binning.bin_spatial({VAR: [1.]}, (2, 0, 1), (2, 0, 1), latitude=[0.5], longitude=[0.5], method='nearest')
+
+## against harp
+
+def make_harp_L2(harp, lat_bounds, lon_bounds, lat, lon, values, with_bounds=True):
+    product = harp.Product(source_product='synthetic_L2.nc')
+    if with_bounds:
+        product.latitude_bounds = harp.Variable(lat_bounds, ['time', None], unit='degree_north')
+        product.longitude_bounds = harp.Variable(lon_bounds, ['time', None], unit='degree_east')
+    product.latitude = harp.Variable(lat, ['time'], unit='degree_north')
+    product.longitude = harp.Variable(lon, ['time'], unit='degree_east')
+    setattr(product, VAR, harp.Variable(values, ['time'], unit='mol/m2'))
+    return product
+
+def run_harp(harp, method):
+    """ harp's L3 product of the swath of 'make_swath' """
+    lat_bounds, lon_bounds, lat, lon, values = make_swath()
+    # harp bins the pixel centers when the product has no bounds
+    harp_L2 = make_harp_L2(harp, lat_bounds, lon_bounds, lat, lon, values, with_bounds=method == 'area')
+    return harp.execute_operations(harp_L2, 'bin_spatial({}, {}, {}, {}, {}, {})'.format(*LAT_GRID, *LON_GRID))
+
+def check_numpy_engine(method, expected, latitude, longitude, harp):
+    """ binning.bin_spatial and mk_raster.bin_product against the harp grid 'expected' """
+    lat_bounds, lon_bounds, lat, lon, values = make_swath()
+    grids = binning.bin_spatial({VAR: values}, LAT_GRID, LON_GRID, lat_bounds, lon_bounds, lat, lon, method=method)
+    np.testing.assert_allclose(grids[VAR], expected, rtol=1e-6, equal_nan=True)
+    np.testing.assert_allclose(binning.get_cell_bounds(*LAT_GRID).mean(axis=1), latitude)
+    np.testing.assert_allclose(binning.get_cell_bounds(*LON_GRID).mean(axis=1), longitude)
+
+    if harp is not None:
+        import mk_raster
+        grid = {'lat_grid': LAT_GRID, 'lon_grid': LON_GRID, 'method': method, 'keep': [VAR]}
+        numpy_L3 = mk_raster.bin_product(make_harp_L2(harp, lat_bounds, lon_bounds, lat, lon, values), grid)
+        np.testing.assert_allclose(numpy_L3[VAR].data[0], expected, rtol=1e-6, equal_nan=True)
+        np.testing.assert_allclose(numpy_L3.latitude.data, latitude)
+        np.testing.assert_allclose(numpy_L3.longitude.data, longitude)
+
+@pytest.mark.parametrize('method', METHODS)
+def test_same_as_harp(method):
+    harp = pytest.importorskip('harp')
+    harp_L3 = run_harp(harp, method)
+    check_numpy_engine(method, harp_L3[VAR].data[0], harp_L3.latitude.data, harp_L3.longitude.data, harp)
+
+@pytest.mark.parametrize('method', METHODS)
+def test_same_as_stored_harp_run(method):
+    if not os.path.isfile(HARP_REFERENCE):
+        pytest.skip(f'{HARP_REFERENCE} is missing, write it with "python tests/test_binning.py" where harp is installed')
+    with np.load(HARP_REFERENCE) as reference:
+        # the stored run is of the same swath
+        np.testing.assert_allclose(reference['values'], make_swath()[-1])
+        check_numpy_engine(method, reference[method], reference['latitude'], reference['longitude'], None)
+
+def save_harp_reference(fname=HARP_REFERENCE):
+    """ store the grids of harp's bin_spatial (both methods) of the swath of 'make_swath' """
+    import harp
+    runs = {method: run_harp(harp, method) for method in METHODS}
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    np.savez_compressed(fname, values=make_swath()[-1], latitude=runs['area'].latitude.data,
+                        longitude=runs['area'].longitude.data, harp_version=getattr(harp, '__version__', ''),
+                        **{method: run[VAR].data[0] for method, run in runs.items()})
+    print(f'harp bin_spatial reference saved in: {fname}')
+
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    save_harp_reference()
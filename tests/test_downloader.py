@@ -0,0 +1,141 @@
+""" downloader.Downloader against a local HTTP server that answers Range requests """
+
+import os
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from downloader import Downloader, get_incomplete_name
+
+DATA = bytes(range(256))*1000
+
+class Hub(BaseHTTPRequestHandler):
+    """ serves DATA at any url. Set on a subclass: 'ranges' (False ignores the Range
+        header), 'failures' (first requests answered with 503) and 'requests'
+        (the Range header of each request is appended)
+    """
+    ranges = True
+    failures = 0
+    requests = None
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('Range'))
+        if len(self.requests) <= self.failures:
+            self.send_error(503)
+            return
+
+        start = 0
+        if self.ranges and self.headers.get('Range') is not None:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(DATA):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(DATA)-1}/{len(DATA)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(DATA) - start))
+        self.end_headers()
+        self.wfile.write(DATA[start:])
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def hub():
+    """ start a server with a new Hub class, returns (url, Hub class) """
+    handler = type('TestHub', (Hub,), {'requests': []})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/orbit.zip', handler
+    server.shutdown()
+    server.server_close()
+
+def make_job(url, tmp_path, md5=None):
+    return {'url': url, 'path': str(tmp_path / 'orbit.zip'), 'size': len(DATA),
+            'md5': md5 or hashlib.md5(DATA).hexdigest()}
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_resume_partial_file(hub, tmp_path):
+    url, handler = hub
+    job = make_job(url, tmp_path)
+    with open(get_incomplete_name(job['path']), 'wb') as f:
+        f.write(DATA[:1000])
+
+    result = Downloader(workers=1, retries=0).download(job)
+
+    assert result['status'] == 'downloaded'
+    assert handler.requests == ['bytes=1000-']
+    assert read(job['path']) == DATA
+    assert not os.path.isfile(get_incomplete_name(job['path']))
+
+def test_server_ignoring_the_range_rewrites_the_file(hub, tmp_path):
+    url, handler = hub
+    handler.ranges = False
+    job = make_job(url, tmp_path)
+    with open(get_incomplete_name(job['path']), 'wb') as f:
+        f.write(b'x'*1000)
+
+    result = Downloader(workers=1, retries=0).download(job)
+
+    assert result['status'] == 'downloaded'
+    assert handler.requests == ['bytes=1000-']
+    assert read(job['path']) == DATA
+
+def test_retry_after_server_error(hub, tmp_path):
+    url, handler = hub
+    handler.failures = 2
+    job = make_job(url, tmp_path)
+
+    result = Downloader(workers=1, retries=2, backoff=0).download(job)
+
+    assert result['status'] == 'downloaded'
+    assert len(handler.requests) == 3
+    assert read(job['path']) == DATA
+
+def test_server_error_after_all_retries(hub, tmp_path):
+    url, handler = hub
+    handler.failures = 5
+    job = make_job(url, tmp_path)
+
+    result = Downloader(workers=1, retries=1, backoff=0).download(job)
+
+    assert result['status'] == 'failed'
+    assert '503' in result['error']
+    assert len(handler.requests) == 2
+    assert not os.path.isfile(job['path'])
+
+def test_md5_mismatch_removes_partial_and_fails(hub, tmp_path):
+    url, handler = hub
+    job = make_job(url, tmp_path, md5='0'*32)
+
+    downloaded, failed = Downloader(workers=1, retries=1, backoff=0).download_all([job])
+
+    assert downloaded == [] and len(failed) == 1
+    assert failed[0]['status'] == 'failed'
+    assert 'md5' in failed[0]['error']
+    # each attempt downloads the whole file again
+    assert handler.requests == [None, None]
+    assert not os.path.isfile(get_incomplete_name(job['path']))
+    assert not os.path.isfile(job['path'])
+
+def test_orbits_outside_are_not_downloaded_again(hub, tmp_path):
+    url, handler = hub
+    outside = make_job(url, tmp_path)
+    inside = dict(make_job(url.replace('orbit', 'inside'), tmp_path), path=str(tmp_path / 'inside.zip'))
+
+    downloaded, failed = Downloader(workers=1, retries=0).download_all([outside, inside],
+                                                                       skip={outside['path']: 'outside'})
+
+    assert failed == []
+    assert {job['path']: job['status'] for job in downloaded} == {outside['path']: 'outside',
+                                                                  inside['path']: 'downloaded'}
+    # only the orbit inside is requested
+    assert handler.requests == [None]
+    assert not os.path.isfile(outside['path'])
@@ -0,0 +1,122 @@
+""" merge of new orbits into the saved days (store.merge_days_into) """
+
+import h5py
+import numpy as np
+import pytest
+
+import store
+
+def make_days(days, seed):
+    """ sorted days, random means with some NaN and their counts (days, 2, 3) """
+    rng = np.random.default_rng(seed)
+    count = rng.integers(0, 3, (len(days), 2, 3)).astype(np.int32)
+    mean = np.where(count > 0, rng.uniform(0, 10, count.shape), np.nan)
+    return np.asarray(days, dtype=np.int64), mean, count
+
+def save(hf, days, mean, count, orbits=('a', 'b')):
+    """ saved 'time', 'data', 'count' and 'orbits' datasets """
+    datasets = [store.create_resizable(hf, name, values) for name, values in [('time', days), ('data', mean),
+                                                                              ('count', count)]]
+    return datasets + [store.create_resizable(hf, 'orbits', np.asarray(orbits, dtype=object),
+                                              dtype=h5py.string_dtype())]
+
+def merge(hf, new, new_orbits=('c',)):
+    return store.merge_days_into(hf['data'], hf['count'], hf['time'], new[1], new[2], new[0],
+                                 hf['orbits'], new_orbits, journal=hf)
+
+def merge_by_hand(old, new):
+    """ expected days, means and counts after merging 'new' into 'old' """
+    days = np.union1d(old[0], new[0])
+    total_sum = np.zeros((len(days), 2, 3))
+    total_count = np.zeros((len(days), 2, 3), dtype=np.int32)
+    for day, mean, count in [old, new]:
+        k = np.searchsorted(days, day)
+        total_sum[k] += np.where(count > 0, mean, 0)*count
+        total_count[k] += count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return days, np.where(total_count > 0, total_sum/total_count, np.nan), total_count
+
+def test_merge_in_place_insert_and_append(tmp_path):
+    old = make_days([0, 1, 4, 5, 7], seed=0)
+    # day 1 is saved, day 3 goes among the saved days and day 9 after them
+    new = make_days([1, 3, 9], seed=1)
+    with h5py.File(tmp_path / 'tensors.h5', 'w') as hf:
+        times, data, count, orbits = save(hf, *old)
+        plan, day_mean, (old_time, old_mean) = merge(hf, new)
+
+        days, mean, total_count = merge_by_hand(old, new)
+        np.testing.assert_array_equal(times[:], days)
+        np.testing.assert_allclose(data[:], mean)
+        np.testing.assert_array_equal(count[:], total_count)
+        assert [store.decode(name) for name in orbits[:]] == ['a', 'b', 'c']
+        assert store.PENDING not in hf
+
+    np.testing.assert_allclose(day_mean, mean[np.searchsorted(days, new[0])])
+    np.testing.assert_array_equal(old_time, [1])
+    np.testing.assert_allclose(old_mean, old[1][[1]])
+    # day 1 in place and the days from day 3 on (days 4, 5 & 7 move)
+    assert plan['shift'] == 2
+    assert plan['n_written'] == 1 + 5
+
+def test_saved_days_before_a_change_are_not_written(tmp_path):
+    old = make_days([0, 1, 2, 3], seed=2)
+    new = make_days([2, 6], seed=3)
+    with h5py.File(tmp_path / 'tensors.h5', 'w') as hf:
+        times, data, count, orbits = save(hf, *old)
+        # a marker in the saved days that must not be written again
+        data[0], data[3] = -1, -1
+        plan, _, _ = merge(hf, new)
+
+        np.testing.assert_array_equal(times[:], [0, 1, 2, 3, 6])
+        np.testing.assert_array_equal(data[0], -1)
+        np.testing.assert_array_equal(data[3], -1)
+
+    assert plan['n_written'] == 2
+
+@pytest.mark.parametrize('fail', ['data', 'orbits'])
+def test_interrupted_update_is_undone(tmp_path, monkeypatch, fail):
+    old = make_days([0, 1, 4], seed=4)
+    new = make_days([1, 2, 6], seed=5)
+    with h5py.File(tmp_path / 'tensors.h5', 'w') as hf:
+        times, data, count, orbits = save(hf, *old)
+
+        # the process dies after the data is written, or as the orbits are recorded
+        write_merged = store.write_merged
+        def crash(*args):
+            if fail == 'data':
+                write_merged(*args)
+            raise KeyboardInterrupt
+        monkeypatch.setattr(store, 'write_merged' if fail == 'data' else 'commit_update', crash)
+        with pytest.raises(KeyboardInterrupt):
+            merge(hf, new)
+        monkeypatch.undo()
+        assert store.PENDING in hf
+
+        # the next update undoes it and merges its orbits once
+        merge(hf, new)
+        days, mean, total_count = merge_by_hand(old, new)
+        np.testing.assert_array_equal(times[:], days)
+        np.testing.assert_allclose(data[:], mean)
+        np.testing.assert_array_equal(count[:], total_count)
+        assert [store.decode(name) for name in orbits[:]] == ['a', 'b', 'c']
+
+def test_update_interrupted_after_its_orbits_is_complete(tmp_path, monkeypatch):
+    old = make_days([0, 1, 4], seed=6)
+    new = make_days([1, 5], seed=7)
+    with h5py.File(tmp_path / 'tensors.h5', 'w') as hf:
+        times, data, count, orbits = save(hf, *old)
+        # the orbits are appended but the journal is not dropped
+        commit_update = store.commit_update
+        def crash(journal, orbits, new_orbits):
+            store.append(orbits, list(new_orbits))
+            raise KeyboardInterrupt
+        monkeypatch.setattr(store, 'commit_update', crash)
+        with pytest.raises(KeyboardInterrupt):
+            merge(hf, new)
+        monkeypatch.setattr(store, 'commit_update', commit_update)
+
+        assert store.recover_update(hf, {'time': times, 'data': data, 'count': count}, orbits) == 'complete'
+        days, mean, total_count = merge_by_hand(old, new)
+        np.testing.assert_allclose(data[:], mean)
+        np.testing.assert_array_equal(count[:], total_count)
+        assert [store.decode(name) for name in orbits[:]] == ['a', 'b', 'c']